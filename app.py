@@ -1,13 +1,17 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 import asyncio
 import uvicorn
 from contextlib import asynccontextmanager
 import json
+import aiohttp
+from loguru import logger
 
 from src.database.simple_db import db
 from src.services.yookassa_service import get_yookassa_service, init_yookassa_service
-from config import SUBSCRIPTION_PLANS, validate_config
+from src.services.prediction_waiters import prediction_waiters, verify_webhook_signature
+from src.services.asset_store import asset_store, MIME_TYPES
+from config import SUBSCRIPTION_PLANS, REPLICATE_WEBHOOK_SECRET, BOT_INTERNAL_HOST, BOT_INTERNAL_PORT, validate_config
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -18,7 +22,8 @@ async def lifespan(app: FastAPI):
     init_yookassa_service()
     # Simple database doesn't need pool initialization
     yield
-    # Simple database doesn't need pool closing
+    # Flush buffered log rows and pending SQLite writes, close connections
+    await db.close()
 
 app = FastAPI(title="Gemini Image Editor Bot API", lifespan=lifespan)
 
@@ -51,27 +56,52 @@ async def yookassa_webhook(request: Request):
             
             plan = SUBSCRIPTION_PLANS.get(plan_type)
             if plan:
-                await db.update_subscription(
-                    user_id, 
-                    plan_type=plan_type,
-                    active=True, 
-                    duration_days=plan['duration_days']
-                )
-                
-                await db.log_payment(
-                    user_id=user_id,
-                    payment_id=payment_id,
-                    plan_type=plan_type,
-                    amount=amount,
-                    currency="RUB",
-                    status="succeeded",
-                    payment_method="yookassa"
-                )
+                # Процесс бота узнает об активации из change_events (сброс кэша и сообщение пользователю)
+                await db.update_subscription(user_id, plan_type, plan['duration_days'], payment_id)
+                await db.add_payment(user_id, payment_id, amount, "succeeded", plan_type)
         
         return JSONResponse(status_code=200, content={"status": "ok"})
         
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.post("/replicate-webhook")
+async def replicate_webhook(request: Request):
+    try:
+        body = await request.body()
+        # Без секрета подпись проверить нечем - такие webhook'и не принимаем
+        if not REPLICATE_WEBHOOK_SECRET:
+            return JSONResponse(status_code=403, content={"error": "webhook secret is not configured"})
+        if not verify_webhook_signature(request.headers, body, REPLICATE_WEBHOOK_SECRET):
+            return JSONResponse(status_code=401, content={"error": "invalid signature"})
+        
+        payload = json.loads(body)
+        
+        # Предсказание ждет либо этот процесс, либо процесс бота - пересылаем туда
+        if not prediction_waiters.resolve(payload):
+            await relay_to_bot("/replicate-webhook", payload)
+        
+        return JSONResponse(status_code=200, content={"status": "ok"})
+        
+    except Exception as e:
+        logger.error(f"Error handling Replicate webhook: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/assets/{asset_name}")
+async def get_asset(asset_name: str):
+    # Изображения для модели (входы редактирования) из хранилища бота
+    asset_id = asset_name.split(".", 1)[0]
+    asset = await asset_store.get(asset_id)
+    if not asset:
+        return JSONResponse(status_code=404, content={"error": "not found"})
+    return FileResponse(asset.path, media_type=MIME_TYPES.get(asset.extension, "application/octet-stream"))
+
+async def relay_to_bot(path: str, payload: dict):
+    """Переслать событие во внутренний сервер процесса бота"""
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+        async with session.post(f"http://{BOT_INTERNAL_HOST}:{BOT_INTERNAL_PORT}{path}", json=payload) as response:
+            if response.status != 200:
+                logger.error(f"Bot internal server returned {response.status} for {path}")
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,1326 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки бота на локальном fake-сервере Replicate (см. fake_replicate.py)
+
+    python benchmark.py generation --concurrency 1,10,50 --latency 2
+    python benchmark.py coalescing --requests 20
+    python benchmark.py webhook --requests 3 --latency 3
+    python benchmark.py polling --requests 5 --latency 8
+    python benchmark.py delivery --image-size 2048
+    python benchmark.py preprocess --requests 3 --latency 2
+    python benchmark.py formats --image-size 1536 --bandwidth 2
+    python benchmark.py variations --count 1,2,4,8 --latency 2
+    python benchmark.py progress --users 16 --workers 4 --latency 3 --patience 4
+    python benchmark.py cancel --latency 6 --after 1
+    python benchmark.py resilience --latency 1 --slow 6 --deadline 3
+    python benchmark.py router --requests 12
+    python benchmark.py telemetry --users 12 --workers 4 --latency 1.5
+    python benchmark.py db --concurrency 1,10,100 --ops 2000
+    python benchmark.py queryplan --users 20000 --generations 300000
+    python benchmark.py logging --jobs 400 --workers 16 --contention 4
+    python benchmark.py subscriptions --users 1000 --clicks 20000 --payments 5 --ttl 2
+    python benchmark.py load --users 50 --flow mixed --latency 3 --distribution lognormal --failure-rate 0.05
+
+Сценарий load гоняет настоящие aiogram Bot и Dispatcher через fake Telegram
+Bot API (см. fake_telegram.py) - апдейты, FSM и middleware как в продакшене.
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import sqlite3
+import sys
+import time
+from types import SimpleNamespace
+
+from aiogram.types import InputFile
+
+FAKE_PORT = 8091
+INTERNAL_PORT = 8092
+FAKE_TELEGRAM_PORT = 8093
+APP_PORT = 8094
+
+class StubMessage:
+    """Минимальная замена aiogram Message для прогона обработчиков"""
+
+    # Скорость загрузки в Telegram (байт/с); None - мгновенно
+    upload_bandwidth = None
+    bytes_uploaded = 0
+
+    def __init__(self, user_id: int, text: str = None):
+        self.from_user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Bench")
+        self.text = text
+        self.photo = None
+        self.photos = []
+        self.edits = []  # время каждой правки текста
+
+    async def answer(self, text, **kwargs):
+        return StubMessage(self.from_user.id, text)
+
+    async def _upload(self, file):
+        if isinstance(file, InputFile):
+            # Вычитываем файл, как это сделала бы multipart-загрузка в Telegram
+            size = 0
+            async for chunk in file.read(None):
+                size += len(chunk)
+            StubMessage.bytes_uploaded += size
+            if self.upload_bandwidth:
+                await asyncio.sleep(size / self.upload_bandwidth)
+
+    async def answer_photo(self, photo, **kwargs):
+        await self._upload(photo)
+        self.photos.append(photo)
+        sent = StubMessage(self.from_user.id)
+        # Telegram возвращает file_id загруженного фото
+        sent.photo = [SimpleNamespace(file_id=photo if isinstance(photo, str) else f"file-{len(self.photos)}")]
+        return sent
+
+    async def answer_media_group(self, media, **kwargs):
+        sent = []
+        for item in media:
+            sent.append(await self.answer_photo(item.media))
+        return sent
+
+    async def answer_document(self, document, **kwargs):
+        await self._upload(document)
+        sent = StubMessage(self.from_user.id)
+        sent.document = SimpleNamespace(file_id=document if isinstance(document, str) else "document")
+        return sent
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        self.edits.append(time.perf_counter())
+
+    async def edit_reply_markup(self, reply_markup=None):
+        pass
+
+    async def delete(self):
+        pass
+
+class StubState:
+    """Минимальная замена FSMContext"""
+
+    def __init__(self):
+        self.data = {}
+
+    async def get_data(self):
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+    async def set_state(self, state=None):
+        pass
+
+    async def clear(self):
+        self.data = {}
+
+async def bench_generation(levels: list[int], latency: float):
+    """Wall-clock N параллельных process_prompt против fake-сервера"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt
+    from src.services.generation_queue import generation_queue
+    await generation_queue.start(workers=max(levels))
+
+    print(f"{'N':>6} {'wall, s':>10} {'per job, s':>12} {'upstream calls':>16}")
+    for n in levels:
+        fake.requests_count = 0
+        messages = [StubMessage(1000 + i, f"Бенчмарк промпт номер {i}") for i in range(n)]
+        start = time.perf_counter()
+        await asyncio.gather(*(process_prompt(message, StubState()) for message in messages))
+        await generation_queue.join()
+        wall = time.perf_counter() - start
+        delivered = sum(len(message.photos) for message in messages)
+        print(f"{n:>6} {wall:>10.2f} {wall / n:>12.3f} {fake.requests_count:>16}  delivered={delivered}")
+
+    await generation_queue.stop()
+    from src.services.result_cache import result_cache
+    from src.services.asset_store import asset_store
+    print(f"result cache: {result_cache.get_stats()}")
+    print(f"asset store: {asset_store.get_stats()}")
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_coalescing(n: int, latency: float):
+    """N одновременных одинаковых промптов должны дать ровно одно предсказание"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt
+    from src.services.generation_queue import generation_queue
+    from src.services.asset_store import asset_store
+    await generation_queue.start(workers=n)
+
+    prompt = f"Кот в космосе {time.time()}"  # уникальный, чтобы не попасть в кэш
+    messages = [StubMessage(2000 + i, prompt) for i in range(n)]
+    await asyncio.gather(*(process_prompt(message, StubState()) for message in messages))
+    await generation_queue.join()
+
+    delivered = sum(len(message.photos) for message in messages)
+    print(f"requests={n} upstream predictions={fake.created_count} delivered={delivered}")
+
+    await generation_queue.stop()
+    await asset_store.close()
+    await runner.cleanup()
+    if fake.created_count != 1:
+        sys.exit(f"expected exactly one upstream prediction, got {fake.created_count}")
+
+async def _start_app(port: int, env: dict):
+    """Запустить app.py (uvicorn) отдельным процессом, как в продакшене, и дождаться /health"""
+    import aiohttp
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+        "--log-level", "warning", env={**os.environ, **env}
+    )
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            if process.returncode is not None:
+                break
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/health") as response:
+                    if response.status == 200:
+                        return process
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    if process.returncode is None:
+        process.terminate()
+    raise RuntimeError("app.py не запустился")
+
+async def bench_webhook(n: int, latency: float):
+    """Время до результата: опрос статуса против webhook через /replicate-webhook в app.py"""
+    import aiohttp
+    import tempfile
+    from fake_replicate import start_fake_replicate
+    from config import REPLICATE_WEBHOOK_SECRET
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency, webhook_secret=REPLICATE_WEBHOOK_SECRET)
+
+    from src.bot.internal_server import start_internal_server
+    from src.services.gemini_service import replicate_service as sdk_service
+    from src.services.replicate_service import replicate_service as rest_service
+    # Webhook идет в app.py: проверка подписи, затем пересылка во внутренний сервер этого процесса
+    internal = await start_internal_server("127.0.0.1", INTERNAL_PORT)
+    app = await _start_app(APP_PORT, {
+        "SQLITE_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bench-webhook-"), "app.db"),
+        "BOT_INTERNAL_HOST": "127.0.0.1", "BOT_INTERNAL_PORT": str(INTERNAL_PORT)
+    })
+    webhook_url = f"http://127.0.0.1:{APP_PORT}/replicate-webhook"
+
+    # Неподписанный и устаревший webhook app.py должен отклонить
+    async with aiohttp.ClientSession() as session:
+        body = b'{"id": "forged", "status": "succeeded"}'
+        async with session.post(webhook_url, data=body) as response:
+            print(f"unsigned webhook: {response.status}")
+        headers = fake._webhook_headers(body)
+        headers["webhook-timestamp"] = str(int(time.time()) - 600)
+        async with session.post(webhook_url, data=body, headers=headers) as response:
+            print(f"stale webhook: {response.status}")
+
+    print(f"{'service':>8} {'mode':>8} {'median, s':>10} {'http calls/pred':>16}")
+    for name, service in (("sdk", sdk_service), ("rest", rest_service)):
+        for mode in ("polling", "webhook"):
+            service.webhook_url = webhook_url if mode == "webhook" else None
+            fake.requests_count = 0
+            timings = []
+            for i in range(n):
+                start = time.perf_counter()
+                await service.generate_image(f"Бенчмарк webhook {name} {mode} {i}")
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            print(f"{name:>8} {mode:>8} {timings[len(timings) // 2]:>10.2f} {fake.requests_count / n:>16.1f}")
+
+    app.terminate()
+    await app.wait()
+    await internal.cleanup()
+    await rest_service.close()
+    await runner.cleanup()
+
+async def bench_polling(n: int, latency: float):
+    """REST-сервис: фиксированный опрос раз в 5 с против адаптивного"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.services.replicate_service import replicate_service as service
+    service.webhook_url = None
+    adaptive = (service.poll_min, service.poll_max)
+
+    print(f"{'mode':>9} {'median, s':>10} {'overhead, s':>12} {'http calls/pred':>16}")
+    for mode, (poll_min, poll_max) in (("fixed 5s", (5.0, 5.0)), ("adaptive", adaptive)):
+        service.poll_min, service.poll_max = poll_min, poll_max
+        fake.requests_count = 0
+        timings = await asyncio.gather(*(_timed(service.generate_image(f"Бенчмарк опроса {mode} {i}"))
+                                         for i in range(n)))
+        median = sorted(timings)[len(timings) // 2]
+        print(f"{mode:>9} {median:>10.2f} {median - latency:>12.2f} {fake.requests_count / n:>16.1f}")
+
+    await service.close()
+    await runner.cleanup()
+
+async def bench_delivery(image_size: int, requests: int):
+    """Доставка большого результата: буфер в памяти против потоковой загрузки"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=0, image_size=image_size, noise=True)
+    print(f"fake image: {len(fake.image) / 1024 / 1024:.1f} MB")
+
+    from src.services.asset_store import asset_store
+    from src.services.delivery import delivery_service, current_rss
+    url = f"http://127.0.0.1:{FAKE_PORT}/files/bench.png"
+
+    # Потоковая загрузка: файл проходит через процесс частями по 64 КБ
+    baseline = current_rss()
+    for _ in range(requests):
+        await delivery_service.send_photo(StubMessage(3000), url, None)
+    stats = delivery_service.get_stats()
+    print(f"streamed: peak rss +{(stats['peak_rss'] - baseline) / 1024 / 1024:.1f} MB, "
+          f"ttfb p50 {stats['p50_ttfb'] * 1000:.1f} ms, {stats['bytes'] / 1024 / 1024:.1f} MB transferred")
+
+    # "До": файл целиком читается в память. Меряем вторым - освобожденная
+    # память не всегда возвращается ОС и исказила бы замер потока.
+    peak = current_rss()
+    for _ in range(requests):
+        async with asset_store.session().get(url) as response:
+            data = await response.read()
+        peak = max(peak, current_rss())
+        del data
+    print(f"buffered: peak rss +{(peak - baseline) / 1024 / 1024:.1f} MB")
+    print(f"delivery: {stats}")
+
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_formats(image_size: int, bandwidth_mb: float):
+    """Размер и время доставки результата для каждого профиля кодирования"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=0, image_size=image_size, noise=True)
+
+    from config import OUTPUT_PROFILES
+    from src.services.asset_store import asset_store
+    from src.services.delivery import delivery_service
+    from src.services.image_preprocessing import image_preprocessor
+    StubMessage.upload_bandwidth = bandwidth_mb * 1024 * 1024
+
+    print(f"{image_size}px result, upload to Telegram {bandwidth_mb} MB/s")
+    print(f"{'profile':>10} {'format':>7} {'sent, KB':>9} {'delivery, s':>12}")
+    for name, profile in OUTPUT_PROFILES.items():
+        url = f"http://127.0.0.1:{FAKE_PORT}/files/{name}-{time.time()}.{profile['model_format']}"
+        StubMessage.bytes_uploaded = 0
+        start = time.perf_counter()
+        original, photo = await delivery_service.prepare_result(url, None, profile)
+        await delivery_service.send_photo(StubMessage(4000), url, photo, profile['model_format'])
+        elapsed = time.perf_counter() - start
+        print(f"{name:>10} {profile['format']:>7} {StubMessage.bytes_uploaded / 1024:>9.0f} {elapsed:>12.2f}")
+
+    image_preprocessor.close()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_variations(counts: list[int], latency: float):
+    """Время одной задачи вариантов в зависимости от N (предсказания идут параллельно)"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import run_variations_job
+    from src.services.generation_queue import generation_queue, GenerationJob
+    from src.services.asset_store import asset_store
+    await generation_queue.start(workers=1)
+
+    print(f"{'N':>6} {'wall, s':>10} {'per image, s':>14} {'predictions':>12} {'delivered':>10}")
+    for n in counts:
+        fake.created_count = 0
+        message = StubMessage(5000 + n)
+        start = time.perf_counter()
+        await generation_queue.enqueue(GenerationJob(
+            telegram_id=5000 + n,
+            kind='variations',
+            prompt=f"Бенчмарк вариантов {n} {time.time()}",
+            regenerate=True,
+            cost=n,
+            execute=run_variations_job,
+            context={'message': message, 'processing_msg': StubMessage(5000 + n), 'state': StubState()}
+        ))
+        await generation_queue.join()
+        wall = time.perf_counter() - start
+        print(f"{n:>6} {wall:>10.2f} {wall / n:>14.2f} {fake.created_count:>12} {len(message.photos):>10}")
+
+    await generation_queue.stop()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_progress(users: int, workers: int, latency: float, patience: float):
+    """
+    Повторные отправки с прогрессом и без.
+
+    Модель нетерпеливого пользователя: если сообщение ожидания не менялось
+    patience секунд, он отправляет тот же промпт еще раз.
+    """
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt
+    from src.services.generation_queue import generation_queue
+    from src.services.progress import progress_service
+    from src.services.asset_store import asset_store
+    await generation_queue.start(workers=workers)
+
+    async def impatient_user(user_id: int, prompt: str):
+        message = StubMessage(user_id, prompt)
+        sent = []
+        original_answer = message.answer
+
+        async def answer(text, **kwargs):
+            reply = await original_answer(text, **kwargs)
+            sent.append(reply)
+            return reply
+        message.answer = answer
+
+        await process_prompt(message, StubState())
+        last_seen = time.perf_counter()
+        while not message.photos:
+            await asyncio.sleep(0.1)
+            last_change = max([last_seen] + [edit for reply in sent for edit in reply.edits])
+            if time.perf_counter() - last_change >= patience:
+                await process_prompt(message, StubState())
+                last_seen = time.perf_counter()
+        return sent
+
+    print(f"{users} users, {workers} workers, latency {latency}s, patience {patience}s, "
+          f"edit interval {progress_service.min_interval}s")
+    print(f"{'progress':>9} {'submissions':>12} {'duplicates':>11} {'rate':>7} {'edits/job':>10} {'min gap, s':>11} {'wall, s':>8}")
+    for enabled in (False, True):
+        progress_service.enabled = enabled
+        progress_service.submissions = progress_service.duplicates = progress_service.edits = 0
+        start = time.perf_counter()
+        replies = await asyncio.gather(*(
+            impatient_user(6000 + i, f"Прогресс {enabled} пользователь {i} {time.time()}") for i in range(users)
+        ))
+        await generation_queue.join()
+        wall = time.perf_counter() - start
+        # Минимальный интервал между правками одного сообщения - проверка троттлинга
+        gaps = [b - a for reply in sum(replies, []) for a, b in zip(reply.edits, reply.edits[1:])]
+        stats = progress_service.get_stats()
+        print(f"{'on' if enabled else 'off':>9} {stats['submissions']:>12} {stats['duplicates']:>11} "
+              f"{stats['duplicate_rate']:>7.1%} {stats['edits'] / stats['submissions']:>10.1f} "
+              f"{min(gaps, default=0):>11.2f} {wall:>8.1f}")
+
+    await generation_queue.stop()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_cancel(latency: float, after: float):
+    """Отмена кнопкой и заменой новым запросом: освобождение воркера и отмена в Replicate"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt, callback_cancel_job
+    from src.services.generation_queue import generation_queue
+    from src.services.gemini_service import replicate_service
+    from src.services.asset_store import asset_store
+    from src.database.simple_db import db
+    await generation_queue.start(workers=1)
+
+    async def submit(user_id: int, prompt: str) -> StubMessage:
+        message = StubMessage(user_id, prompt)
+        replies = []
+        original_answer = message.answer
+
+        async def answer(text, **kwargs):
+            reply = await original_answer(text, **kwargs)
+            replies.append(reply)
+            return reply
+        message.answer = answer
+        await process_prompt(message, StubState())
+        message.replies = replies
+        return message
+
+    async def answer_callback(text=None, **kwargs):
+        pass
+
+    # 1. Кнопка "Отменить": единственный воркер занят, вторая задача ждет в очереди
+    run = time.time()
+    first = await submit(8001, f"Отмена кнопкой {run}")
+    second = await submit(8002, f"Задача в очереди {run}")
+    await asyncio.sleep(after)
+    job = generation_queue.user_jobs(8001)[0]
+    start = time.perf_counter()
+    await callback_cancel_job(SimpleNamespace(
+        data=f"cancel:{job.job_id}", from_user=SimpleNamespace(id=8001), answer=answer_callback
+    ))
+    while not generation_queue.user_jobs(8002) or generation_queue.user_jobs(8002)[0].started_at is None:
+        await asyncio.sleep(0.01)
+    freed = time.perf_counter() - start
+    await generation_queue.join()
+    print(f"button: worker freed in {freed * 1000:.0f} ms, cancelled job delivered {len(first.photos)} photos, "
+          f"queued job delivered {len(second.photos)}")
+
+    # 2. Новый запрос заменяет незавершенный
+    superseded = await submit(8003, f"Старый запрос {run}")
+    await asyncio.sleep(after)
+    replacement = await submit(8003, f"Новый запрос {run}")
+    await generation_queue.join()
+    await asyncio.sleep(0.2)  # фоновая отмена в Replicate
+    print(f"superseded: old message {superseded.replies[0].text!r}, old delivered {len(superseded.photos)}, "
+          f"new delivered {len(replacement.photos)}")
+
+    print(f"upstream cancelled: {fake.cancelled_count} (service {replicate_service.cancelled_upstream}), "
+          f"model time saved {fake.saved_seconds:.1f}s of {latency * 2:.1f}s")
+    await db.flush()
+    conn = sqlite3.connect(db.db_path)
+    rows = conn.execute(
+        "SELECT user_id, status FROM image_generations WHERE user_id IN (8001, 8002, 8003) ORDER BY id DESC LIMIT 4"
+    ).fetchall()
+    conn.close()
+    print(f"image_generations: {rows}")
+
+    await generation_queue.stop()
+    await replicate_service.close()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_resilience(latency: float, slow: float, deadline: float):
+    """Деградация провайдера: hedged-запрос к запасной модели, дедлайны, breaker и восстановление"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt
+    from src.services.generation_queue import generation_queue
+    from src.services.gemini_service import replicate_service
+    from src.services.asset_store import asset_store
+    await generation_queue.start(workers=4)
+    primary, fallback = "nano-banana", replicate_service.fallback_model
+    primary_ref, fallback_ref = replicate_service.models[primary], replicate_service.models[fallback]
+    run = time.time()
+
+    async def burst(name: str, n: int):
+        timings = []
+
+        async def one(i: int):
+            start = time.perf_counter()
+            try:
+                url = await replicate_service.generate_image(f"{name} {run} {i}")
+                outcome = "fallback" if replicate_service.served_by_fallback(url) else ("ok" if url else "failed")
+            except Exception as e:
+                outcome = type(e).__name__
+            timings.append((time.perf_counter() - start, outcome))
+
+        await asyncio.gather(*(one(i) for i in range(n)))
+        durations = sorted(duration for duration, _ in timings)
+        outcomes = {}
+        for _, outcome in timings:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        stats = replicate_service.get_stats()
+        states = {model: breaker['state'] for model, breaker in stats['breakers'].items()}
+        print(f"{name:<10} max {durations[-1]:>6.2f}s  {outcomes}  breakers={states}  "
+              f"hedges={stats['hedges']} wins={stats['hedge_wins']} deadlines={stats['deadlines_exceeded']}")
+
+    # 1. Здоровый провайдер - набираем статистику задержки для p95
+    await burst("warm-up", 10)
+    tracker = replicate_service.latency_for(primary)
+    print(f"p95 {tracker.p95():.2f}s -> hedge after {tracker.hedge_delay():.2f}s")
+
+    # 2. Основная модель медленная - hedged-запрос к быстрой запасной
+    fake.model_latency[primary_ref] = slow
+    fake.model_latency[fallback_ref] = latency / 2
+    await burst("degraded", 5)
+
+    # 3. Основная модель зависла, запасная недоступна - дедлайн и размыкание breaker'ов
+    fake.model_latency[primary_ref] = deadline * 10
+    fake.down_models.add(fallback_ref)
+    await burst("outage", 5)
+
+    # Пользователь получает ответ сразу, очередь не занимается
+    message = StubMessage(9001, f"Во время сбоя {run}")
+    replies = []
+
+    async def answer(text, **kwargs):
+        reply = StubMessage(9001, text)
+        replies.append(reply)
+        return reply
+    message.answer = answer
+    start = time.perf_counter()
+    await process_prompt(message, StubState())
+    print(f"user answer in {(time.perf_counter() - start) * 1000:.0f} ms: {replies[0].text.splitlines()[0]!r}")
+    await burst("open", 3)
+
+    # 4. Провайдер восстановился - после reset_timeout пробный вызов замыкает breaker
+    fake.model_latency.clear()
+    fake.down_models.clear()
+    await asyncio.sleep(replicate_service.breaker(primary).reset_timeout)
+    await burst("probe", 1)
+    await burst("recovered", 5)
+
+    print(f"upstream predictions created: {fake.created_count}, cancelled: {fake.cancelled_count}")
+    await generation_queue.stop()
+    await replicate_service.close()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_router(n: int):
+    """Выбор модели по политикам и тарифам; перестройка при отказе самой быстрой модели"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=1.0)
+
+    from src.services.gemini_service import replicate_service
+    from src.services.asset_store import asset_store
+    router = replicate_service.router
+
+    # Задержки моделей на fake-сервере (модели сообщества - по версии)
+    latencies = {"nano-banana": 1.5, "flux-dev": 1.0, "flux-schnell": 0.3, "sdxl": 1.2, "stable-diffusion": 0.6}
+    for key, seconds in latencies.items():
+        ref = replicate_service.models[key]
+        fake.model_latency[ref.split(":", 1)[1] if ":" in ref else ref] = seconds
+    run = time.time()
+
+    async def burst(plan: str, label: str):
+        chosen, durations, costs = {}, [], 0.0
+
+        async def one(i: int):
+            nonlocal costs
+            start = time.perf_counter()
+            try:
+                route = replicate_service.route(plan)
+            except Exception:
+                chosen["none"] = chosen.get("none", 0) + 1
+                return
+            url = await replicate_service.generate_image(f"Роутер {label} {run} {i}", route=route)
+            chosen[route.model] = chosen.get(route.model, 0) + 1
+            if url:
+                durations.append(time.perf_counter() - start)
+                costs += router.prediction_cost(route.model, latencies[route.model]) or 0.0
+
+        for batch in range(0, n, 4):
+            await asyncio.gather(*(one(i) for i in range(batch, min(n, batch + 4))))
+        avg = sum(durations) / len(durations) if durations else 0.0
+        print(f"{label:<22} {plan:<9} {str(chosen):<40} ok {len(durations):>2}/{n}  "
+              f"avg {avg:>5.2f}s  cost ${costs:.4f}")
+
+    # Разогрев: исследование набирает замеры всех моделей
+    router.set_policy("fastest")
+    for _ in range(3):
+        await burst("1_month", "warm-up")
+    router.explore = 0.0
+
+    print(f"{'policy':<22} {'plan':<9} {'chosen':<40}")
+    for policy in ("best", "fastest", "cheapest"):
+        router.set_policy(policy)
+        for plan in ("1_month", "1_year"):
+            await burst(plan, policy)
+
+    # Самая быстрая модель отказывает: breaker размыкается, роутер уходит на следующую
+    router.set_policy("fastest")
+    fake.down_models.add(replicate_service.models["flux-schnell"])
+    await burst("1_month", "fastest, schnell down")
+    await burst("1_month", "fastest, after")
+    print(f"router: chosen {router.get_stats()['chosen']}")
+    print(f"last decision: {router.recent_decisions(1)[0]['candidates'][:2]}")
+
+    await replicate_service.close()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_telemetry(users: int, workers: int, latency: float):
+    """Время этапов генерации из истории и отчет /admin_latency"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt, cmd_admin_latency
+    from src.services.generation_queue import generation_queue, stage_report
+    from src.services.gemini_service import replicate_service
+    from src.services.asset_store import asset_store
+    from src.database.simple_db import db
+    await generation_queue.start(workers=workers)
+
+    conn = sqlite3.connect(db.db_path)
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM image_generations").fetchone()[0]
+    run = time.time()
+    messages = [StubMessage(7000 + i, f"Тайминги этапов {run} {i}") for i in range(users)]
+    await asyncio.gather(*(process_prompt(message, StubState()) for message in messages))
+    await generation_queue.join()
+    await db.flush()
+
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute(
+        "SELECT * FROM image_generations WHERE id > ? AND status = 'succeeded'", (last_id,)
+    ).fetchall()]
+    conn.close()
+    print(f"{users} users, {workers} workers, model latency {latency}s: {len(rows)} rows with timings")
+    print(f"{'stage':<16} {'n':>4} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9}")
+    for stage, stats in stage_report(rows).items():
+        print(f"{stage:<16} {stats['count']:>4} {stats['p50']:>9} {stats['p95']:>9} {stats['p99']:>9}")
+
+    admin = StubMessage(95714127, "/admin_latency 1")
+    replies = []
+
+    async def answer(text, **kwargs):
+        replies.append(text)
+    admin.answer = answer
+    await cmd_admin_latency(admin)
+    print(replies[0])
+
+    await generation_queue.stop()
+    await replicate_service.close()
+    await asset_store.close()
+    await runner.cleanup()
+
+async def bench_load(users: int, flow: str, workers: int, ramp: float, timeout: float, replicate_options: dict,
+                     telegram_options: dict):
+    """Полные сценарии handlers.py под нагрузкой: fake Telegram + fake Replicate, бот через long polling"""
+    from fake_replicate import start_fake_replicate
+    from fake_telegram import start_fake_telegram
+    fake, runner = await start_fake_replicate(FAKE_PORT, **replicate_options)
+    telegram, telegram_runner = await start_fake_telegram(FAKE_TELEGRAM_PORT, **telegram_options)
+
+    from bot_runner import create_bot, create_dispatcher
+    from loguru import logger
+    # bot_runner настраивает логирование при импорте - возвращаем тихий режим бенчмарка
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+    from src.services.generation_queue import generation_queue, percentile
+    from src.services.gemini_service import replicate_service
+    from src.services.asset_store import asset_store
+    from src.database.simple_db import db
+
+    run = int(time.time())
+    user_ids = [10_000 + i for i in range(users)]
+    for user_id in user_ids:
+        await db.create_user(user_id, f"user{user_id}", "Load")
+        await db.update_subscription(user_id, "1_month", 30)
+
+    bot, dp = create_bot(), create_dispatcher()
+    await generation_queue.start(workers=workers)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+
+    async def step(user_id: int, push, predicate) -> bool:
+        """Действие пользователя и ожидание ответа бота на него"""
+        after = len(telegram.sent[user_id])
+        push()
+        return await telegram.wait_for(user_id, predicate, after=after, timeout=timeout) is not None
+
+    async def scenario(index: int, user_id: int):
+        await asyncio.sleep(ramp * index / max(users - 1, 1))
+        kind = flow if flow != "mixed" else ("generate", "edit")[index % 2]
+        answered = lambda message: True
+        if kind == "generate":
+            await step(user_id, lambda: telegram.push_callback(user_id, "generate_image"), answered)
+        else:
+            await step(user_id, lambda: telegram.push_callback(user_id, "edit_image"), answered)
+            # Сначала приходит "Обрабатываю изображение", промпт ждем только после предобработки
+            await step(user_id, lambda: telegram.push_photo(user_id),
+                       lambda message: "Редактирование изображения" in (message.get("text") or ""))
+        start = time.perf_counter()
+        delivered = await step(
+            user_id, lambda: telegram.push_message(user_id, f"Нагрузочный тест {kind} {run} {index}"),
+            lambda message: "photo" in message
+        )
+        return kind, delivered, time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(scenario(i, user_id) for i, user_id in enumerate(user_ids)))
+    wall = time.perf_counter() - start
+
+    print(f"{users} users, flow {flow}, {workers} workers, wall {wall:.1f}s")
+    print(f"{'flow':<9} {'users':>6} {'delivered':>10} {'p50, s':>8} {'p95, s':>8} {'max, s':>8}")
+    for kind in sorted({kind for kind, _, _ in results}):
+        durations = [duration for k, ok, duration in results if k == kind and ok]
+        total = sum(1 for k, _, _ in results if k == kind)
+        print(f"{kind:<9} {total:>6} {len(durations):>10} {percentile(durations, 50):>8.2f} "
+              f"{percentile(durations, 95):>8.2f} {max(durations, default=0):>8.2f}")
+    print(f"replicate: {fake.get_stats()}")
+    print(f"telegram: {telegram.get_stats()}")
+    print(f"queue: {generation_queue.get_stats()}")
+
+    await dp.stop_polling()
+    await polling
+    await generation_queue.stop()
+    await bot.session.close()
+    await replicate_service.close()
+    await asset_store.close()
+    await telegram_runner.cleanup()
+    await runner.cleanup()
+
+class LegacyDatabase:
+    """Как было до SQLiteEngine: новое соединение на каждый запрос прямо в event loop"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    async def get_user(self, telegram_id: int):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+        conn.close()
+        return row
+
+    async def check_subscription(self, telegram_id: int):
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute('SELECT subscription_active, subscription_expires_at FROM users '
+                           'WHERE telegram_id = ? AND subscription_active = TRUE', (telegram_id,)).fetchone()
+        conn.close()
+        return row
+
+    async def log_image_generation(self, telegram_id: int, prompt: str, success: bool, image_url: str = None):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('INSERT INTO image_generations (user_id, prompt, image_url, status) VALUES (?, ?, ?, ?)',
+                     (telegram_id, prompt, image_url, 'succeeded' if success else 'failed'))
+        conn.commit()
+        conn.close()
+
+async def bench_db(levels: list[int], ops: int, users: int):
+    """Операций в секунду и задержка event loop: соединение на запрос против SQLiteEngine"""
+    import tempfile
+    from loguru import logger
+    from src.database.simple_db import SimpleDatabase
+    # SimpleDatabase логирует каждый запрос - в замере это был бы вывод, а не база
+    logger.remove()
+
+    directory = tempfile.mkdtemp(prefix="bench-db-")
+    engine_db = SimpleDatabase(os.path.join(directory, "bench.db"))
+    engine_db.log_buffer = None  # здесь сравниваем сами запросы, буфер журнала - в бенчмарке logging
+    for user_id in range(users):
+        await engine_db.create_user(user_id, f"user{user_id}", "Bench")
+        await engine_db.update_subscription(user_id, "1_month", 30)
+    legacy_db = LegacyDatabase(engine_db.db_path)
+
+    operations = {
+        "get_user": lambda db, i: db.get_user(i % users),
+        "check_subscription": lambda db, i: db.check_subscription(i % users),
+        "log_image_generation": lambda db, i: db.log_image_generation(i % users, f"Бенчмарк {i}", True, "asset:x")
+    }
+
+    async def run(database, operation, n: int) -> tuple[float, float]:
+        """ops/s и максимальная задержка event loop (насколько опаздывает sleep(0.001))"""
+        lag = 0.0
+        done = False
+
+        async def probe():
+            nonlocal lag
+            while not done:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lag = max(lag, time.perf_counter() - start - 0.001)
+
+        async def worker(offset: int):
+            for i in range(offset, ops, n):
+                await operation(database, i)
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(offset) for offset in range(n)))
+        elapsed = time.perf_counter() - start
+        done = True
+        await probe_task
+        return ops / elapsed, lag
+
+    print(f"{ops} ops per run, {users} users")
+    print(f"{'operation':<22} {'N':>4} {'legacy ops/s':>13} {'engine ops/s':>13} {'legacy lag, ms':>15} {'engine lag, ms':>15}")
+    for name, operation in operations.items():
+        for n in levels:
+            legacy_rate, legacy_lag = await run(legacy_db, operation, n)
+            engine_rate, engine_lag = await run(engine_db, operation, n)
+            print(f"{name:<22} {n:>4} {legacy_rate:>13.0f} {engine_rate:>13.0f} "
+                  f"{legacy_lag * 1000:>15.1f} {engine_lag * 1000:>15.1f}")
+
+    await engine_db.close()
+
+async def bench_queryplan(users: int, generations: int):
+    """
+    EXPLAIN QUERY PLAN для каждого запроса SimpleDatabase на большой базе.
+
+    Запросы не дублируются здесь: вызываем каждый публичный метод, собираем
+    выполненный SQL через trace движка и проверяем его план. Полный проход по
+    таблице (SCAN) на горячем пути - регрессия, скрипт завершается с ошибкой.
+    """
+    import inspect
+    import random
+    import tempfile
+    from datetime import datetime, timedelta
+    from loguru import logger
+    from src.database.simple_db import SimpleDatabase
+    logger.remove()
+
+    directory = tempfile.mkdtemp(prefix="bench-queryplan-")
+    database = SimpleDatabase(os.path.join(directory, "queryplan.db"))
+
+    # Заполняем базу напрямую, пакетами
+    start = time.perf_counter()
+    conn = database.engine.connect()
+    expires = datetime.now() + timedelta(days=30)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO users (telegram_id, username, first_name, subscription_active, subscription_plan, "
+        "subscription_expires_at) VALUES (?, ?, ?, ?, '1_month', ?)",
+        ((i, f"user{i}", "Seed", i % 3 == 0, expires) for i in range(users))
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (user_id, plan_name, price, duration_days, is_active, expires_at, payment_id) "
+        "VALUES (?, '1_month', 999, 30, ?, ?, ?)",
+        ((i % users, i >= users, expires, f"pay-{i}") for i in range(users * 2))
+    )
+    conn.executemany(
+        "INSERT INTO payments (user_id, payment_id, amount, status, plan_type) VALUES (?, ?, 999, ?, '1_month')",
+        ((i, f"pay-{i}", "succeeded") for i in range(users))
+    )
+    rng = random.Random(0)
+    conn.executemany(
+        "INSERT INTO image_generations (user_id, prompt, status, generation_type, processing_time_ms, created_at) "
+        "VALUES (?, 'seed', ?, 'text_to_image', 1000, datetime('now', ?))",
+        ((rng.randrange(users), rng.choice(("succeeded", "failed", "cancelled")), f"-{rng.randrange(24 * 30)} hours")
+         for _ in range(generations))
+    )
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"seeded {users} users, {generations} generations in {time.perf_counter() - start:.1f}s")
+
+    # Каждый публичный метод с типичными аргументами. Новый метод без записи здесь - тоже ошибка.
+    user_id = users // 2
+
+    async def log_and_flush():
+        """Журнал пишется отложенно - сбрасываем буфер, чтобы INSERT попал в trace"""
+        await database.log_image_generation(user_id, "plan", True, "asset:x")
+        await database.flush()
+
+    async def watch_changes():
+        """Запросы наблюдателя change_events: запуск и одно доставленное событие"""
+        delivered = asyncio.Event()
+
+        async def on_change(change):
+            delivered.set()
+        await database.start_change_listener(on_change)
+        await database.deactivate_subscription(user_id + 2)
+        await asyncio.wait_for(delivered.wait(), 5)
+        await database.stop_change_listener()
+
+    calls = {
+        "add_user": lambda: database.add_user(user_id, "user", "Seed"),
+        "create_user": lambda: database.create_user(user_id + 1, "user", "Seed"),
+        "get_user": lambda: database.get_user(user_id),
+        "check_subscription": lambda: database.check_subscription(user_id),
+        "create_subscription": lambda: database.create_subscription(user_id, "1_month", 999, 30, "pay-plan"),
+        "update_subscription": lambda: database.update_subscription(user_id, "1_month", 30),
+        "deactivate_subscription": lambda: database.deactivate_subscription(user_id + 1),
+        "get_subscription_info": lambda: database.get_subscription_info(user_id),
+        "get_active_plan": lambda: database.get_active_plan(user_id),
+        "get_output_profile": lambda: database.get_output_profile(user_id),
+        "set_output_profile": lambda: database.set_output_profile(user_id, "standard"),
+        "add_image_generation": lambda: database.add_image_generation(user_id, "plan"),
+        "add_payment": lambda: database.add_payment(user_id, "pay-plan", 999, "succeeded", "1_month"),
+        "get_user_stats": lambda: database.get_user_stats(user_id),
+        "log_image_generation": lambda: log_and_flush(),
+        "get_generation_timings": lambda: database.get_generation_timings(24),
+        "flush": lambda: database.flush(),
+        "start_change_listener": lambda: watch_changes(),
+        "stop_change_listener": lambda: database.stop_change_listener(),
+    }
+    # close закрывает движок - его запросы проверять не нужно
+    methods = {name for name, member in inspect.getmembers(SimpleDatabase, inspect.iscoroutinefunction)
+               if not name.startswith("_") and name != "close"}
+    missing = sorted(methods - set(calls))
+    if missing:
+        sys.exit(f"no query plan check for: {', '.join(missing)}")
+
+    checker = sqlite3.connect(database.db_path)
+    failures = []
+    print(f"{'method':<24} plan")
+    for name, call in calls.items():
+        statements = []
+        database.engine.close()  # новые соединения подхватят trace
+        database.engine.trace = statements.append
+        await call()
+        database.engine.trace = None
+        for statement in statements:
+            if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+                continue  # BEGIN/COMMIT и PRAGMA
+            plan = [row[3] for row in checker.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()]
+            scans = [step for step in plan if step.startswith("SCAN")]
+            if scans:
+                failures.append((name, statement, scans))
+            if plan:
+                print(f"{name:<24} {'; '.join(plan)}")
+    checker.close()
+    await database.close()
+
+    if failures:
+        for name, statement, scans in failures:
+            print(f"REGRESSION {name}: {'; '.join(scans)}\n    {' '.join(statement.split())}")
+        sys.exit(f"{len(failures)} queries scan a whole table")
+    print("all hot-path queries use indexes")
+
+async def bench_logging(jobs: int, workers: int, latency: float, contention: int):
+    """Пропускная способность и хвосты задержки генерации: журнал напрямую против буфера отложенной записи"""
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency)
+
+    from src.bot.handlers import process_prompt
+    from src.services.generation_queue import generation_queue, percentile
+    from src.services.gemini_service import replicate_service
+    from src.services.asset_store import asset_store
+    from src.database.simple_db import db
+    from src.database.write_behind import WriteBehindBuffer
+    buffer = db.log_buffer or WriteBehindBuffer(db._write_log_rows)
+    await generation_queue.start(workers=workers)
+
+    # Журнал - последний шаг обработчика: его возврат и есть конец задачи для воркера
+    log_image_generation = db.log_image_generation
+    log_times, finished = [], {}
+
+    async def timed_log(telegram_id, *args, **kwargs):
+        start = time.perf_counter()
+        await log_image_generation(telegram_id, *args, **kwargs)
+        finished[telegram_id] = time.perf_counter()
+        log_times.append(finished[telegram_id] - start)
+    db.log_image_generation = timed_log
+
+    async def writer(stop: asyncio.Event, user_id: int):
+        """Посторонние записи в ту же базу (подписки, профили): очередь писателя не пустая"""
+        while not stop.is_set():
+            await db.set_output_profile(user_id, None)
+
+    run = int(time.time())
+    print(f"{jobs} jobs, {workers} workers, model latency {latency}s, {contention} concurrent writers")
+    print(f"{'mode':<13} {'jobs/s':>8} {'log p50, ms':>12} {'log p99, ms':>12} "
+          f"{'job p50, ms':>12} {'job p95, ms':>12} {'job p99, ms':>12} {'rows':>6}")
+    for mode in ("direct", "write-behind"):
+        db.log_buffer = buffer if mode == "write-behind" else None
+        log_times.clear()
+        finished.clear()
+        stop = asyncio.Event()
+        writers = [asyncio.create_task(writer(stop, 40_000 + i)) for i in range(contention)]
+        messages = [StubMessage(30_000 + i, f"Журнал {mode} {run} {i}") for i in range(jobs)]
+        submitted = {}
+        start = time.perf_counter()
+        for message in messages:
+            submitted[message.from_user.id] = time.perf_counter()
+            await process_prompt(message, StubState())
+        await generation_queue.join()
+        wall = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*writers)
+        await db.flush()
+
+        job_times = [finished[user_id] - submitted[user_id] for user_id in finished]
+        rows = await db.engine.fetchone(
+            "SELECT COUNT(*) FROM image_generations WHERE prompt LIKE ?", (f"Журнал {mode} {run} %",)
+        )
+        print(f"{mode:<13} {jobs / wall:>8.1f} {percentile(log_times, 50) * 1000:>12.2f} "
+              f"{percentile(log_times, 99) * 1000:>12.2f} {percentile(job_times, 50) * 1000:>12.0f} "
+              f"{percentile(job_times, 95) * 1000:>12.0f} {percentile(job_times, 99) * 1000:>12.0f} {rows[0]:>6}")
+    print(f"buffer: {buffer.get_stats()}")
+
+    db.log_image_generation = log_image_generation
+    await generation_queue.stop()
+    await replicate_service.close()
+    await asset_store.close()
+    await runner.cleanup()
+    await db.close()
+
+async def bench_subscriptions(users: int, clicks: int, payments: int, ttl: float):
+    """Кэш статуса подписки: доля попаданий, время проверки и устаревание после оплаты в другом процессе"""
+    import random
+    from src.services.generation_queue import percentile
+    from src.database.simple_db import db, SimpleDatabase
+    # Процесс app.py: та же база, свой кэш и свое соединение-писатель
+    api_db = SimpleDatabase(db.db_path)
+
+    user_ids = [50_000 + i for i in range(users)]
+    for user_id in user_ids:
+        await db.create_user(user_id, f"user{user_id}", "Bench")
+        await db.deactivate_subscription(user_id)
+    for user_id in user_ids[::2]:
+        await db.update_subscription(user_id, "1_month", 30)
+
+    # 1. Нажатия «Генерация»: случайные пользователи, с кэшем и без
+    rng = random.Random(0)
+    sequence = [rng.choice(user_ids) for _ in range(clicks)]
+    print(f"{clicks} subscription checks over {users} users")
+    print(f"{'mode':<8} {'hit ratio':>10} {'p50, ms':>9} {'p99, ms':>9}")
+    for mode, mode_ttl in (("no cache", 0), ("cache", ttl)):
+        db.subscriptions.ttl = mode_ttl
+        db.subscriptions.invalidate()
+        db.subscriptions.hits = db.subscriptions.misses = 0
+        timings = []
+        for user_id in sequence:
+            start = time.perf_counter()
+            await db.check_subscription(user_id)
+            timings.append(time.perf_counter() - start)
+        print(f"{mode:<8} {db.subscriptions.get_stats()['hit_ratio']:>10.1%} "
+              f"{percentile(timings, 50) * 1000:>9.3f} {percentile(timings, 99) * 1000:>9.3f}")
+
+    # 2. Оплата в app.py: сколько бот еще видит старый статус (отказ в генерации)
+    #    и через сколько получает событие, по которому пишет «подписка активирована»
+    received = {}
+
+    async def on_change(change):
+        received[change["telegram_id"]] = time.perf_counter()
+
+    async def stale_for(user_id: int) -> tuple[float, float]:
+        assert not await db.check_subscription(user_id)  # отказ закэширован
+        paid = time.perf_counter()
+        await api_db.update_subscription(user_id, "1_month", 30, f"pay-bench-{user_id}")
+        while not await db.check_subscription(user_id):
+            await asyncio.sleep(0.001)
+        return time.perf_counter() - paid, paid
+
+    unpaid = user_ids[1::2]
+    print(f"{payments} payments in the API process, cache TTL {ttl}s")
+    print(f"{'mode':<12} {'stale p50, ms':>14} {'stale max, ms':>14} {'event p50, ms':>14} {'event max, ms':>14}")
+    for mode in ("change feed", "ttl only"):
+        if mode == "change feed":
+            await db.start_change_listener(on_change)
+        else:
+            await db.stop_change_listener()
+        stale, events = [], []
+        for _ in range(payments):
+            user_id = unpaid.pop()
+            duration, paid = await stale_for(user_id)
+            stale.append(duration)
+            await asyncio.sleep(0.05)
+            if user_id in received:
+                events.append(received[user_id] - paid)
+        event_columns = (f"{percentile(events, 50) * 1000:>14.1f} {max(events) * 1000:>14.1f}" if events
+                         else f"{'-':>14} {'-':>14}")
+        print(f"{mode:<12} {percentile(stale, 50) * 1000:>14.1f} {max(stale) * 1000:>14.1f} {event_columns}")
+    print(f"bot cache: {db.subscriptions.get_stats()}")
+
+    await api_db.close()
+    await db.close()
+
+def _make_photo() -> bytes:
+    """Тяжелое фото с телефона: 4000x3000 JPEG с шумом и EXIF-поворотом"""
+    import io
+    from PIL import Image
+    image = Image.merge("RGB", [Image.effect_noise((4000, 3000), 16) for _ in range(3)])
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: повернуть на 90°
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95, exif=exif)
+    return buffer.getvalue()
+
+async def bench_preprocess(n: int, latency: float, bandwidth_mb: float):
+    """Редактирование: сырое фото против предобработанного (байты и время до результата)"""
+    import base64
+    from fake_replicate import start_fake_replicate
+    fake, runner = await start_fake_replicate(FAKE_PORT, latency=latency, input_bandwidth=bandwidth_mb * 1024 * 1024)
+
+    from src.services.gemini_service import replicate_service
+    from src.services.image_preprocessing import image_preprocessor
+    from src.services.asset_store import asset_store
+    replicate_service.webhook_url = None
+
+    raw = _make_photo()
+    print(f"raw photo: {len(raw) / 1024 / 1024:.1f} MB, model input bandwidth {bandwidth_mb} MB/s")
+    print(f"{'mode':>12} {'input, KB':>10} {'median, s':>10}")
+
+    for mode in ("raw", "preprocessed"):
+        fake.input_bytes = 0
+        timings = []
+        for i in range(n):
+            start = time.perf_counter()
+            if mode == "raw":
+                # Как раньше: модель скачивает исходный файл из Telegram
+                image_url = f"data:image/jpeg;base64,{base64.b64encode(raw).decode()}"
+            else:
+                processed = await image_preprocessor.process(raw)
+                asset = await asset_store.put(processed.data, None, processed.extension)
+                image_url = await asset_store.input_url(asset.ref)
+            await replicate_service.edit_image(f"Бенчмарк редактирования {mode} {i}", image_url)
+            timings.append(time.perf_counter() - start)
+        median = sorted(timings)[len(timings) // 2]
+        print(f"{mode:>12} {fake.input_bytes / n / 1024:>10.0f} {median:>10.2f}")
+
+    stats = image_preprocessor.get_stats()
+    print(f"preprocessing: avg {stats['avg_time']:.2f}s, saved {stats['bytes_saved'] / stats['processed'] / 1024:.0f} KB per photo")
+    image_preprocessor.close()
+    await runner.cleanup()
+
+async def _timed(coro) -> float:
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    generation = sub.add_parser("generation", help="Параллельные генерации через process_prompt")
+    generation.add_argument("--concurrency", default="1,10,50")
+    generation.add_argument("--latency", type=float, default=2.0)
+
+    coalescing = sub.add_parser("coalescing", help="Одинаковые одновременные промпты -> одно предсказание")
+    coalescing.add_argument("--requests", type=int, default=20)
+    coalescing.add_argument("--latency", type=float, default=1.0)
+
+    webhook = sub.add_parser("webhook", help="Опрос статуса против webhook")
+    webhook.add_argument("--requests", type=int, default=3)
+    webhook.add_argument("--latency", type=float, default=3.0)
+
+    polling = sub.add_parser("polling", help="Фиксированный опрос против адаптивного (REST-сервис)")
+    polling.add_argument("--requests", type=int, default=5)
+    polling.add_argument("--latency", type=float, default=8.0)
+
+    delivery = sub.add_parser("delivery", help="Буферизованная против потоковой доставки результата")
+    delivery.add_argument("--image-size", type=int, default=2048)
+    delivery.add_argument("--requests", type=int, default=3)
+
+    preprocess = sub.add_parser("preprocess", help="Редактирование сырого фото против предобработанного")
+    preprocess.add_argument("--requests", type=int, default=3)
+    preprocess.add_argument("--latency", type=float, default=2.0)
+    preprocess.add_argument("--bandwidth", type=float, default=2.0, help="МБ/с, с которой модель качает вход")
+
+    formats = sub.add_parser("formats", help="Байты и время доставки по профилям кодирования")
+    formats.add_argument("--image-size", type=int, default=1536)
+    formats.add_argument("--bandwidth", type=float, default=2.0, help="МБ/с загрузки в Telegram")
+
+    variations = sub.add_parser("variations", help="Время задачи вариантов в зависимости от N")
+    variations.add_argument("--count", default="1,2,4,8")
+    variations.add_argument("--latency", type=float, default=2.0)
+
+    progress = sub.add_parser("progress", help="Повторные отправки с прогрессом в сообщении ожидания и без")
+    progress.add_argument("--users", type=int, default=16)
+    progress.add_argument("--workers", type=int, default=4)
+    progress.add_argument("--latency", type=float, default=3.0)
+    progress.add_argument("--patience", type=float, default=4.0, help="Сколько секунд пользователь ждет без изменений")
+
+    cancel = sub.add_parser("cancel", help="Отмена генерации: освобождение воркера и отмена в Replicate")
+    cancel.add_argument("--latency", type=float, default=6.0)
+    cancel.add_argument("--after", type=float, default=1.0, help="Через сколько секунд отменять")
+
+    resilience = sub.add_parser("resilience", help="Hedging, дедлайны и circuit breaker при деградации провайдера")
+    resilience.add_argument("--latency", type=float, default=1.0, help="Задержка здорового провайдера, сек")
+    resilience.add_argument("--slow", type=float, default=6.0, help="Задержка деградировавшей основной модели")
+    resilience.add_argument("--deadline", type=float, default=3.0)
+
+    router = sub.add_parser("router", help="Выбор модели роутером по политикам и тарифам")
+    router.add_argument("--requests", type=int, default=12)
+
+    telemetry = sub.add_parser("telemetry", help="Время этапов генерации (очередь, Replicate, доставка)")
+    telemetry.add_argument("--users", type=int, default=12)
+    telemetry.add_argument("--workers", type=int, default=4)
+    telemetry.add_argument("--latency", type=float, default=1.5)
+
+    database = sub.add_parser("db", help="Операций в секунду SimpleDatabase: соединение на запрос против SQLiteEngine")
+    database.add_argument("--concurrency", default="1,10,100")
+    database.add_argument("--ops", type=int, default=2000, help="Операций в каждом замере")
+    database.add_argument("--users", type=int, default=1000)
+
+    queryplan = sub.add_parser("queryplan", help="Проверка планов запросов SimpleDatabase на большой базе")
+    queryplan.add_argument("--users", type=int, default=20000)
+    queryplan.add_argument("--generations", type=int, default=300000)
+
+    logging = sub.add_parser("logging", help="Генерации с журналом напрямую и через буфер отложенной записи")
+    logging.add_argument("--jobs", type=int, default=400)
+    logging.add_argument("--workers", type=int, default=16)
+    logging.add_argument("--latency", type=float, default=0.2)
+    logging.add_argument("--contention", type=int, default=4, help="Параллельных посторонних писателей в базу")
+
+    subscriptions = sub.add_parser("subscriptions", help="Кэш статуса подписки: попадания и устаревание после оплаты")
+    subscriptions.add_argument("--users", type=int, default=1000)
+    subscriptions.add_argument("--clicks", type=int, default=20000, help="Проверок подписки")
+    subscriptions.add_argument("--payments", type=int, default=5, help="Оплат в каждом режиме")
+    subscriptions.add_argument("--ttl", type=float, default=2.0, help="TTL кэша на время замера, сек")
+
+    load = sub.add_parser("load", help="Полные сценарии бота под нагрузкой через fake Telegram и fake Replicate")
+    load.add_argument("--users", type=int, default=50)
+    load.add_argument("--flow", choices=("generate", "edit", "mixed"), default="mixed")
+    load.add_argument("--workers", type=int, default=8)
+    load.add_argument("--ramp", type=float, default=5.0, help="За сколько секунд приходят все пользователи")
+    load.add_argument("--timeout", type=float, default=120.0, help="Сколько пользователь ждет ответа, сек")
+    load.add_argument("--latency", type=float, default=3.0, help="Средняя задержка модели, сек")
+    load.add_argument("--distribution", default="lognormal", help="fixed, uniform, lognormal, exponential")
+    load.add_argument("--spread", type=float, default=0.5)
+    load.add_argument("--failure-rate", type=float, default=0.0, help="Доля неудачных предсказаний")
+    load.add_argument("--error-rate", type=float, default=0.0, help="Доля 500 на создание предсказания")
+    load.add_argument("--rate-limit", type=float, default=None, help="Предсказаний в секунду, сверх - 429")
+    load.add_argument("--tg-latency", type=float, default=0.05, help="Средняя задержка Bot API, сек")
+    load.add_argument("--tg-error-rate", type=float, default=0.0, help="Доля 500 от Bot API")
+    load.add_argument("--chat-rate-limit", type=float, default=None, help="Сообщений в секунду в чат, сверх - 429")
+    load.add_argument("--upload-bandwidth", type=float, default=None, help="МБ/с загрузки в Telegram")
+
+    args = parser.parse_args()
+
+    # Направляем сервисы на локальный fake-сервер до импорта config
+    os.environ["REPLICATE_BASE_URL"] = f"http://127.0.0.1:{FAKE_PORT}"
+    os.environ.setdefault("REPLICATE_API_KEY", "fake")
+    os.environ.setdefault("REPLICATE_POLL_INTERVAL", "0.5")
+
+    if args.command == "variations":
+        # Все N предсказаний одновременно, чтобы увидеть масштабирование
+        os.environ["VARIATIONS_CONCURRENCY"] = str(max(int(count) for count in args.count.split(",")))
+
+    if args.command == "resilience":
+        # Быстрые пороги, чтобы пройти все состояния breaker'а за секунды
+        os.environ["REPLICATE_FALLBACK_MODEL"] = "flux-schnell"
+        os.environ["REPLICATE_DEADLINE"] = str(args.deadline)
+        os.environ["REPLICATE_HEDGE_MIN_SAMPLES"] = "10"
+        os.environ["REPLICATE_HEDGE_MIN_DELAY"] = str(args.latency / 2)
+        os.environ["BREAKER_WINDOW"] = "10"
+        os.environ["BREAKER_RESET_TIMEOUT"] = "2"
+        # Только основная и запасная модели, иначе роутер уйдет на третью
+        os.environ["ROUTER_MODELS"] = "nano-banana,flux-schnell"
+    if args.command == "router":
+        os.environ["ROUTER_EXPLORE"] = "0.5"
+    if args.command == "webhook":
+        # app.py проверяет подпись webhook'ов fake-сервера этим секретом
+        os.environ["REPLICATE_WEBHOOK_SECRET"] = "whsec_" + base64.b64encode(b"benchmark-webhook-secret").decode()
+        os.environ.setdefault("YOOKASSA_SHOP_ID", "1")
+        for name in ("BOT_TOKEN", "YOOKASSA_SECRET_KEY", "DATABASE_URL"):
+            os.environ.setdefault(name, "fake")
+    if args.command == "load":
+        os.environ["TELEGRAM_API_BASE_URL"] = f"http://127.0.0.1:{FAKE_TELEGRAM_PORT}"
+        os.environ["BOT_TOKEN"] = "123456:fake-load-test"
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    if args.command == "generation":
+        levels = [int(level) for level in args.concurrency.split(",")]
+        asyncio.run(bench_generation(levels, args.latency))
+    elif args.command == "coalescing":
+        asyncio.run(bench_coalescing(args.requests, args.latency))
+    elif args.command == "webhook":
+        asyncio.run(bench_webhook(args.requests, args.latency))
+    elif args.command == "polling":
+        asyncio.run(bench_polling(args.requests, args.latency))
+    elif args.command == "delivery":
+        asyncio.run(bench_delivery(args.image_size, args.requests))
+    elif args.command == "preprocess":
+        asyncio.run(bench_preprocess(args.requests, args.latency, args.bandwidth))
+    elif args.command == "formats":
+        asyncio.run(bench_formats(args.image_size, args.bandwidth))
+    elif args.command == "variations":
+        counts = [int(count) for count in args.count.split(",")]
+        asyncio.run(bench_variations(counts, args.latency))
+    elif args.command == "progress":
+        asyncio.run(bench_progress(args.users, args.workers, args.latency, args.patience))
+    elif args.command == "cancel":
+        asyncio.run(bench_cancel(args.latency, args.after))
+    elif args.command == "resilience":
+        asyncio.run(bench_resilience(args.latency, args.slow, args.deadline))
+    elif args.command == "router":
+        asyncio.run(bench_router(args.requests))
+    elif args.command == "telemetry":
+        asyncio.run(bench_telemetry(args.users, args.workers, args.latency))
+    elif args.command == "db":
+        levels = [int(level) for level in args.concurrency.split(",")]
+        asyncio.run(bench_db(levels, args.ops, args.users))
+    elif args.command == "queryplan":
+        asyncio.run(bench_queryplan(args.users, args.generations))
+    elif args.command == "logging":
+        asyncio.run(bench_logging(args.jobs, args.workers, args.latency, args.contention))
+    elif args.command == "subscriptions":
+        asyncio.run(bench_subscriptions(args.users, args.clicks, args.payments, args.ttl))
+    elif args.command == "load":
+        asyncio.run(bench_load(
+            args.users, args.flow, args.workers, args.ramp, args.timeout,
+            replicate_options=dict(latency=args.latency, distribution=args.distribution, spread=args.spread,
+                                   failure_rate=args.failure_rate, error_rate=args.error_rate,
+                                   rate_limit=args.rate_limit),
+            telegram_options=dict(latency=args.tg_latency, distribution=args.distribution, spread=args.spread,
+                                  error_rate=args.tg_error_rate, chat_rate_limit=args.chat_rate_limit,
+                                  upload_bandwidth=args.upload_bandwidth * 1024 * 1024 if args.upload_bandwidth else None)
+        ))
+
+if __name__ == "__main__":
+    main()
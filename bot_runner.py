@@ -1,15 +1,25 @@
 import asyncio
 import sys
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from loguru import logger
 import os
 
-from config import BOT_TOKEN, validate_config
-from src.bot.handlers import router
+from config import (
+    BOT_TOKEN, TELEGRAM_API_BASE_URL, GENERATION_WORKERS, BOT_INTERNAL_HOST, BOT_INTERNAL_PORT, validate_config
+)
+from src.bot.handlers import router, on_database_change
 from src.bot.middleware import LoggingMiddleware, RateLimitMiddleware
+from src.bot.internal_server import start_internal_server
 from src.database.simple_db import db
 from src.services.yookassa_service import init_yookassa_service, yookassa_service
+from src.services.gemini_service import replicate_service
+from src.services.replicate_service import replicate_service as replicate_rest_service
+from src.services.generation_queue import generation_queue
+from src.services.asset_store import asset_store
+from src.services.image_preprocessing import image_preprocessor
 
 # Настройка логирования
 logger.remove()
@@ -26,6 +36,27 @@ logger.add(
     retention="7 days"
 )
 
+def create_bot() -> Bot:
+    """Бот с сессией на api.telegram.org или на TELEGRAM_API_BASE_URL (fake_telegram.py)"""
+    session = None
+    if TELEGRAM_API_BASE_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE_URL))
+    return Bot(token=BOT_TOKEN, session=session, parse_mode=ParseMode.HTML)
+
+def create_dispatcher() -> Dispatcher:
+    """Диспетчер с middleware и роутером обработчиков"""
+    dp = Dispatcher()
+    
+    # Регистрируем middleware
+    dp.message.middleware(LoggingMiddleware())
+    dp.callback_query.middleware(LoggingMiddleware())
+    dp.message.middleware(RateLimitMiddleware(rate_limit=20, time_window=60))
+    dp.callback_query.middleware(RateLimitMiddleware(rate_limit=30, time_window=60))
+    
+    # Регистрируем роутеры
+    dp.include_router(router)
+    return dp
+
 async def main():
     """Основная функция запуска бота"""
     
@@ -55,17 +86,17 @@ async def main():
         return
     
     # Инициализация бота и диспетчера
-    bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
-    dp = Dispatcher()
+    bot = create_bot()
+    dp = create_dispatcher()
     
-    # Регистрируем middleware
-    dp.message.middleware(LoggingMiddleware())
-    dp.callback_query.middleware(LoggingMiddleware())
-    dp.message.middleware(RateLimitMiddleware(rate_limit=20, time_window=60))
-    dp.callback_query.middleware(RateLimitMiddleware(rate_limit=30, time_window=60))
+    # Запускаем пул воркеров генерации
+    await generation_queue.start(workers=GENERATION_WORKERS)
     
-    # Регистрируем роутеры
-    dp.include_router(router)
+    # Внутренний сервер для событий из app.py (webhook'и Replicate)
+    internal_server = await start_internal_server(BOT_INTERNAL_HOST, BOT_INTERNAL_PORT)
+    
+    # Изменения из app.py (оплата подписки): сброс кэша и уведомление пользователя
+    await db.start_change_listener(lambda change: on_database_change(bot, change))
     
     # Уведомляем о запуске
     logger.info("Starting Gemini Image Editor Bot...")
@@ -76,8 +107,15 @@ async def main():
     except Exception as e:
         logger.error(f"Bot error: {e}")
     finally:
+        await internal_server.cleanup()
+        await generation_queue.stop()
         await bot.session.close()
-        # Простая база данных не требует закрытия пула
+        await replicate_service.close()
+        await replicate_rest_service.close()
+        await asset_store.close()
+        image_preprocessor.close()
+        # Дописываем буфер журнала и очередь записей, закрываем соединения SQLite
+        await db.close()
         logger.info("Bot stopped")
 
 if __name__ == "__main__":
@@ -5,12 +5,97 @@ load_dotenv()
 
 # Telegram Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Базовый URL Bot API (можно направить на локальный fake_telegram.py для нагрузочных тестов)
+TELEGRAM_API_BASE_URL = (os.getenv("TELEGRAM_API_BASE_URL") or "").rstrip("/") or None
 
 # Database (PostgreSQL)
 DATABASE_URL = os.getenv("DATABASE_URL")
+# SQLite (SimpleDatabase): файл, число соединений-читателей и ожидание блокировки другого процесса (мс)
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "bot_subscriptions.db")
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", "4"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Отложенная запись журнала генераций (платежи пишутся сразу): сброс пачкой по размеру или по времени (сек),
+# сверх LOG_BUFFER_MAX_PENDING строк (если база недоступна) самые старые отбрасываются
+LOG_WRITE_BEHIND = os.getenv("LOG_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+LOG_BUFFER_MAX_ROWS = int(os.getenv("LOG_BUFFER_MAX_ROWS", "200"))
+LOG_BUFFER_FLUSH_INTERVAL = float(os.getenv("LOG_BUFFER_FLUSH_INTERVAL", "1.0"))
+LOG_BUFFER_MAX_PENDING = int(os.getenv("LOG_BUFFER_MAX_PENDING", "10000"))
+# Кэш статуса подписки в памяти процесса: предельный возраст записи (сек, 0 - выключен) и размер
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "600"))
+SUBSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv("SUBSCRIPTION_CACHE_MAX_ENTRIES", "100000"))
+# События изменений между процессами (SQLite): период опроса data_version (сек) и срок хранения событий (сек)
+CHANGE_FEED_POLL_INTERVAL = float(os.getenv("CHANGE_FEED_POLL_INTERVAL", "0.005"))
+CHANGE_EVENTS_RETENTION = float(os.getenv("CHANGE_EVENTS_RETENTION", "3600"))
 
 # Replicate API (для генерации изображений)
 REPLICATE_API_KEY = os.getenv("REPLICATE_API_KEY")
+# Базовый URL API (можно направить на локальный fake_replicate.py для тестов)
+REPLICATE_BASE_URL = os.getenv("REPLICATE_BASE_URL") or None
+# Публичный URL /replicate-webhook (app.py); если не задан - ждем результат опросом статуса
+REPLICATE_WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL")
+REPLICATE_WEBHOOK_SECRET = os.getenv("REPLICATE_WEBHOOK_SECRET")
+# Интервал запасного опроса на случай потерянного webhook (сек)
+REPLICATE_WEBHOOK_FALLBACK_POLL = float(os.getenv("REPLICATE_WEBHOOK_FALLBACK_POLL", "15"))
+# Границы адаптивного опроса статуса предсказания в REST-сервисе (сек)
+REPLICATE_POLL_MIN = float(os.getenv("REPLICATE_POLL_MIN", "0.5"))
+REPLICATE_POLL_MAX = float(os.getenv("REPLICATE_POLL_MAX", "5"))
+# Размер общего пула HTTP-соединений к Replicate
+REPLICATE_MAX_CONNECTIONS = int(os.getenv("REPLICATE_MAX_CONNECTIONS", "100"))
+REPLICATE_MAX_KEEPALIVE = int(os.getenv("REPLICATE_MAX_KEEPALIVE", "20"))
+# Предельное время одного предсказания, включая ожидание результата (сек)
+REPLICATE_DEADLINE = float(os.getenv("REPLICATE_DEADLINE", "120"))
+# Запасная модель для hedged-запросов генерации (ключ MODEL_CATALOG); пусто - без hedging
+REPLICATE_FALLBACK_MODEL = os.getenv("REPLICATE_FALLBACK_MODEL") or None
+# Hedged-запрос уходит через p95 задержки основной модели, но не раньше HEDGE_MIN_DELAY (сек)
+# и только когда накоплено HEDGE_MIN_SAMPLES замеров
+REPLICATE_HEDGE_MIN_DELAY = float(os.getenv("REPLICATE_HEDGE_MIN_DELAY", "10"))
+REPLICATE_HEDGE_MIN_SAMPLES = int(os.getenv("REPLICATE_HEDGE_MIN_SAMPLES", "20"))
+# Circuit breaker: открывается, когда доля ошибок среди последних WINDOW вызовов (не меньше
+# MIN_CALLS) достигает FAILURE_RATIO; через RESET_TIMEOUT сек пропускает пробный запрос
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATIO = float(os.getenv("BREAKER_FAILURE_RATIO", "0.5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# Внутренний HTTP-сервер процесса бота (принимает события от app.py)
+BOT_INTERNAL_HOST = os.getenv("BOT_INTERNAL_HOST", "127.0.0.1")
+BOT_INTERNAL_PORT = int(os.getenv("BOT_INTERNAL_PORT", "8081"))
+
+# Очередь генераций
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "8"))
+GENERATION_QUEUE_MAX = int(os.getenv("GENERATION_QUEUE_MAX", "500"))
+GENERATION_MAX_PENDING_PER_USER = int(os.getenv("GENERATION_MAX_PENDING_PER_USER", "5"))
+GENERATION_MAX_IN_FLIGHT_PER_USER = int(os.getenv("GENERATION_MAX_IN_FLIGHT_PER_USER", "2"))
+# Вес полосы для подписок, активированных админом, и лимит ожидания до обслуживания вне очереди (сек)
+ADMIN_PRIORITY_WEIGHT = int(os.getenv("ADMIN_PRIORITY_WEIGHT", "1"))
+GENERATION_LANE_MAX_WAIT = float(os.getenv("GENERATION_LANE_MAX_WAIT", "60"))
+# Режим вариантов: сколько изображений на один промпт и сколько предсказаний одновременно
+VARIATIONS_COUNT = int(os.getenv("VARIATIONS_COUNT", "4"))
+VARIATIONS_CONCURRENCY = int(os.getenv("VARIATIONS_CONCURRENCY", "4"))
+# Прогресс генерации в сообщении ожидания: вкл/выкл и минимальный интервал между правками (сек)
+PROGRESS_UPDATES = os.getenv("PROGRESS_UPDATES", "true").lower() in ("1", "true", "yes")
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))
+
+# Кэш результатов генерации
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache/results")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "500"))
+RESULT_CACHE_TTL_HOURS = float(os.getenv("RESULT_CACHE_TTL_HOURS", "72"))
+# Хранилище сгенерированных изображений (файлы + file_id Telegram)
+ASSET_STORE_DIR = os.getenv("ASSET_STORE_DIR", "cache/assets")
+ASSET_STORE_MAX_MB = int(os.getenv("ASSET_STORE_MAX_MB", "2000"))
+ASSET_STORE_TTL_DAYS = float(os.getenv("ASSET_STORE_TTL_DAYS", "30"))
+# История правок пользователя (версии для "Отменить правку" и цепочки правок)
+EDIT_HISTORY_MAX_VERSIONS = int(os.getenv("EDIT_HISTORY_MAX_VERSIONS", "10"))
+EDIT_HISTORY_MAX_MB = int(os.getenv("EDIT_HISTORY_MAX_MB", "50"))
+EDIT_HISTORY_TTL_HOURS = float(os.getenv("EDIT_HISTORY_TTL_HOURS", "24"))
+# Публичный адрес app.py: модель забирает сохраненные изображения по {PUBLIC_BASE_URL}/assets/<id>.
+# Если не задан - изображение передается модели как data URI.
+PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or "").rstrip("/") or None
+# Предобработка фото для редактирования
+IMAGE_MAX_DIM = int(os.getenv("IMAGE_MAX_DIM", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "90"))
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))
+IMAGE_MAX_UPLOAD_MB = int(os.getenv("IMAGE_MAX_UPLOAD_MB", "20"))
 
 # YooMoney Payments
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
@@ -21,17 +106,104 @@ SUBSCRIPTION_PLANS = {
     "1_month": {
         "price": 999,  # рублей
         "duration_days": 30,
-        "name": "1 месяц"
+        "name": "1 месяц",
+        "priority_weight": 2,  # вес полосы в очереди генераций
+        "output_profile": "standard",  # профиль кодирования результата (OUTPUT_PROFILES)
+        "model_quality": 1  # минимальное качество модели (quality в MODEL_CATALOG)
     },
     "3_months": {
         "price": 1499,  # рублей
         "duration_days": 90,
-        "name": "3 месяца"
+        "name": "3 месяца",
+        "priority_weight": 4,  # вес полосы в очереди генераций
+        "output_profile": "high",  # профиль кодирования результата (OUTPUT_PROFILES)
+        "model_quality": 3  # минимальное качество модели (quality в MODEL_CATALOG)
     },
     "1_year": {
         "price": 4999,  # рублей
         "duration_days": 365,
-        "name": "1 год"
+        "name": "1 год",
+        "priority_weight": 8,  # вес полосы в очереди генераций
+        "output_profile": "max",  # профиль кодирования результата (OUTPUT_PROFILES)
+        "model_quality": 4  # минимальное качество модели (quality в MODEL_CATALOG)
+    }
+}
+
+# Профили кодирования результата: в каком формате модель отдает оригинал
+# (model_format: png/jpg) и как он перекодируется для отправки фото
+OUTPUT_PROFILES = {
+    "standard": {"name": "Стандарт (JPEG)", "model_format": "jpg", "format": "jpg", "quality": 85, "max_dim": 1280},
+    "high": {"name": "Высокое (WebP)", "model_format": "png", "format": "webp", "quality": 90, "max_dim": 2048},
+    "max": {"name": "Максимальное (WebP)", "model_format": "png", "format": "webp", "quality": 95, "max_dim": 4096},
+    # Без max_dim в формате модели - оригинал отправляется как есть (потоком)
+    "lossless": {"name": "Без потерь (PNG)", "model_format": "png", "format": "png", "quality": None, "max_dim": None}
+}
+DEFAULT_OUTPUT_PROFILE = os.getenv("DEFAULT_OUTPUT_PROFILE", "standard")
+ADMIN_OUTPUT_PROFILE = os.getenv("ADMIN_OUTPUT_PROFILE", "max")
+
+# Каталог моделей Replicate для роутера:
+#   model - "owner/name" (официальная модель) или "owner/name:version";
+#   quality - оценка качества 1..5, тарифы задают минимум (model_quality);
+#   cost - цена за изображение ($) или cost_per_second - цена секунды GPU ($);
+#   latency - ожидаемое время предсказания (сек), пока нет своих замеров;
+#   input - фиксированные параметры модели; params - какие параметры запроса
+#   модель понимает (остальные отбрасываются); edit - умеет редактировать фото.
+MODEL_CATALOG = {
+    "nano-banana": {
+        "model": "google/nano-banana", "quality": 5, "cost": 0.039, "latency": 12,
+        "input": {}, "params": ["output_format", "aspect_ratio", "image_input"], "edit": True
+    },
+    "flux-dev": {
+        "model": "black-forest-labs/flux-dev", "quality": 4, "cost": 0.025, "latency": 8,
+        "input": {"num_inference_steps": 28}, "params": ["output_format", "aspect_ratio"]
+    },
+    "flux-schnell": {
+        "model": "black-forest-labs/flux-schnell", "quality": 3, "cost": 0.003, "latency": 2,
+        "input": {"num_inference_steps": 4}, "params": ["output_format", "aspect_ratio"]
+    },
+    "sdxl": {
+        "model": "stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b",
+        "quality": 3, "cost_per_second": 0.000725, "latency": 10,
+        "input": {"width": 1024, "height": 1024, "num_inference_steps": 25, "guidance_scale": 7.5}, "params": []
+    },
+    "stable-diffusion": {
+        "model": "stability-ai/stable-diffusion:27b93a2413e7f36cd83da926f3656280b2931564ff050bf9575f1fdf9bcd7478",
+        "quality": 1, "cost_per_second": 0.000725, "latency": 5,
+        "input": {"width": 512, "height": 512, "num_inference_steps": 20, "guidance_scale": 7.5}, "params": []
+    }
+}
+# Роутер моделей: политика (fastest / cheapest / best), включенные модели (через запятую,
+# пусто - весь каталог), окно замеров на модель и сколько замеров нужно, чтобы им доверять
+ROUTER_POLICY = os.getenv("ROUTER_POLICY", "best")
+ROUTER_MODELS = [key.strip() for key in os.getenv("ROUTER_MODELS", "").split(",") if key.strip()] or list(MODEL_CATALOG)
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+# Доля запросов, отправляемых в наименее изученную подходящую модель (чтобы замеры не устаревали)
+ROUTER_EXPLORE = float(os.getenv("ROUTER_EXPLORE", "0.05"))
+# Минимальное качество модели для подписок, активированных админом
+ADMIN_MODEL_QUALITY = int(os.getenv("ADMIN_MODEL_QUALITY", "4"))
+
+# Стили: шаблон промпта ({prompt} - описание пользователя) и параметры модели
+STYLE_PRESETS = {
+    "artistic": {
+        "name": "🎨 Художественный",
+        "template": "{prompt}. Painterly fine art, expressive brushstrokes, rich color palette, gallery composition",
+        "params": {"aspect_ratio": "4:5"}
+    },
+    "photorealistic": {
+        "name": "📸 Фотореалистичный",
+        "template": "{prompt}. Photorealistic photograph, natural lighting, sharp focus, 35mm lens, high detail",
+        "params": {"aspect_ratio": "3:2"}
+    },
+    "cartoon": {
+        "name": "🎭 Мультяшный",
+        "template": "{prompt}. Cartoon anime illustration, clean line art, flat vibrant colors, cel shading",
+        "params": {"aspect_ratio": "1:1"}
+    },
+    "vintage": {
+        "name": "📺 Винтажный",
+        "template": "{prompt}. Vintage retro photo, film grain, faded warm tones, 1970s aesthetic",
+        "params": {"aspect_ratio": "4:3"}
     }
 }
 
@@ -49,3 +221,6 @@ def validate_config(required: list[str] | None = None) -> None:
     missing = [name for name in names_to_check if not os.getenv(name)]
     if missing:
         raise ValueError(f"Отсутствуют переменные окружения: {', '.join(missing)}")
+    # Без секрета webhook Replicate нельзя проверить: любой POST подставил бы результат чужой задаче
+    if REPLICATE_WEBHOOK_URL and not REPLICATE_WEBHOOK_SECRET:
+        raise ValueError("REPLICATE_WEBHOOK_URL задан без REPLICATE_WEBHOOK_SECRET")
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Локальный fake-сервер Replicate API для тестов и бенчмарков.
+
+Эмулирует создание предсказаний, их статусы и выдачу файлов, не тратя деньги
+на реальные предсказания. Задержка модели берется из распределения
+(fixed, uniform, lognormal, exponential), можно включить долю неудачных
+предсказаний, ошибки 5xx и ответы 429 при превышении лимита запросов. С
+--webhook-secret webhook'и подписываются так же, как у Replicate. Запуск:
+
+    python fake_replicate.py --port 8090 --latency 10 --distribution lognormal --failure-rate 0.05
+    REPLICATE_BASE_URL=http://127.0.0.1:8090 python bot_runner.py
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import io
+import json
+import math
+import random
+import time
+import uuid
+from collections import deque
+from typing import Dict, Any, Deque, Optional
+
+import aiohttp
+from aiohttp import web
+from PIL import Image
+
+def _make_image(size: int = 512, noise: bool = False, image_format: str = "PNG") -> bytes:
+    """Сгенерировать тестовое изображение (с шумом - плохо сжимаемое, как настоящие фото)"""
+    if noise:
+        image = Image.merge("RGB", [Image.effect_noise((size, size), 64) for _ in range(3)])
+    else:
+        image = Image.radial_gradient("L").resize((size, size)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+DISTRIBUTIONS = ("fixed", "uniform", "lognormal", "exponential")
+
+class LatencyModel:
+    """
+    Распределение задержки вокруг заданного среднего.
+
+    spread - разброс: для uniform доля от среднего в обе стороны, для
+    lognormal - sigma (среднее сохраняется), для fixed и exponential не используется.
+    """
+
+    def __init__(self, distribution: str = "fixed", spread: float = 0.5, seed: int = None):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.distribution = distribution
+        self.spread = spread
+        self._random = random.Random(seed)
+
+    def sample(self, mean: float) -> float:
+        if mean <= 0 or self.distribution == "fixed":
+            return max(mean, 0.0)
+        if self.distribution == "uniform":
+            return self._random.uniform(mean * max(1 - self.spread, 0), mean * (1 + self.spread))
+        if self.distribution == "lognormal":
+            return self._random.lognormvariate(math.log(mean) - self.spread ** 2 / 2, self.spread)
+        return self._random.expovariate(1 / mean)
+
+class RateLimiter:
+    """Скользящее окно в 1 с: сколько еще ждать до освобождения слота (0 - запрос проходит)"""
+
+    def __init__(self, per_second: Optional[float]):
+        self.per_second = per_second
+        self._calls: Deque[float] = deque()
+
+    def acquire(self) -> float:
+        if not self.per_second:
+            return 0.0
+        now = time.monotonic()
+        while self._calls and now - self._calls[0] >= 1.0:
+            self._calls.popleft()
+        if len(self._calls) >= self.per_second:
+            return 1.0 - (now - self._calls[0])
+        self._calls.append(now)
+        return 0.0
+
+class FakeReplicate:
+    def __init__(self, latency: float = 5.0, image_size: int = 512, noise: bool = False,
+                 input_bandwidth: float = None, distribution: str = "fixed", spread: float = 0.5,
+                 failure_rate: float = 0.0, error_rate: float = 0.0, rate_limit: float = None,
+                 seed: int = None, webhook_secret: str = None):
+        self.latency = latency
+        self.latency_model = LatencyModel(distribution, spread, seed)
+        # Доля предсказаний, которые завершатся статусом failed, и доля ответов 5xx на создание
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        # Лимит создания предсказаний в секунду - сверх него 429 с Retry-After
+        self.rate_limiter = RateLimiter(rate_limit)
+        self._random = random.Random(seed)
+        # Скорость, с которой "модель" скачивает входные изображения (байт/с); None - мгновенно
+        self.input_bandwidth = input_bandwidth
+        self.input_bytes = 0
+        # Секрет подписи webhook'ов (whsec_...); None - webhook'и без подписи
+        self.webhook_secret = webhook_secret
+        self.image = _make_image(image_size, noise)
+        self.images = {"png": self.image, "jpg": _make_image(image_size, noise, "JPEG")}
+        self.predictions: Dict[str, Dict[str, Any]] = {}
+        self.requests_count = 0
+        self.created_count = 0
+        self.webhooks_sent = 0
+        self.cancelled_count = 0
+        self.failed_count = 0
+        self.errors_count = 0
+        self.throttled_count = 0
+        self.saved_seconds = 0.0  # непосчитанное время модели у отмененных предсказаний
+        # Переопределения для отдельных моделей ("owner/name"): задержка и недоступность
+        self.model_latency: Dict[str, float] = {}
+        self.down_models: set = set()
+        self._tasks: set = set()
+
+    def _status(self, prediction: Dict[str, Any]) -> Dict[str, Any]:
+        """Обновить статус предсказания в зависимости от прошедшего времени"""
+        if prediction["status"] in ("succeeded", "failed", "canceled"):
+            return prediction
+
+        elapsed = time.time() - prediction["_created"]
+        if elapsed >= prediction["_latency"] and prediction["_fail"]:
+            prediction["status"] = "failed"
+            prediction["error"] = "Fake prediction failure"
+            prediction["completed_at"] = _iso(time.time())
+            self.failed_count += 1
+        elif elapsed >= prediction["_latency"]:
+            prediction["status"] = "succeeded"
+            extension = "jpg" if (prediction["input"] or {}).get("output_format") == "jpg" else "png"
+            prediction["output"] = f"{prediction['_base']}/files/{prediction['id']}.{extension}"
+            prediction["completed_at"] = _iso(time.time())
+            prediction["metrics"] = {"predict_time": prediction["_latency"]}
+        elif elapsed >= prediction["_latency"] * 0.2:
+            percentage = int(elapsed / prediction["_latency"] * 100)
+            prediction["status"] = "processing"
+            prediction["started_at"] = prediction["started_at"] or _iso(time.time())
+            prediction["logs"] = f"{percentage}%|{'#' * (percentage // 10)}| {percentage}/100"
+        return prediction
+
+    def _public(self, prediction: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in prediction.items() if not key.startswith("_")}
+
+    async def create_prediction(self, request: web.Request) -> web.Response:
+        self.requests_count += 1
+        owner, name = request.match_info.get("owner"), request.match_info.get("name")
+        body = await request.json()
+        # Модели сообщества вызываются по версии - тогда переопределения ищем по ней
+        model = f"{owner}/{name}" if owner else body.get("version", "fake/model")
+        if model in self.down_models:
+            return web.json_response({"detail": "Service Unavailable"}, status=503)
+        wait = self.rate_limiter.acquire()
+        if wait:
+            self.throttled_count += 1
+            seconds = math.ceil(wait)
+            return web.json_response({
+                "title": "Request was throttled",
+                "detail": f"Request was throttled. Expected available in {seconds} second.",
+                "status": 429
+            }, status=429, headers={"Retry-After": str(seconds)})
+        if self._random.random() < self.error_rate:
+            self.errors_count += 1
+            return web.json_response({"detail": "Internal Server Error"}, status=500)
+        self.created_count += 1
+        prediction_id = uuid.uuid4().hex
+        base = f"{request.scheme}://{request.host}"
+        prediction = {
+            "id": prediction_id,
+            "model": model,
+            "version": body.get("version", "fake"),
+            "status": "starting",
+            "input": body.get("input"),
+            "output": None,
+            "logs": "",
+            "error": None,
+            "metrics": {},
+            "created_at": _iso(time.time()),
+            "started_at": None,
+            "completed_at": None,
+            "urls": {
+                "get": f"{base}/v1/predictions/{prediction_id}",
+                "cancel": f"{base}/v1/predictions/{prediction_id}/cancel"
+            },
+            "_created": time.time(),
+            "_latency": self.latency_model.sample(self.model_latency.get(model, self.latency)),
+            "_fail": self._random.random() < self.failure_rate,
+            "_base": base
+        }
+        input_bytes = await self._fetch_inputs(body.get("input") or {})
+        self.input_bytes += input_bytes
+        if self.input_bandwidth:
+            prediction["_latency"] += input_bytes / self.input_bandwidth
+        self.predictions[prediction_id] = prediction
+        if body.get("webhook"):
+            task = asyncio.create_task(self._fire_webhook(prediction, body["webhook"]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return web.json_response(self._public(prediction), status=201)
+
+    async def _fetch_inputs(self, input_data: Dict[str, Any]) -> int:
+        """Скачать входные изображения (URL или data URI), как это делает Replicate. Возвращает байты."""
+        total = 0
+        for value in input_data.values():
+            for item in value if isinstance(value, list) else [value]:
+                if not isinstance(item, str):
+                    continue
+                if item.startswith("data:"):
+                    total += len(base64.b64decode(item.split(",", 1)[1]))
+                elif item.startswith("http"):
+                    async with aiohttp.ClientSession() as session:
+                        async with session.get(item) as response:
+                            total += len(await response.read())
+        return total
+
+    async def _fire_webhook(self, prediction: Dict[str, Any], url: str):
+        """Отправить webhook о завершении предсказания, как это делает Replicate"""
+        await asyncio.sleep(prediction["_latency"])
+        self._status(prediction)
+        body = json.dumps(self._public(prediction)).encode()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, data=body, headers=self._webhook_headers(body)) as response:
+                    await response.read()
+                    if response.status != 200:
+                        print(f"Webhook rejected: {response.status}")
+            self.webhooks_sent += 1
+        except Exception as e:
+            print(f"Webhook delivery failed: {e}")
+
+    def _webhook_headers(self, body: bytes) -> Dict[str, str]:
+        """Заголовки webhook; с секретом - подпись webhook-id/-timestamp/-signature"""
+        headers = {"Content-Type": "application/json"}
+        if not self.webhook_secret:
+            return headers
+        webhook_id = f"msg_{uuid.uuid4().hex}"
+        timestamp = str(int(time.time()))
+        secret = self.webhook_secret
+        key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+        digest = hmac.new(key, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+        headers.update({
+            "webhook-id": webhook_id,
+            "webhook-timestamp": timestamp,
+            "webhook-signature": f"v1,{base64.b64encode(digest).decode()}"
+        })
+        return headers
+
+    async def get_prediction(self, request: web.Request) -> web.Response:
+        self.requests_count += 1
+        prediction = self.predictions.get(request.match_info["prediction_id"])
+        if not prediction:
+            return web.json_response({"detail": "Not found"}, status=404)
+        return web.json_response(self._public(self._status(prediction)))
+
+    async def cancel_prediction(self, request: web.Request) -> web.Response:
+        self.requests_count += 1
+        prediction = self.predictions.get(request.match_info["prediction_id"])
+        if not prediction:
+            return web.json_response({"detail": "Not found"}, status=404)
+        self._status(prediction)
+        if prediction["status"] in ("starting", "processing"):
+            prediction["status"] = "canceled"
+            prediction["completed_at"] = _iso(time.time())
+            self.cancelled_count += 1
+            self.saved_seconds += prediction["_latency"] - (time.time() - prediction["_created"])
+        return web.json_response(self._public(prediction))
+
+    async def get_file(self, request: web.Request) -> web.Response:
+        if request.match_info["file_name"].endswith(".jpg"):
+            return web.Response(body=self.images["jpg"], content_type="image/jpeg")
+        return web.Response(body=self.image, content_type="image/png")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests_count,
+            "created": self.created_count,
+            "failed": self.failed_count,
+            "errors": self.errors_count,
+            "throttled": self.throttled_count,
+            "cancelled": self.cancelled_count,
+            "webhooks_sent": self.webhooks_sent
+        }
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+
+    def create_app(self) -> web.Application:
+        # Входные изображения могут приходить data URI прямо в теле запроса
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/models/{owner}/{name}/predictions", self.create_prediction)
+        app.router.add_post("/v1/predictions", self.create_prediction)
+        app.router.add_get("/v1/predictions/{prediction_id}", self.get_prediction)
+        app.router.add_post("/v1/predictions/{prediction_id}/cancel", self.cancel_prediction)
+        app.router.add_get("/files/{file_name}", self.get_file)
+        app.router.add_get("/fake/stats", self.stats)
+        return app
+
+def _iso(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + "Z"
+
+async def start_fake_replicate(port: int, latency: float = 5.0, **kwargs) -> tuple[FakeReplicate, web.AppRunner]:
+    """Запустить fake-сервер внутри текущего event loop (для бенчмарков)"""
+    fake = FakeReplicate(latency=latency, **kwargs)
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return fake, runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Replicate API")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=5.0, help="Среднее время выполнения предсказания, сек")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="fixed", help="Распределение задержки")
+    parser.add_argument("--spread", type=float, default=0.5, help="Разброс задержки (uniform - доля, lognormal - sigma)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Доля предсказаний со статусом failed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500 на создание предсказания")
+    parser.add_argument("--rate-limit", type=float, default=None, help="Предсказаний в секунду, сверх - 429")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--noise", action="store_true", help="Плохо сжимаемое изображение (большой PNG)")
+    parser.add_argument("--input-bandwidth", type=float, default=None,
+                        help="Скорость скачивания входных изображений моделью, МБ/с")
+    parser.add_argument("--webhook-secret", default=None, help="Секрет подписи webhook'ов (whsec_...)")
+    args = parser.parse_args()
+
+    fake = FakeReplicate(
+        latency=args.latency, image_size=args.image_size, noise=args.noise,
+        input_bandwidth=args.input_bandwidth * 1024 * 1024 if args.input_bandwidth else None,
+        distribution=args.distribution, spread=args.spread, failure_rate=args.failure_rate,
+        error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed,
+        webhook_secret=args.webhook_secret
+    )
+    web.run_app(fake.create_app(), host="127.0.0.1", port=args.port)
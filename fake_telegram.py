@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Локальный fake-сервер Telegram Bot API для нагрузочных тестов.
+
+Бот подключается к нему вместо api.telegram.org (TELEGRAM_API_BASE_URL) и
+работает как обычно: long polling getUpdates, отправка и правка сообщений,
+загрузка фото, скачивание файлов. Апдейты от "пользователей" подкладываются
+методами push_* или через HTTP (/fake/updates/...). Задержка ответов берется
+из распределения, можно включить долю ошибок 5xx и лимиты отправки на чат и
+на бота - сверх них сервер отвечает 429 с retry_after, как настоящий. Запуск:
+
+    python fake_telegram.py --port 8095 --latency 0.05 --chat-rate-limit 1
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8095 BOT_TOKEN=123456:fake python bot_runner.py
+    curl -X POST 127.0.0.1:8095/fake/updates/message -d '{"user_id": 1, "text": "/start"}'
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from fake_replicate import LatencyModel, RateLimiter, DISTRIBUTIONS, _make_image
+
+BOT_USER = {"id": 100000, "is_bot": True, "first_name": "Fake Bot", "username": "fake_bot"}
+
+# Методы, на которые действуют лимиты отправки (как flood control у Telegram)
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendMediaGroup",
+    "editMessageText", "editMessageReplyMarkup", "editMessageCaption"
+}
+
+class FakeTelegramError(Exception):
+    def __init__(self, code: int, description: str, parameters: Dict[str, Any] = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.parameters = parameters
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.05, distribution: str = "fixed", spread: float = 0.5,
+                 error_rate: float = 0.0, chat_rate_limit: float = None, global_rate_limit: float = None,
+                 upload_bandwidth: float = None, photo_size: int = 512, seed: int = None):
+        self.latency = latency
+        self.latency_model = LatencyModel(distribution, spread, seed)
+        self.error_rate = error_rate
+        self.chat_rate_limit = chat_rate_limit
+        self.global_limiter = RateLimiter(global_rate_limit)
+        self._chat_limiters: Dict[int, RateLimiter] = {}
+        # Скорость, с которой "Telegram" принимает загрузки (байт/с); None - мгновенно
+        self.upload_bandwidth = upload_bandwidth
+        self.user_photo = _make_image(photo_size, noise=True, image_format="JPEG")
+        self._random = random.Random(seed)
+
+        self._updates: List[Dict[str, Any]] = []
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self._changed = asyncio.Condition()
+        # Сообщения по чатам: (chat_id, message_id) -> сообщение; лента отправленного ботом
+        self.messages: Dict[tuple, Dict[str, Any]] = {}
+        self.sent: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        # Файлы, которые бот может скачать (фото от пользователей)
+        self.files: Dict[str, bytes] = {}
+
+        self.calls = Counter()
+        self.errors_count = 0
+        self.throttled_count = 0
+        self.not_modified_count = 0
+        self.bytes_uploaded = 0
+        self.bytes_fetched = 0
+
+    # Апдейты от пользователей
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"user{user_id}",
+                "language_code": "ru"}
+
+    def _message(self, chat_id: int, sender: Dict[str, Any], **fields) -> Dict[str, Any]:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": sender,
+            **fields
+        }
+        self.messages[(chat_id, message["message_id"])] = message
+        return message
+
+    def _push(self, **update) -> Dict[str, Any]:
+        self._update_id += 1
+        update = {"update_id": self._update_id, **update}
+        self._updates.append(update)
+        self._new_updates.set()
+        return update
+
+    def push_message(self, user_id: int, text: str) -> Dict[str, Any]:
+        """Пользователь пишет боту текст (команды - тоже текст)"""
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self._push(message=self._message(user_id, self._user(user_id), **fields))
+
+    def push_photo(self, user_id: int, data: bytes = None, caption: str = None) -> Dict[str, Any]:
+        """Пользователь отправляет фото (по умолчанию - тестовое JPEG с шумом)"""
+        data = data or self.user_photo
+        file_id = f"user-photo-{uuid.uuid4().hex}"
+        self.files[file_id] = data
+        photo = [{"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1024, "height": 1024,
+                  "file_size": len(data)}]
+        fields = {"photo": photo, "caption": caption} if caption else {"photo": photo}
+        return self._push(message=self._message(user_id, self._user(user_id), **fields))
+
+    def push_callback(self, user_id: int, data: str, message_id: int = None) -> Dict[str, Any]:
+        """Пользователь нажимает кнопку под сообщением бота (по умолчанию - под последним)"""
+        if message_id is None:
+            sent = self.sent.get(user_id)
+            message = sent[-1] if sent else self._message(user_id, BOT_USER, text="...")
+        else:
+            message = self.messages[(user_id, message_id)]
+        return self._push(callback_query={
+            "id": uuid.uuid4().hex,
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message
+        })
+
+    async def wait_for(self, chat_id: int, predicate, after: int = 0,
+                       timeout: float = 60.0) -> Optional[Dict[str, Any]]:
+        """
+        Дождаться отправки или правки сообщения ботом, для которого predicate(message) истинно.
+
+        after - сколько записей ленты чата пропустить (len(sent[chat_id]) до действия пользователя).
+        """
+        async def _wait():
+            async with self._changed:
+                while True:
+                    for message in self.sent.get(chat_id, [])[after:]:
+                        if predicate(message):
+                            return message
+                    await self._changed.wait()
+        try:
+            return await asyncio.wait_for(_wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _record(self, chat_id: int, message: Dict[str, Any]):
+        async with self._changed:
+            self.sent[chat_id].append(message)
+            self._changed.notify_all()
+
+    # Bot API
+
+    async def _delay(self):
+        seconds = self.latency_model.sample(self.latency)
+        if seconds:
+            await asyncio.sleep(seconds)
+
+    def _throttle(self, method: str, chat_id: Optional[int]):
+        if method not in SEND_METHODS:
+            return
+        wait = self.global_limiter.acquire()
+        if not wait and chat_id is not None and self.chat_rate_limit:
+            limiter = self._chat_limiters.setdefault(chat_id, RateLimiter(self.chat_rate_limit))
+            wait = limiter.acquire()
+        if wait:
+            self.throttled_count += 1
+            seconds = math.ceil(wait)
+            raise FakeTelegramError(429, f"Too Many Requests: retry after {seconds}", {"retry_after": seconds})
+
+    async def _file(self, value: str, form) -> tuple[str, int]:
+        """file_id для поля с файлом: загрузка (attach://), URL или существующий file_id"""
+        if value.startswith("attach://"):
+            part = form.get(value[len("attach://"):])
+            data = part.file.read() if part is not None else b""
+            self.bytes_uploaded += len(data)
+            if self.upload_bandwidth:
+                await asyncio.sleep(len(data) / self.upload_bandwidth)
+            return f"bot-file-{uuid.uuid4().hex}", len(data)
+        if value.startswith("http"):
+            # Telegram сам скачивает файл по URL
+            async with aiohttp.ClientSession() as session:
+                async with session.get(value) as response:
+                    if response.status != 200:
+                        raise FakeTelegramError(400, "Bad Request: wrong file identifier/HTTP URL specified")
+                    data = await response.read()
+            self.bytes_fetched += len(data)
+            return f"bot-file-{uuid.uuid4().hex}", len(data)
+        return value, 0
+
+    def _markup(self, form) -> Optional[Dict[str, Any]]:
+        value = form.get("reply_markup")
+        return json.loads(value) if value else None
+
+    async def _photo_message(self, chat_id: int, media: str, form, caption: str = None,
+                             reply_markup: Dict[str, Any] = None) -> Dict[str, Any]:
+        file_id, size = await self._file(media, form)
+        fields = {"photo": [{"file_id": file_id, "file_unique_id": file_id[-16:], "width": 1024, "height": 1024,
+                             "file_size": size}]}
+        if caption:
+            fields["caption"] = caption
+        if reply_markup:
+            fields["reply_markup"] = reply_markup
+        return self._message(chat_id, BOT_USER, **fields)
+
+    async def _call(self, method: str, form) -> Any:
+        chat_id = int(form["chat_id"]) if form.get("chat_id") else None
+        self._throttle(method, chat_id)
+        if self._random.random() < self.error_rate:
+            self.errors_count += 1
+            raise FakeTelegramError(500, "Internal Server Error")
+
+        if method == "getMe":
+            return BOT_USER
+        if method == "sendMessage":
+            fields = {"text": form["text"]}
+            if form.get("reply_markup"):
+                fields["reply_markup"] = self._markup(form)
+            message = self._message(chat_id, BOT_USER, **fields)
+        elif method == "sendPhoto":
+            message = await self._photo_message(chat_id, form["photo"], form, form.get("caption"), self._markup(form))
+        elif method == "sendDocument":
+            file_id, size = await self._file(form["document"], form)
+            message = self._message(chat_id, BOT_USER, document={
+                "file_id": file_id, "file_unique_id": file_id[-16:], "file_name": "original", "file_size": size
+            })
+        elif method == "sendMediaGroup":
+            group = uuid.uuid4().hex
+            messages = []
+            for item in json.loads(form["media"]):
+                message = await self._photo_message(chat_id, item["media"], form, item.get("caption"))
+                message["media_group_id"] = group
+                messages.append(message)
+                await self._record(chat_id, message)
+            return messages
+        elif method in ("editMessageText", "editMessageReplyMarkup", "editMessageCaption"):
+            message = self.messages.get((chat_id, int(form["message_id"])))
+            if message is None:
+                raise FakeTelegramError(400, "Bad Request: message to edit not found")
+            changes = {"reply_markup": self._markup(form)}
+            if method == "editMessageText":
+                changes["text"] = form["text"]
+            elif method == "editMessageCaption":
+                changes["caption"] = form.get("caption")
+            if all(message.get(key) == value for key, value in changes.items()):
+                self.not_modified_count += 1
+                raise FakeTelegramError(400, "Bad Request: message is not modified: specified new message content "
+                                             "and reply markup are exactly the same as a current content and "
+                                             "reply markup of the message")
+            message.update({key: value for key, value in changes.items() if value is not None})
+            message["edit_date"] = int(time.time())
+            await self._record(chat_id, message)
+            return message
+        elif method == "deleteMessage":
+            self.messages.pop((chat_id, int(form["message_id"])), None)
+            return True
+        elif method == "getFile":
+            data = self.files.get(form["file_id"])
+            if data is None:
+                raise FakeTelegramError(400, "Bad Request: invalid file_id")
+            return {"file_id": form["file_id"], "file_unique_id": form["file_id"][-16:],
+                    "file_size": len(data), "file_path": form["file_id"]}
+        else:
+            # answerCallbackQuery, deleteWebhook, setMyCommands и прочее
+            return True
+
+        await self._record(chat_id, message)
+        return message
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(form)})
+
+        await self._delay()
+        try:
+            result = await self._call(method, form)
+        except FakeTelegramError as e:
+            body = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.parameters:
+                body["parameters"] = e.parameters
+            return web.json_response(body, status=e.code)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, form) -> List[Dict[str, Any]]:
+        """Long polling: отдать апдейты начиная с offset, при пустой очереди ждать до timeout"""
+        offset = int(form.get("offset") or 0)
+        limit = int(form.get("limit") or 100)
+        timeout = float(form.get("timeout") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def download_file(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info["file_path"])
+        if data is None:
+            return web.Response(status=404)
+        await self._delay()
+        return web.Response(body=data, content_type="image/jpeg")
+
+    # Управление для внешних нагрузочных сценариев
+
+    async def post_message(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(self.push_message(int(body["user_id"]), body["text"]))
+
+    async def post_photo(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(self.push_photo(int(body["user_id"]), caption=body.get("caption")))
+
+    async def post_callback(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(self.push_callback(int(body["user_id"]), body["data"], body.get("message_id")))
+
+    async def get_chat(self, request: web.Request) -> web.Response:
+        return web.json_response(self.sent.get(int(request.match_info["chat_id"]), []))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "calls": dict(self.calls),
+            "errors": self.errors_count,
+            "throttled": self.throttled_count,
+            "not_modified": self.not_modified_count,
+            "bytes_uploaded": self.bytes_uploaded,
+            "bytes_fetched": self.bytes_fetched,
+            "pending_updates": len(self._updates)
+        }
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+
+    def create_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{file_path}", self.download_file)
+        app.router.add_post("/fake/updates/message", self.post_message)
+        app.router.add_post("/fake/updates/photo", self.post_photo)
+        app.router.add_post("/fake/updates/callback", self.post_callback)
+        app.router.add_get("/fake/chats/{chat_id}", self.get_chat)
+        app.router.add_get("/fake/stats", self.stats)
+        return app
+
+async def start_fake_telegram(port: int, latency: float = 0.05, **kwargs) -> tuple[FakeTelegram, web.AppRunner]:
+    """Запустить fake-сервер внутри текущего event loop (для бенчмарков)"""
+    fake = FakeTelegram(latency=latency, **kwargs)
+    runner = web.AppRunner(fake.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return fake, runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--latency", type=float, default=0.05, help="Средняя задержка ответа, сек")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="fixed", help="Распределение задержки")
+    parser.add_argument("--spread", type=float, default=0.5, help="Разброс задержки (uniform - доля, lognormal - sigma)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--chat-rate-limit", type=float, default=None, help="Сообщений в секунду в один чат, сверх - 429")
+    parser.add_argument("--global-rate-limit", type=float, default=None, help="Сообщений в секунду на бота, сверх - 429")
+    parser.add_argument("--upload-bandwidth", type=float, default=None, help="Скорость приема загрузок, МБ/с")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(
+        latency=args.latency, distribution=args.distribution, spread=args.spread, error_rate=args.error_rate,
+        chat_rate_limit=args.chat_rate_limit, global_rate_limit=args.global_rate_limit,
+        upload_bandwidth=args.upload_bandwidth * 1024 * 1024 if args.upload_bandwidth else None, seed=args.seed
+    )
+    web.run_app(fake.create_app(), host="127.0.0.1", port=args.port)
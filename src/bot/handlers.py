@@ -1,21 +1,33 @@
-from aiogram import Router, F
+from aiogram import Bot, Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from typing import Optional
+from typing import Optional, Callable, Awaitable, Dict, Any
 import asyncio
 import base64
-import sqlite3
+import io
+import time
 from loguru import logger
 
 from src.database.simple_db import db
-from src.services.gemini_service import ReplicateImageService
+from src.services.gemini_service import replicate_service
+from src.services.resilience import CircuitOpenError
+from src.services.model_router import RouteDecision, POLICIES
+from src.services.generation_queue import generation_queue, GenerationJob, QueueFullError, StageTimings, stage_report
+from src.services.result_cache import result_cache, CachedResult, normalize_prompt
+from src.services.asset_store import asset_store, Asset
+from src.services.delivery import delivery_service
+from src.services.image_preprocessing import image_preprocessor
+from src.services.singleflight import generation_flights
+from src.services.style_presets import style_presets
+from src.services.progress import progress_service, ProgressReporter
 from src.services.yookassa_service import get_yookassa_service
-from config import SUBSCRIPTION_PLANS
-
-# Создаем экземпляр сервиса
-replicate_service = ReplicateImageService()
+from src.database.change_feed import SUBSCRIPTION_CHANGED
+from config import (
+    SUBSCRIPTION_PLANS, OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE, ADMIN_OUTPUT_PROFILE,
+    VARIATIONS_COUNT, VARIATIONS_CONCURRENCY, IMAGE_MAX_UPLOAD_MB
+)
 
 # Состояния для FSM
 class ImageStates(StatesGroup):
@@ -33,6 +45,7 @@ def get_main_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🎨 Генерировать изображение", callback_data="generate_image")],
         [InlineKeyboardButton(text="✏️ Редактировать изображение", callback_data="edit_image")],
+        [InlineKeyboardButton(text="🎭 Генерация в стиле", callback_data="choose_style")],
         [InlineKeyboardButton(text="💎 Моя подписка", callback_data="subscription")],
         [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help")]
     ])
@@ -53,16 +66,40 @@ def get_plans_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔙 Назад", callback_data="subscription")]
     ])
 
-def get_style_keyboard() -> InlineKeyboardMarkup:
-    """Клавиатура выбора стиля"""
+def get_format_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура выбора профиля кодирования результата"""
+    rows = [
+        [InlineKeyboardButton(text=profile['name'], callback_data=f"profile:{name}")]
+        for name, profile in OUTPUT_PROFILES.items()
+    ]
+    rows.append([InlineKeyboardButton(text="📋 По тарифу", callback_data="profile:default")])
+    rows.append([InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def get_cancel_keyboard(job: GenerationJob) -> InlineKeyboardMarkup:
+    """Кнопка отмены под сообщением ожидания"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎨 Художественный", callback_data="style_artistic")],
-        [InlineKeyboardButton(text="📸 Фотореалистичный", callback_data="style_photorealistic")],
-        [InlineKeyboardButton(text="🎭 Мультяшный", callback_data="style_cartoon")],
-        [InlineKeyboardButton(text="📺 Винтажный", callback_data="style_vintage")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+        [InlineKeyboardButton(text="✖️ Отменить", callback_data=f"cancel:{job.job_id}")]
     ])
 
+def get_edit_result_buttons() -> list:
+    """Ряды кнопок под результатом правки (без кнопки оригинала)"""
+    return [
+        [InlineKeyboardButton(text="✏️ Редактировать еще", callback_data="edit_again")],
+        [InlineKeyboardButton(text="↩️ Отменить правку", callback_data="edit_undo")],
+        [InlineKeyboardButton(text="🖼 Другое изображение", callback_data="edit_image")],
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+    ]
+
+def get_style_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура выбора стиля"""
+    rows = [
+        [InlineKeyboardButton(text=preset.name, callback_data=f"style_{preset.key}")]
+        for preset in style_presets.all()
+    ]
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 # Обработчики команд
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
@@ -106,6 +143,8 @@ async def cmd_help(message: Message):
 /start - Главное меню
 /help - Эта справка
 /subscription - Информация о подписке
+/format - Качество и формат результата
+/variations - Несколько вариантов по одному описанию
 
 <b>Как пользоваться:</b>
 
@@ -121,6 +160,7 @@ async def cmd_help(message: Message):
 • Получи инструкции по редактированию
 
 3️⃣ <b>Стили изображений:</b>
+• Нажми "🎭 Генерация в стиле" и выбери стиль
 • Художественный - живописный стиль
 • Фотореалистичный - как фотография
 • Мультяшный - аниме/мультфильм
@@ -143,6 +183,23 @@ async def cmd_subscription(message: Message):
     user_id = message.from_user.id
     await show_subscription_info(message, user_id)
 
+@router.message(Command("format"))
+async def cmd_format(message: Message):
+    """Обработчик команды /format - выбор качества и формата результата"""
+    user_id = message.from_user.id
+    current = await get_output_profile(user_id, await db.get_active_plan(user_id))
+    chosen = await db.get_output_profile(user_id)
+    
+    await message.answer(
+        f"🖼 <b>Качество результата</b>\n\n"
+        f"Сейчас: <b>{OUTPUT_PROFILES[current]['name']}</b>"
+        f"{'' if chosen in OUTPUT_PROFILES else ' (по тарифу)'}\n\n"
+        f"Чем выше качество, тем больше файл и дольше отправка. "
+        f"Оригинал без сжатия всегда можно получить кнопкой «📎 Оригинал файлом».",
+        reply_markup=get_format_keyboard(),
+        parse_mode="HTML"
+    )
+
 @router.message(Command("admin_activate"))
 async def cmd_admin_activate(message: Message):
     """Админ-команда для активации подписки (временное решение)"""
@@ -277,25 +334,195 @@ async def cmd_admin_deactivate(message: Message):
         return
     
     # Деактивируем подписку
-    try:
-        conn = sqlite3.connect("bot_subscriptions.db")
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET subscription_active = FALSE 
-            WHERE telegram_id = ?
-        ''', (user_id,))
-        
-        conn.commit()
-        conn.close()
-        
+    if await db.deactivate_subscription(user_id):
         await message.answer("✅ Подписка деактивирована")
         logger.success(f"Admin subscription deactivated for user {user_id}")
-        
-    except Exception as e:
+    else:
         await message.answer("❌ Ошибка деактивации подписки")
-        logger.error(f"Error deactivating admin subscription: {e}")
+
+@router.message(Command("admin_queue"))
+async def cmd_admin_queue(message: Message):
+    """Админ-команда для мониторинга очереди генераций"""
+    user_id = message.from_user.id
+    
+    # Список админов
+    admin_ids = [95714127, 888641250, 369631340]  # Список всех админов
+    if user_id not in admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    stats = generation_queue.get_stats()
+    progress_stats = progress_service.get_stats()
+    lanes_text = "\n".join(
+        f"• {name} (вес {lane['weight']}): в очереди {lane['depth']}, "
+        f"p50 {lane['p50_wait']:.1f}с, p95 {lane['p95_wait']:.1f}с"
+        for name, lane in stats['lanes'].items()
+    )
+    await message.answer(
+        f"📊 <b>Очередь генераций</b>\n\n"
+        f"📥 В очереди: {stats['queue_depth']}\n"
+        f"⚙️ Воркеры: {stats['busy_workers']}/{stats['workers']}\n"
+        f"⏱ Ожидание: ср. {stats['avg_wait_time']:.1f}с, макс. {stats['max_wait_time']:.1f}с\n"
+        f"👥 В работе по пользователям: {stats['in_flight_per_user']}\n"
+        f"✅ Выполнено: {stats['completed']}, ❌ ошибок: {stats['failed']}, "
+        f"✖️ отменено: {stats['cancelled']} (в Replicate: {replicate_service.cancelled_upstream})\n"
+        f"🔁 Повторные отправки: {progress_stats['duplicates']} из {progress_stats['submissions']} "
+        f"({progress_stats['duplicate_rate']:.1%})\n"
+        f"✏️ Правок прогресса: {progress_stats['edits']}, схлопнуто {progress_stats['coalesced']}, "
+        f"лимит Telegram {progress_stats['throttled']}\n\n"
+        f"<b>Полосы приоритета:</b>\n{lanes_text}",
+        parse_mode="HTML"
+    )
+
+@router.message(Command("admin_provider"))
+async def cmd_admin_provider(message: Message):
+    """Админ-команда для мониторинга провайдера: breaker'ы, дедлайны, hedging"""
+    user_id = message.from_user.id
+    
+    # Список админов
+    admin_ids = [95714127, 888641250, 369631340]  # Список всех админов
+    if user_id not in admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    stats = replicate_service.get_stats()
+    breakers_text = "\n".join(
+        f"• {model}: {breaker['state']}, ошибок {breaker['failure_rate']:.0%}, "
+        f"размыканий {breaker['opened']}, отказов {breaker['rejected']}"
+        for model, breaker in stats['breakers'].items()
+    ) or "• вызовов еще не было"
+    latency_text = "\n".join(
+        f"• {model}: p95 {latency['p95']:.1f}с, hedge через "
+        + (f"{latency['hedge_delay']:.1f}с" if latency['hedge_delay'] is not None else "— (мало данных)")
+        for model, latency in stats['latency'].items()
+    ) or "• замеров еще нет"
+    await message.answer(
+        f"🛡 <b>Провайдер генерации</b>\n\n"
+        f"<b>Circuit breaker'ы:</b>\n{breakers_text}\n\n"
+        f"<b>Задержки:</b>\n{latency_text}\n\n"
+        f"⌛ Превышений дедлайна: {stats['deadlines_exceeded']}\n"
+        f"🔀 Hedged-запросов: {stats['hedges']}, выиграла запасная: {stats['hedge_wins']} "
+        f"({stats['hedge_win_rate']:.0%})\n"
+        f"✖️ Отменено в Replicate: {stats['cancelled_upstream']}",
+        parse_mode="HTML"
+    )
+
+@router.message(Command("admin_router"))
+async def cmd_admin_router(message: Message):
+    """Админ-команда роутера моделей: /admin_router [fastest|cheapest|best]"""
+    user_id = message.from_user.id
+    
+    # Список админов
+    admin_ids = [95714127, 888641250, 369631340]  # Список всех админов
+    if user_id not in admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    router_service = replicate_service.router
+    parts = (message.text or "").split()
+    if len(parts) > 1:
+        if not router_service.set_policy(parts[1]):
+            await message.answer(f"❌ Неизвестная политика. Доступны: {', '.join(POLICIES)}")
+            return
+        logger.info(f"Admin {user_id} set router policy to {parts[1]}")
+    
+    stats = router_service.get_stats()
+    models_text = "\n".join(
+        f"• {model}: выбрана {stats['chosen'].get(model, 0)} раз, замеров {model_stats['samples']}, "
+        f"ошибок {model_stats['failure_rate']:.0%}, p50 {model_stats['p50_latency']:.1f}с, "
+        f"цена {model_stats['avg_cost'] if model_stats['avg_cost'] is not None else 0:.4f}$"
+        for model, model_stats in stats['models'].items()
+    )
+    decisions_text = "\n".join(
+        f"• {decision['plan'] or '—'} (качество от {decision['floor']}): {decision['chosen'] or 'нет модели'}"
+        + (" 🔍" if decision['explore'] else "")
+        for decision in router_service.recent_decisions(5)
+    ) or "• решений еще не было"
+    await message.answer(
+        f"🧭 <b>Роутер моделей</b>\n\n"
+        f"📐 Политика: <b>{stats['policy']}</b> (сменить: /admin_router {'|'.join(POLICIES)})\n"
+        f"🔍 Исследование: {stats['explored']}, 🚫 без подходящей модели: {stats['unroutable']}\n\n"
+        f"<b>Модели:</b>\n{models_text}\n\n"
+        f"<b>Последние решения:</b>\n{decisions_text}",
+        parse_mode="HTML"
+    )
+
+@router.message(Command("admin_latency"))
+async def cmd_admin_latency(message: Message):
+    """Админ-команда: p50/p95/p99 этапов генерации за N часов (/admin_latency [часы])"""
+    user_id = message.from_user.id
+    
+    # Список админов
+    admin_ids = [95714127, 888641250, 369631340]  # Список всех админов
+    if user_id not in admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    parts = (message.text or "").split()
+    hours = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 24
+    rows = await db.get_generation_timings(hours)
+    if not rows:
+        await message.answer(f"📭 За последние {hours} ч. успешных генераций с таймингами нет")
+        return
+    
+    stage_names = {
+        'queue_wait': "📥 Очередь бота",
+        'upstream_queue': "☁️ Очередь Replicate",
+        'model_run': "🎨 Работа модели",
+        'download': "⬇️ Скачивание",
+        'delivery': "📤 Доставка в Telegram",
+        'total': "⏱ Всего"
+    }
+    sections = []
+    for generation_type in sorted({row['generation_type'] for row in rows}, key=str):
+        group = [row for row in rows if row['generation_type'] == generation_type]
+        lines = "\n".join(
+            f"{stage_names[stage]}: {stats['p50'] / 1000:.1f} / {stats['p95'] / 1000:.1f} / "
+            f"{stats['p99'] / 1000:.1f} с (n={stats['count']})"
+            for stage, stats in stage_report(group).items() if stats['count']
+        )
+        sections.append(f"<b>{generation_type}</b> ({len(group)})\n{lines}")
+    await message.answer(
+        f"⏱ <b>Время этапов генерации</b> за {hours} ч., p50 / p95 / p99\n\n" + "\n\n".join(sections),
+        parse_mode="HTML"
+    )
+
+@router.message(Command("admin_cache"))
+async def cmd_admin_cache(message: Message):
+    """Админ-команда для мониторинга кэша результатов"""
+    user_id = message.from_user.id
+    
+    # Список админов
+    admin_ids = [95714127, 888641250, 369631340]  # Список всех админов
+    if user_id not in admin_ids:
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    stats = result_cache.get_stats()
+    assets = asset_store.get_stats()
+    delivery = delivery_service.get_stats()
+    subscriptions = db.subscriptions.get_stats()
+    await message.answer(
+        f"🗄 <b>Кэш результатов</b>\n\n"
+        f"🎯 Попадания: {stats['hits']}, промахи: {stats['misses']} ({stats['hit_ratio']:.0%})\n"
+        f"📦 Записей: {stats['entries']}\n"
+        f"💾 Занято: {stats['bytes_stored'] / 1024 / 1024:.1f} из {stats['max_bytes'] / 1024 / 1024:.0f} МБ\n"
+        f"🔗 Объединено одинаковых запросов: {generation_flights.coalesced}\n\n"
+        f"🖼 <b>Хранилище изображений</b>\n"
+        f"📦 Файлов: {assets['assets']}, с file_id: {assets['with_file_id']}\n"
+        f"💾 Занято: {assets['bytes_stored'] / 1024 / 1024:.1f} из {assets['max_bytes'] / 1024 / 1024:.0f} МБ\n"
+        f"⬇️ Скачиваний: {assets['downloads']}, отправок по file_id: {assets['file_id_sends']}\n"
+        f"🕘 Версий в истории правок: {assets['edit_versions']}\n\n"
+        f"📤 <b>Доставка</b> (последние {delivery['deliveries']})\n"
+        f"🔀 Способы: {delivery['by_mode']}, переключений на запасной: {delivery['fallbacks']}\n"
+        f"⏱ TTFB p50/p95: {delivery['p50_ttfb']:.2f} / {delivery['p95_ttfb']:.2f} с\n"
+        f"🧠 Пиковый RSS: {delivery['peak_rss'] / 1024 / 1024:.0f} МБ\n\n"
+        f"💎 <b>Кэш подписок</b>\n"
+        f"🎯 Попадания: {subscriptions['hits']}, промахи: {subscriptions['misses']} "
+        f"({subscriptions['hit_ratio']:.0%}), записей: {subscriptions['entries']}\n"
+        f"🔄 Сбросов: {subscriptions['invalidations']}",
+        parse_mode="HTML"
+    )
 
 # Обработчики callback-запросов
 @router.callback_query(F.data == "main_menu")
@@ -407,6 +634,65 @@ async def callback_edit_image(callback: CallbackQuery, state: FSMContext):
     await state.set_state(ImageStates.waiting_for_image)
     await callback.answer()
 
+@router.callback_query(F.data == "edit_again")
+async def callback_edit_again(callback: CallbackQuery, state: FSMContext):
+    """Продолжить правки с последнего результата, без повторной загрузки"""
+    user_id = callback.from_user.id
+    
+    # Проверяем подписку
+    subscription_active = await db.check_subscription(user_id)
+    if not subscription_active:
+        await callback.message.answer(
+            "❌ <b>Требуется подписка</b>\n\nДля редактирования изображений нужна активная подписка.",
+            reply_markup=get_subscription_keyboard(user_id),
+            parse_mode="HTML"
+        )
+        await callback.answer()
+        return
+    
+    head = await asset_store.edit_head(user_id)
+    if not head:
+        await callback.answer("❌ История правок истекла. Отправь изображение заново.", show_alert=True)
+        await state.set_state(ImageStates.waiting_for_image)
+        return
+    
+    # Последняя версия уже в хранилище - модель получит ее оттуда
+    await state.update_data(last_image_url=head.asset.ref, last_image_hash=head.asset.asset_id)
+    await state.set_state(ImageStates.waiting_for_edit_prompt)
+    await callback.message.answer(
+        "✏️ <b>Продолжаем редактирование</b>\n\n"
+        "Опиши следующее изменение - оно применится к последнему результату.",
+        parse_mode="HTML"
+    )
+    await callback.answer()
+
+@router.callback_query(F.data == "edit_undo")
+async def callback_edit_undo(callback: CallbackQuery, state: FSMContext):
+    """Вернуть предыдущую версию из истории правок (без новой генерации)"""
+    user_id = callback.from_user.id
+    previous = await asset_store.undo_edit(user_id)
+    if not previous:
+        await callback.answer("Отменять нечего", show_alert=True)
+        return
+    
+    if previous.prompt:
+        caption = f"↩️ <b>Правка отменена</b>\n\n<i>Версия {previous.version}: {previous.prompt}</i>"
+    else:
+        caption = "↩️ <b>Правка отменена</b>\n\n<i>Исходное изображение</i>"
+    try:
+        # Версия уже отправлялась - уходит по file_id
+        await delivery_service.send_photo(
+            callback.message, None, previous.asset, previous.asset.extension,
+            caption=caption,
+            reply_markup=get_result_keyboard(get_edit_result_buttons(), previous.asset),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Error sending previous edit version: {e}")
+        await callback.answer("❌ Не удалось отправить изображение. Попробуй позже.", show_alert=True)
+        return
+    await callback.answer()
+
 @router.callback_query(F.data == "subscription")
 async def callback_subscription(callback: CallbackQuery):
     """Информация о подписке"""
@@ -540,10 +826,354 @@ async def callback_help(callback: CallbackQuery):
     await cmd_help(callback.message)
     await callback.answer()
 
+@router.callback_query(F.data.startswith("profile:"))
+async def callback_select_profile(callback: CallbackQuery):
+    """Сохранить выбранный профиль кодирования результата"""
+    user_id = callback.from_user.id
+    profile = callback.data.split(":", 1)[1]
+    
+    if profile != "default" and profile not in OUTPUT_PROFILES:
+        await callback.answer("❌ Неизвестный формат", show_alert=True)
+        return
+    
+    await db.set_output_profile(user_id, None if profile == "default" else profile)
+    current = await get_output_profile(user_id, await db.get_active_plan(user_id))
+    await callback.answer(f"✅ Качество: {OUTPUT_PROFILES[current]['name']}")
+
+@router.callback_query(F.data.startswith("original:"))
+async def callback_original(callback: CallbackQuery):
+    """Отправить оригинал результата файлом, без сжатия Telegram"""
+    asset = await asset_store.find(callback.data.split(":", 1)[1])
+    if not asset:
+        await callback.answer("❌ Оригинал больше недоступен", show_alert=True)
+        return
+    
+    try:
+        await delivery_service.send_document(callback.message, asset, caption="📎 Оригинал без сжатия")
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Error sending original: {e}")
+        await callback.answer("❌ Не удалось отправить файл. Попробуй позже.", show_alert=True)
+
+@router.callback_query(F.data == "choose_style")
+async def callback_choose_style(callback: CallbackQuery):
+    """Показать стилевые пресеты"""
+    try:
+        await callback.message.edit_text(
+            "🎭 <b>Генерация в стиле</b>\n\nВыбери стиль, затем опиши изображение:",
+            reply_markup=get_style_keyboard(),
+            parse_mode="HTML"
+        )
+    except:
+        await callback.message.answer(
+            "🎭 <b>Генерация в стиле</b>\n\nВыбери стиль, затем опиши изображение:",
+            reply_markup=get_style_keyboard(),
+            parse_mode="HTML"
+        )
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("style_"))
+async def callback_select_style(callback: CallbackQuery, state: FSMContext):
+    """Выбор стиля: запоминаем пресет и ждем описание"""
+    user_id = callback.from_user.id
+    preset = style_presets.get(callback.data.removeprefix("style_"))
+    if not preset:
+        await callback.answer("❌ Неизвестный стиль", show_alert=True)
+        return
+    
+    # Проверяем подписку
+    subscription_active = await db.check_subscription(user_id)
+    if not subscription_active:
+        try:
+            await callback.message.edit_text(
+                "❌ <b>Требуется подписка</b>\n\nДля генерации изображений нужна активная подписка.",
+                reply_markup=get_subscription_keyboard(user_id),
+                parse_mode="HTML"
+            )
+        except:
+            await callback.message.answer(
+                "❌ <b>Требуется подписка</b>\n\nДля генерации изображений нужна активная подписка.",
+                reply_markup=get_subscription_keyboard(user_id),
+                parse_mode="HTML"
+            )
+        await callback.answer()
+        return
+    
+    try:
+        await callback.message.edit_text(
+            f"🎭 <b>Стиль: {preset.name}</b>\n\n"
+            "Опиши, что хочешь создать - стиль добавится автоматически.\n\n"
+            "Например: \"Старый маяк на скалистом берегу во время шторма\"",
+            parse_mode="HTML"
+        )
+    except:
+        await callback.message.answer(
+            f"🎭 <b>Стиль: {preset.name}</b>\n\n"
+            "Опиши, что хочешь создать - стиль добавится автоматически.\n\n"
+            "Например: \"Старый маяк на скалистом берегу во время шторма\"",
+            parse_mode="HTML"
+        )
+    
+    await state.update_data(style=preset.key)
+    await state.set_state(ImageStates.waiting_for_style)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("cancel:"))
+async def callback_cancel_job(callback: CallbackQuery):
+    """Отмена генерации: задача снимается с очереди или прерывается вместе с предсказанием"""
+    job = generation_queue.get_job(callback.data.split(":", 1)[1])
+    if not job or job.telegram_id != callback.from_user.id:
+        await callback.answer("Генерация уже завершена")
+        return
+    
+    if await cancel_job(job, "✖️ <b>Генерация отменена</b>"):
+        await callback.answer("Отменено")
+    else:
+        await callback.answer("Генерация уже завершена")
+
+@router.callback_query(F.data == "regenerate")
+async def callback_regenerate(callback: CallbackQuery, state: FSMContext):
+    """Сгенерировать изображение заново, минуя кэш результатов"""
+    user_id = callback.from_user.id
+    data = await state.get_data()
+    prompt = data.get('last_prompt')
+    
+    if not prompt:
+        await callback.answer("❌ Промпт не найден. Начни генерацию заново.", show_alert=True)
+        return
+    
+    # Проверяем подписку
+    subscription_active = await db.check_subscription(user_id)
+    if not subscription_active:
+        await callback.message.answer(
+            "❌ <b>Требуется подписка</b>\n\nДля генерации изображений нужна активная подписка.",
+            reply_markup=get_subscription_keyboard(user_id),
+            parse_mode="HTML"
+        )
+        await callback.answer()
+        return
+    
+    processing_msg = await callback.message.answer("🎨 <b>Генерация изображения...</b>\n\n⏳ Пожалуйста, подождите...")
+    await enqueue_job(GenerationJob(
+        telegram_id=user_id,
+        kind='generate',
+        prompt=prompt,
+        regenerate=True,
+        style=data.get('last_style'),
+        lane=await db.get_active_plan(user_id),
+        execute=run_generation_job,
+        context={'message': callback.message, 'processing_msg': processing_msg, 'state': state}
+    ))
+    await callback.answer()
+
+@router.callback_query(F.data == "variations")
+async def callback_variations(callback: CallbackQuery, state: FSMContext):
+    """Несколько вариантов по последнему промпту"""
+    data = await state.get_data()
+    prompt = data.get('last_prompt')
+    
+    if not prompt:
+        await callback.answer("❌ Промпт не найден. Начни генерацию заново.", show_alert=True)
+        return
+    
+    await start_variations(callback.message, callback.from_user.id, prompt, state, data.get('last_style'))
+    await callback.answer()
+
+@router.message(Command("variations"))
+async def cmd_variations(message: Message, state: FSMContext):
+    """Обработчик команды /variations <описание>"""
+    parts = (message.text or "").split(maxsplit=1)
+    data = await state.get_data()
+    # Без описания - варианты последнего промпта в его стиле
+    prompt = parts[1].strip() if len(parts) > 1 else data.get('last_prompt')
+    style = None if len(parts) > 1 else data.get('last_style')
+    
+    if not prompt or len(prompt) < 10:
+        await message.answer(
+            "❌ Укажи описание после команды (минимум 10 символов).\n\n"
+            "Например: <code>/variations кот в космическом шлеме</code>",
+            parse_mode="HTML"
+        )
+        return
+    
+    await start_variations(message, message.from_user.id, prompt, state, style)
+
+async def start_variations(message: Message, user_id: int, prompt: str, state: FSMContext,
+                           style: Optional[str] = None):
+    """Проверить подписку и поставить в очередь задачу на VARIATIONS_COUNT вариантов"""
+    subscription_active = await db.check_subscription(user_id)
+    if not subscription_active:
+        await message.answer(
+            "❌ <b>Требуется подписка</b>\n\nДля генерации изображений нужна активная подписка.",
+            reply_markup=get_subscription_keyboard(user_id),
+            parse_mode="HTML"
+        )
+        return
+    
+    processing_msg = await message.answer(
+        f"🎲 <b>Генерация {VARIATIONS_COUNT} вариантов...</b>\n\n⏳ Пожалуйста, подождите...",
+        parse_mode="HTML"
+    )
+    # Задача занимает один слот воркера, но в справедливой очереди стоит как N генераций
+    await enqueue_job(GenerationJob(
+        telegram_id=user_id,
+        kind='variations',
+        prompt=prompt,
+        regenerate=True,
+        style=style,
+        cost=VARIATIONS_COUNT,
+        lane=await db.get_active_plan(user_id),
+        execute=run_variations_job,
+        context={'message': message, 'processing_msg': processing_msg, 'state': state}
+    ))
+
+async def run_variations_job(job: GenerationJob):
+    """Выполнение задачи вариантов: N предсказаний параллельно, результат одним альбомом"""
+    message = job.context['message']
+    processing_msg = job.context['processing_msg']
+    state = job.context['state']
+    user_id = job.telegram_id
+    prompt = job.prompt
+    profile = output_profile_of(job)
+    model_prompt, params = styled_prompt(job)
+    semaphore = asyncio.Semaphore(VARIATIONS_CONCURRENCY)
+    try:
+        # Все варианты одного альбома - от одной модели
+        route = replicate_service.route(job.lane)
+    except CircuitOpenError:
+        await close_progress(job)
+        await answer_overloaded(message, processing_msg)
+        return
+    
+    async def variation():
+        """Одно предсказание; результат сразу скачивается и перекодируется по профилю"""
+        timings = StageTimings(queue_wait=job.timings.queue_wait)
+        async with semaphore:
+            image_url = await replicate_service.generate_image(
+                model_prompt, user_id, profile['model_format'], params, route=route, timings=timings
+            )
+        if not image_url:
+            return None
+        original, photo = await delivery_service.prepare_result(image_url, None, profile, timings)
+        return image_url, original, photo, timings
+    
+    tasks = [asyncio.create_task(variation()) for _ in range(job.cost)]
+    results = []
+    failed = 0
+    overloaded = False
+    try:
+        # Собираем результаты по мере готовности; каждый вариант - отдельная запись в истории,
+        # успешные записываются после отправки альбома (со временем доставки)
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                result = await next_done
+            except CircuitOpenError:
+                overloaded = True
+                result = None
+            except Exception as e:
+                logger.error(f"Variation failed for user {user_id}: {e}")
+                result = None
+            
+            if result:
+                results.append(result)
+            else:
+                failed += 1
+                await log_generation(job, False)
+            
+            progress = job.context.get('progress')
+            if progress:
+                progress.update(f"Готово {len(results) + failed} из {job.cost}")
+    finally:
+        for task in tasks:
+            task.cancel()
+    await close_progress(job)
+    
+    buttons = [
+        [InlineKeyboardButton(text="🎲 Еще варианты", callback_data="variations")],
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+    ]
+    
+    if not results and overloaded:
+        await answer_overloaded(message, processing_msg)
+        return
+    
+    if not results:
+        try:
+            await processing_msg.edit_text(
+                "❌ Не удалось сгенерировать варианты. Попробуй еще раз с другим промптом.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+                ])
+            )
+        except:
+            await message.answer(
+                "❌ Не удалось сгенерировать варианты. Попробуй еще раз с другим промптом.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+                ])
+            )
+        return
+    
+    try:
+        await processing_msg.delete()
+    except:
+        pass
+    # Варианты уходят пользователю - отмена и замена новым запросом больше не действуют
+    job.delivered = True
+    
+    caption = f"🎲 <b>Варианты:</b>\n\n<i>{prompt}</i>"
+    delivery_start = time.perf_counter()
+    try:
+        if len(results) == 1:
+            # Альбом - минимум из двух изображений
+            image_url, original, photo, _ = results[0]
+            _, asset = await delivery_service.send_photo(
+                message, image_url, photo, profile['model_format'],
+                reply_markup=get_result_keyboard(buttons, original), caption=caption, parse_mode="HTML"
+            )
+            first = original or asset
+        else:
+            await delivery_service.send_media_group(
+                message, [(photo, image_url) for image_url, _, photo, _ in results],
+                caption=caption, parse_mode="HTML"
+            )
+            first = results[0][1]
+            # У альбома не бывает кнопок - отправляем их отдельным сообщением
+            await message.answer(
+                f"✅ Готово вариантов: {len(results)} из {job.cost}"
+                + (f"\n⚠️ Не удалось: {failed}" if failed else ""),
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
+            )
+    except Exception as e:
+        logger.error(f"Error sending variations: {e}")
+        await message.answer(
+            "❌ Произошла ошибка при отправке вариантов. Попробуй позже.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+            ])
+        )
+        for image_url, original, _, timings in results:
+            await log_generation(job, True, original.ref if original else image_url, timings=timings)
+        return
+    
+    # Альбом доставляется целиком - время доставки у всех вариантов общее
+    delivered = time.perf_counter() - delivery_start
+    for image_url, original, _, timings in results:
+        timings.delivery = delivered
+        await log_generation(job, True, original.ref if original else image_url, timings=timings)
+    
+    # Первый вариант становится текущим изображением для редактирования
+    await state.update_data(
+        last_image_url=first.ref if first else results[0][0],
+        last_image_hash=first.asset_id if first else results[0][0],
+        last_prompt=prompt,
+        last_style=job.style
+    )
+
 # Обработчики состояний
 @router.message(ImageStates.waiting_for_prompt)
-async def process_prompt(message: Message, state: FSMContext):
-    """Обработка промпта для генерации"""
+async def process_prompt(message: Message, state: FSMContext, style: Optional[str] = None):
+    """Обработка промпта для генерации (style - выбранный стилевой пресет)"""
     user_id = message.from_user.id
     prompt = message.text
     
@@ -555,34 +1185,79 @@ async def process_prompt(message: Message, state: FSMContext):
     
     # Показываем анимацию загрузки
     processing_msg = await message.answer("🎨 <b>Генерация изображения...</b>\n\n⏳ Пожалуйста, подождите...")
+    await state.clear()
+    
+    # Ставим задачу в очередь, результат отправит воркер
+    await enqueue_job(GenerationJob(
+        telegram_id=user_id,
+        kind='generate',
+        prompt=prompt,
+        style=style,
+        lane=await db.get_active_plan(user_id),
+        execute=run_generation_job,
+        context={'message': message, 'processing_msg': processing_msg, 'state': state}
+    ))
+
+@router.message(ImageStates.waiting_for_style)
+async def process_style_prompt(message: Message, state: FSMContext):
+    """Обработка промпта для генерации в выбранном стиле"""
+    data = await state.get_data()
+    await process_prompt(message, state, style=data.get('style'))
+
+async def run_generation_job(job: GenerationJob):
+    """Выполнение задачи генерации воркером очереди"""
+    message = job.context['message']
+    processing_msg = job.context['processing_msg']
+    state = job.context['state']
+    user_id = job.telegram_id
+    prompt = job.prompt
     
     try:
-        # Генерируем изображение через Replicate API
-        image_url = await replicate_service.generate_image(prompt, user_id)
+        # Берем результат из кэша или генерируем через Replicate API
+        model_prompt, params = styled_prompt(job)
+        cache_key, cached, image_url = await resolve_result(
+            job, lambda route: replicate_service.generate_image(
+                model_prompt, user_id, output_profile_of(job)['model_format'], params, progress_callback(job), route,
+                job.timings
+            )
+        )
+        await close_progress(job)
         
         if image_url:
-            # Это реальное изображение - отправляем по URL
+            # Это реальное изображение - отправляем
             try:
                 await processing_msg.delete()
             except:
                 pass  # Игнорируем ошибку если сообщение уже удалено
+            # Результат уходит пользователю - отмена и замена новым запросом больше не действуют
+            job.delivered = True
             
-            # Логируем успешную генерацию
-            await db.log_image_generation(user_id, prompt, True, image_url)
-            
-            # Сохраняем URL изображения в состоянии для редактирования
-            await state.update_data(last_image_url=image_url)
-            
-            # Отправляем изображение по URL
-            await message.answer_photo(
-                photo=image_url,
-                caption=f"🎨 <b>Сгенерированное изображение:</b>\n\n<i>{prompt}</i>",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            # Отправляем изображение по профилю кодирования (file_id, файл, поток с Replicate или URL)
+            asset = await send_result(
+                message, job, cache_key, cached, image_url,
+                buttons=[
                     [InlineKeyboardButton(text="🎨 Создать еще", callback_data="generate_image")],
+                    [InlineKeyboardButton(text="🔄 Сгенерировать заново", callback_data="regenerate")],
+                    [InlineKeyboardButton(text="🎲 Варианты", callback_data="variations")],
                     [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-                ]),
+                ],
+                caption=f"🎨 <b>Сгенерированное изображение:</b>{style_caption(job)}\n\n<i>{prompt}</i>",
                 parse_mode="HTML"
             )
+            
+            # Ссылка на сохраненный файл не протухает, в отличие от URL Replicate
+            result_ref = asset.ref if asset else image_url
+            
+            # Логируем успешную генерацию
+            await log_generation(job, True, result_ref)
+            
+            # Сохраняем изображение и промпт в состоянии для редактирования и перегенерации
+            await state.update_data(
+                last_image_url=result_ref,
+                last_image_hash=asset.asset_id if asset else cache_key,
+                last_prompt=prompt,
+                last_style=job.style
+            )
         else:
             try:
                 await processing_msg.edit_text(
@@ -600,10 +1275,16 @@ async def process_prompt(message: Message, state: FSMContext):
                 )
             
             # Логируем неудачную генерацию
-            await db.log_image_generation(user_id, prompt, False)
+            await log_generation(job, False)
+    
+    except CircuitOpenError:
+        await close_progress(job)
+        await answer_overloaded(message, processing_msg)
+        await log_generation(job, False)
     
     except Exception as e:
         logger.error(f"Error processing prompt: {e}")
+        await close_progress(job)
         try:
             await processing_msg.edit_text(
                 "❌ Произошла ошибка при генерации. Попробуй позже.",
@@ -618,8 +1299,6 @@ async def process_prompt(message: Message, state: FSMContext):
                     [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
                 ])
             )
-    
-    await state.clear()
 
 @router.message(ImageStates.waiting_for_image, F.photo)
 async def process_image_for_edit(message: Message, state: FSMContext):
@@ -627,17 +1306,37 @@ async def process_image_for_edit(message: Message, state: FSMContext):
     user_id = message.from_user.id
     logger.info(f"Photo received for user {user_id}")
     
-    # Получаем изображение
-    photo = message.photo[-1]  # Берем самое большое разрешение
-    file = await message.bot.get_file(photo.file_id)
-    logger.info(f"File info: {file.file_path}")
+    # Самое большое разрешение; слишком большой файл не скачиваем
+    photo = message.photo[-1]
+    if photo.file_size and photo.file_size > IMAGE_MAX_UPLOAD_MB * 1024 * 1024:
+        await message.answer(
+            f"❌ Изображение слишком большое. Отправь фото до {IMAGE_MAX_UPLOAD_MB} МБ."
+        )
+        return
     
-    # Получаем URL изображения от Telegram
-    image_url = f"https://api.telegram.org/file/bot{message.bot.token}/{file.file_path}"
+    processing_msg = await message.answer("🔄 Обрабатываю изображение...")
+    try:
+        # Скачиваем один раз, затем проверяем, поворачиваем по EXIF, уменьшаем и пережимаем в пуле процессов
+        buffer = io.BytesIO()
+        await message.bot.download(photo, destination=buffer)
+        processed = await image_preprocessor.process(buffer.getvalue())
+        asset = await asset_store.put(processed.data, None, processed.extension) if processed else None
+    except Exception as e:
+        logger.error(f"Error processing image for user {user_id}: {e}")
+        asset = None
+    finally:
+        await processing_msg.delete()
+    if not asset:
+        await message.answer(
+            "❌ Не удалось обработать изображение. Отправь другое фото (JPEG, PNG или WEBP)."
+        )
+        return
     
-    # Сохраняем URL изображения в состоянии
-    await state.update_data(last_image_url=image_url)
-    logger.info(f"Image URL saved to state: {image_url}")
+    # Сохраняем ссылку на обработанное изображение (id - хэш содержимого, подходит для ключа кэша)
+    await state.update_data(last_image_url=asset.ref, last_image_hash=asset.asset_id)
+    # Новое изображение начинает новую историю правок
+    await asset_store.start_edit_history(user_id, asset.asset_id)
+    logger.info(f"Image saved to state: {asset.ref}")
     
     await message.answer(
         "✏️ <b>Редактирование изображения</b>\n\n"
@@ -691,41 +1390,64 @@ async def process_edit_prompt(message: Message, state: FSMContext):
     
     # Показываем, что обрабатываем
     processing_msg = await message.answer("🔄 Редактирую изображение...")
+    await state.clear()
+    
+    # Ставим задачу в очередь, результат отправит воркер
+    await enqueue_job(GenerationJob(
+        telegram_id=user_id,
+        kind='edit',
+        prompt=edit_prompt,
+        image_url=last_image_url,
+        input_hash=data.get('last_image_hash'),
+        lane=await db.get_active_plan(user_id),
+        execute=run_edit_job,
+        context={'message': message, 'processing_msg': processing_msg, 'state': state}
+    ))
+
+async def run_edit_job(job: GenerationJob):
+    """Выполнение задачи редактирования воркером очереди"""
+    message = job.context['message']
+    processing_msg = job.context['processing_msg']
+    user_id = job.telegram_id
+    edit_prompt = job.prompt
+    last_image_url = job.image_url
+    
+    async def produce(route: RouteDecision):
+        # Сохраненное изображение передаем модели содержимым, а не ссылкой
+        input_url = await asset_store.input_url(last_image_url)
+        if not input_url:
+            return None
+        return await replicate_service.edit_image(
+            edit_prompt, input_url, user_id, output_profile_of(job)['model_format'], progress_callback(job), route,
+            job.timings
+        )
     
     try:
-        # Получаем URL изображения из состояния (может быть сгенерированное или пользовательское)
-        if not last_image_url:
-            await message.answer(
-                "❌ <b>Нет изображения для редактирования</b>\n\n"
-                "Сначала отправьте изображение или сгенерируйте его, а затем попробуйте отредактировать.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="🎨 Генерировать изображение", callback_data="generate_image")],
-                    [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-                ]),
-                parse_mode="HTML"
-            )
-            await state.clear()
-            return
-        
-        # Редактируем изображение через Replicate API
-        edited_image_url = await replicate_service.edit_image(edit_prompt, last_image_url)
+        # Берем результат из кэша или редактируем через Replicate API
+        cache_key, cached, edited_image_url = await resolve_result(job, produce)
+        await close_progress(job)
         
         if edited_image_url:
-            # Отправляем отредактированное изображение по URL
+            # Отправляем отредактированное изображение
             try:
                 await processing_msg.delete()
             except:
                 pass  # Игнорируем ошибку если сообщение уже удалено
+            # Результат уходит пользователю - отмена и замена новым запросом больше не действуют
+            job.delivered = True
             
-            await message.answer_photo(
-                photo=edited_image_url,
+            asset = await send_result(
+                message, job, cache_key, cached, edited_image_url,
+                buttons=get_edit_result_buttons(),
                 caption=f"✏️ <b>Отредактированное изображение</b>\n\n<i>Запрос: {edit_prompt}</i>",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✏️ Редактировать еще", callback_data="edit_image")],
-                    [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
-                ])
+                parse_mode="HTML"
             )
+            if asset:
+                # Результат - новая версия в истории: с нее продолжится цепочка правок
+                await asset_store.push_edit(user_id, job.input_hash, asset.asset_id, edit_prompt)
+            
+            # Логируем успешное редактирование
+            await log_generation(job, True, asset.ref if asset else edited_image_url)
         else:
             try:
                 await processing_msg.edit_text(
@@ -761,9 +1483,18 @@ async def process_edit_prompt(message: Message, state: FSMContext):
                     ]),
                     parse_mode="HTML"
                 )
+            
+            # Логируем неудачное редактирование
+            await log_generation(job, False)
+    
+    except CircuitOpenError:
+        await close_progress(job)
+        await answer_overloaded(message, processing_msg)
+        await log_generation(job, False)
     
     except Exception as e:
         logger.error(f"Error processing edit: {e}")
+        await close_progress(job)
         try:
             await processing_msg.edit_text(
                 "❌ Произошла ошибка при обработке. Попробуй позже.",
@@ -778,10 +1509,264 @@ async def process_edit_prompt(message: Message, state: FSMContext):
                     [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
                 ])
             )
-    
-    await state.clear()
+
 
 # Вспомогательные функции
+async def find_cached(job: GenerationJob, models: list = None) -> Optional[CachedResult]:
+    """Результат задачи в кэше от любой модели, подходящей ее тарифу (перегенерация кэш не смотрит)"""
+    if job.regenerate:
+        return None
+    if models is None:
+        models = replicate_service.router.candidates(job.lane, job.kind == 'edit')
+    profile = output_profile_of(job)
+    return await result_cache.get_first([
+        result_cache.make_key(model, job.prompt, profile['model_format'], job.input_hash, job.style)
+        for model in models
+    ])
+
+async def resolve_result(job: GenerationJob, produce: Callable[[RouteDecision], Awaitable[Optional[str]]]):
+    """Получить результат из кэша или вызвать produce(route).
+    
+    Модель входит в ключ кэша, поэтому ищем по ключам всех моделей, подходящих
+    тарифу задачи: пользователь не получит из кэша результат модели ниже качества
+    своего тарифа. Роутер выбирает модель только при промахе, внутри общего
+    предсказания - попадание в кэш не зависит от breaker'ов и не считается
+    решением роутера.
+    Возвращает (ключ кэша, запись кэша или None, URL изображения или None).
+    """
+    edit = job.kind == 'edit'
+    models = replicate_service.router.candidates(job.lane, edit)
+    
+    def key_for(model: str) -> str:
+        return result_cache.make_key(model, job.prompt, output_profile_of(job)['model_format'], job.input_hash, job.style)
+    
+    cached = await find_cached(job, models)
+    if cached:
+        return cached.key, cached, cached.source_url or cached.asset.ref
+    
+    async def generate():
+        route = replicate_service.route(job.lane, edit=edit)
+        return route.model, await produce(route)
+    
+    # Одинаковые одновременные запросы с тем же набором допустимых моделей разделяют
+    # одно предсказание. Результат скачается и попадет в кэш при отправке (send_result).
+    flight_key = key_for(",".join(sorted(models)))
+    if job.regenerate:
+        flight_key = f"{flight_key}:regenerate"
+    model, image_url = await generation_flights.do(flight_key, generate)
+    return key_for(model), None, image_url
+
+async def send_result(message: Message, job: GenerationJob, cache_key: str, cached: Optional[CachedResult],
+                      image_url: str, buttons: list, **kwargs):
+    """Отправить результат по профилю кодирования и сохранить оригинал в кэш.
+    
+    buttons - ряды кнопок под фото, кнопка "оригинал файлом" добавляется, как только
+    оригинал сохранен. Возвращает asset оригинала или None.
+    """
+    profile = output_profile_of(job)
+    original, photo = await delivery_service.prepare_result(
+        image_url, cached.asset if cached else None, profile, job.timings
+    )
+    start = time.perf_counter()
+    sent, asset = await delivery_service.send_photo(
+        message, image_url, photo, profile['model_format'],
+        reply_markup=get_result_keyboard(buttons, original), **kwargs
+    )
+    job.timings.delivery = time.perf_counter() - start
+    
+    if original is None and asset:
+        # Оригинал сохранился при потоковой отправке - теперь можно предложить его файлом
+        original = asset
+        try:
+            await sent.edit_reply_markup(reply_markup=get_result_keyboard(buttons, original))
+        except:
+            pass
+    
+    if original and not cached and not replicate_service.served_by_fallback(image_url):
+        # Результат запасной модели не кэшируем под ключом основной
+        await result_cache.put(cache_key, original)
+    return original
+
+def get_result_keyboard(buttons: list, original: Optional[Asset]) -> InlineKeyboardMarkup:
+    """Клавиатура под результатом: кнопка оригинала перед последним рядом (главное меню)"""
+    rows = list(buttons)
+    if original:
+        # Полный sha256 не помещается в callback_data (64 байта), хватает префикса
+        rows.insert(len(rows) - 1, [
+            InlineKeyboardButton(text="📎 Оригинал файлом", callback_data=f"original:{original.asset_id[:32]}")
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def styled_prompt(job: GenerationJob) -> tuple[str, Optional[dict]]:
+    """Промпт для модели и параметры с учетом стилевого пресета задачи"""
+    preset = style_presets.get(job.style)
+    if not preset:
+        return job.prompt, None
+    return preset.apply(job.prompt), dict(preset.params)
+
+def style_caption(job: GenerationJob) -> str:
+    """Название стиля для подписи под результатом"""
+    preset = style_presets.get(job.style)
+    return f"\n🎭 Стиль: {preset.name}" if preset else ""
+
+def job_title(job: GenerationJob) -> str:
+    """Заголовок сообщения о прогрессе задачи"""
+    if job.kind == 'variations':
+        return f"🎲 <b>Генерация {job.cost} вариантов...</b>"
+    if job.kind == 'edit':
+        return "🔄 <b>Редактирую изображение...</b>"
+    return "🎨 <b>Генерация изображения...</b>"
+
+def progress_callback(job: GenerationJob):
+    """Колбэк прогресса предсказания для сервиса генерации (None - прогресс не показываем)"""
+    progress = job.context.get('progress')
+    return progress.update if progress else None
+
+async def close_progress(job: GenerationJob):
+    """Остановить обновления прогресса перед отправкой результата или ошибки"""
+    progress = job.context.get('progress')
+    if progress:
+        await progress.close()
+
+async def log_generation(job: GenerationJob, success: bool, image_url: str = None, status: str = None,
+                         timings: StageTimings = None):
+    """Записать исход задачи в историю вместе с временем этапов"""
+    timings = timings or job.timings
+    if timings.queue_wait is None:
+        timings.queue_wait = job.wait_time
+    await db.log_image_generation(
+        job.telegram_id, job.prompt, success, image_url, status,
+        generation_type=job.generation_type,
+        processing_time_ms=job.processing_time_ms(),
+        timings=timings.as_ms()
+    )
+
+async def answer_overloaded(message: Message, processing_msg: Message):
+    """Быстрый ответ, пока провайдер недоступен (circuit breaker разомкнут)"""
+    text = "⚠️ <b>Сервис перегружен</b>\n\nГенерация сейчас недоступна. Попробуй через минуту."
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+    ])
+    try:
+        await processing_msg.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    except:
+        await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+
+async def cancel_job(job: GenerationJob, text: str) -> bool:
+    """Отменить задачу, записать отмену в историю и показать text вместо сообщения ожидания"""
+    if not await generation_queue.cancel(job.job_id):
+        return False
+    
+    await close_progress(job)
+    if job.started_at is None and job.context.get('tracked'):
+        # До воркера задача не дошла - обертка execute не снимет ее с учета
+        progress_service.finished(job.telegram_id, job.prompt)
+    await log_generation(job, False, status='cancelled')
+    
+    try:
+        await job.context['processing_msg'].edit_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+            ]),
+            parse_mode="HTML"
+        )
+    except:
+        pass
+    return True
+
+def supersedes(job: GenerationJob, other: GenerationJob) -> bool:
+    """Новая задача заменяет незавершенную задачу того же вида с другими параметрами"""
+    return (
+        other.job_id != job.job_id
+        and other.kind == job.kind
+        and (normalize_prompt(other.prompt), other.input_hash, other.style)
+        != (normalize_prompt(job.prompt), job.input_hash, job.style)
+    )
+
+async def watch_queue_position(job: GenerationJob, progress: ProgressReporter):
+    """Показывать место в очереди, пока задача ждет свободного воркера"""
+    while True:
+        position = generation_queue.position(job)
+        if position is None:
+            return
+        progress.update('queued', position=position, waited=job.wait_time)
+        await asyncio.sleep(progress.min_interval)
+
+def output_profile_of(job: GenerationJob) -> dict:
+    """Профиль кодирования результата задачи"""
+    return OUTPUT_PROFILES.get(job.output_profile) or OUTPUT_PROFILES[DEFAULT_OUTPUT_PROFILE]
+
+async def get_output_profile(user_id: int, plan: Optional[str]) -> str:
+    """Профиль кодирования: выбор пользователя, иначе по тарифу"""
+    profile = await db.get_output_profile(user_id)
+    if profile not in OUTPUT_PROFILES:
+        if plan == 'admin':
+            profile = ADMIN_OUTPUT_PROFILE
+        else:
+            profile = SUBSCRIPTION_PLANS.get(plan, {}).get('output_profile', DEFAULT_OUTPUT_PROFILE)
+    return profile if profile in OUTPUT_PROFILES else DEFAULT_OUTPUT_PROFILE
+
+async def enqueue_job(job: GenerationJob):
+    """Поставить задачу в очередь генераций, сообщив пользователю о переполнении"""
+    processing_msg = job.context['processing_msg']
+    if not job.output_profile:
+        job.output_profile = await get_output_profile(job.telegram_id, job.lane)
+    if not replicate_service.available(job.lane, edit=job.kind == 'edit') and not await find_cached(job):
+        # Ни одна подходящая модель не доступна и ответа нет в кэше - отвечаем сразу, не занимая очередь
+        await answer_overloaded(job.context['message'], processing_msg)
+        return
+    
+    # Повторная отправка того же промпта, пока первый еще в работе - признак того,
+    # что пользователь не дождался (перегенерация и варианты - осознанные повторы)
+    tracked = not job.regenerate
+    if tracked:
+        progress_service.submitted(job.telegram_id, job.prompt)
+    
+    # Новый запрос заменяет предыдущий незавершенный: он больше не нужен пользователю.
+    # Отменяем только после того, как новый принят в очередь
+    superseded = [other for other in generation_queue.user_jobs(job.telegram_id) if supersedes(job, other)]
+    
+    progress = progress_service.start(processing_msg, job_title(job), reply_markup=get_cancel_keyboard(job))
+    job.context['progress'] = progress
+    job.context['tracked'] = tracked
+    execute = job.execute
+    
+    async def execute_with_progress(job: GenerationJob):
+        try:
+            await execute(job)
+        finally:
+            await progress.close()
+            if tracked:
+                progress_service.finished(job.telegram_id, job.prompt)
+    
+    job.execute = execute_with_progress
+    try:
+        await generation_queue.enqueue(job)
+        for other in superseded:
+            await cancel_job(other, "↪️ <b>Заменено новым запросом</b>")
+        progress.spawn(watch_queue_position(job, progress))
+        if not progress_service.enabled:
+            # Без обновлений прогресса кнопку отмены нужно поставить отдельно
+            try:
+                await processing_msg.edit_reply_markup(reply_markup=get_cancel_keyboard(job))
+            except:
+                pass
+    except QueueFullError as e:
+        logger.warning(f"Job rejected for user {job.telegram_id}: {e}")
+        await progress.close()
+        if tracked:
+            progress_service.finished(job.telegram_id, job.prompt)
+        try:
+            await processing_msg.edit_text(
+                "⏳ Сейчас слишком много запросов. Дождись завершения текущих генераций и попробуй снова.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+                ])
+            )
+        except:
+            pass
+
 async def show_subscription_info(message: Message, user_id: int):
     """Показать информацию о подписке"""
     user = await db.get_user(user_id)
@@ -853,3 +1838,26 @@ async def show_subscription_info(message: Message, user_id: int):
     except:
         # Если не можем редактировать, отправляем новое сообщение
         await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+
+async def on_database_change(bot: Bot, change: Dict[str, Any]):
+    """Изменение из другого процесса (кэш подписок уже сброшен): сообщить об оплаченной подписке"""
+    if change.get('event') != SUBSCRIPTION_CHANGED or not change.get('active'):
+        return
+    payment_id = change.get('payment_id')
+    # Активации админом подтверждает сама команда, здесь - только оплаты из /yookassa-webhook
+    if not payment_id or payment_id.startswith("admin_activation"):
+        return
+    plan_name = SUBSCRIPTION_PLANS.get(change.get('plan'), {}).get('name', 'Неизвестный план')
+    expires_at = change.get('expires_at')
+    from datetime import datetime
+    expires_str = datetime.fromisoformat(expires_at).strftime("%d.%m.%Y %H:%M") if expires_at else "Неизвестно"
+    await bot.send_message(
+        change['telegram_id'],
+        f"✅ <b>Подписка активирована!</b>\n\n"
+        f"📋 План: {plan_name}\n"
+        f"📅 Действует до: {expires_str}\n\n"
+        f"Спасибо за оплату! Генерация и редактирование изображений уже доступны.",
+        reply_markup=get_main_keyboard(),
+        parse_mode="HTML"
+    )
+    logger.info(f"Subscription activation pushed to user {change['telegram_id']}")
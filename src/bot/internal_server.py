@@ -0,0 +1,46 @@
+"""
+Внутренний HTTP-сервер процесса бота
+
+app.py (uvicorn) и bot_runner.py работают в разных процессах. События,
+которые приходят в app.py, но нужны боту (например, webhook о завершении
+предсказания Replicate), пересылаются сюда; изменения подписок бот получает
+из базы (change_feed.py). GET /metrics отдает метрики процесса бота в JSON.
+"""
+
+from aiohttp import web
+from loguru import logger
+
+from src.services.prediction_waiters import prediction_waiters
+from src.services.gemini_service import replicate_service
+from src.services.generation_queue import generation_queue
+from src.services.progress import progress_service
+from src.database.simple_db import db
+
+async def replicate_webhook(request: web.Request) -> web.Response:
+    """Завершение предсказания, пересланное из app.py"""
+    payload = await request.json()
+    resolved = prediction_waiters.resolve(payload)
+    return web.json_response({"status": "ok", "resolved": resolved})
+
+async def metrics(request: web.Request) -> web.Response:
+    """Метрики провайдера, очереди и прогресса"""
+    return web.json_response({
+        "provider": replicate_service.get_stats(),
+        "queue": generation_queue.get_stats(),
+        "progress": progress_service.get_stats(),
+        "subscription_cache": db.subscriptions.get_stats()
+    })
+
+def create_internal_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post("/replicate-webhook", replicate_webhook)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+async def start_internal_server(host: str, port: int) -> web.AppRunner:
+    """Запустить внутренний сервер в текущем event loop"""
+    runner = web.AppRunner(create_internal_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Internal server listening on {host}:{port}")
+    return runner
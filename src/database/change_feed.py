@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Уведомления об изменениях в базе между процессами
+
+app.py (uvicorn) и bot_runner.py - разные процессы с общей базой. Изменение,
+важное для другого процесса (оплаченная подписка), публикуется событием в той
+же транзакции, что и само изменение:
+
+- ProductionDatabase: NOTIFY в канал CHANGE_CHANNEL, слушатель - LISTEN на
+  отдельном соединении asyncpg;
+- SimpleDatabase: строка в таблице change_events, слушатель - поток, который
+  опрашивает PRAGMA data_version (меняется, только когда коммитит другое
+  соединение, и ничего не читает с диска) и при изменении дочитывает новые
+  события.
+
+Событие - словарь с полем event; при переподключении слушателя приходит
+{"event": "resync"}: события за время разрыва могли потеряться.
+"""
+
+import asyncio
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+
+from src.database.sqlite_engine import SQLiteEngine
+from src.database.subscription_cache import SubscriptionCache
+
+CHANGE_CHANNEL = "db_changes"
+
+# События
+SUBSCRIPTION_CHANGED = "subscription_changed"
+RESYNC = "resync"
+
+# Подписчик процесса: async callback(change)
+ChangeCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+_callback_tasks = set()
+
+def encode_change(event: str, **fields) -> str:
+    return json.dumps({"event": event, **fields}, default=str)
+
+def dispatch_change(change: Dict[str, Any], subscriptions: SubscriptionCache, callback: Optional[ChangeCallback]):
+    """Сбросить затронутые кэши процесса и передать событие подписчику (вызывается в event loop)"""
+    event = change.get("event")
+    if event == SUBSCRIPTION_CHANGED:
+        subscriptions.invalidate(int(change["telegram_id"]))
+    elif event == RESYNC:
+        subscriptions.invalidate()
+    if callback:
+        task = asyncio.get_running_loop().create_task(_run_callback(callback, change))
+        _callback_tasks.add(task)
+        task.add_done_callback(_callback_tasks.discard)
+
+async def _run_callback(callback: ChangeCallback, change: Dict[str, Any]):
+    try:
+        await callback(change)
+    except Exception as e:
+        logger.error(f"Error handling database change {change.get('event')}: {e}")
+
+class SQLiteChangeWatcher:
+    def __init__(self, engine: SQLiteEngine, on_change: Callable[[Dict[str, Any]], None], interval: float = 0.005):
+        self.engine = engine
+        self.on_change = on_change
+        self.interval = interval
+        self.delivered = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = threading.Event()
+
+    def start(self):
+        """Запустить поток наблюдения; on_change вызывается в текущем event loop"""
+        loop = asyncio.get_running_loop()
+        self._stop.clear()
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run, args=(loop,), name="sqlite-changes", daemon=True)
+        self._thread.start()
+        # События, закоммиченные после возврата из start(), не будут пропущены
+        self._started.wait()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, loop: asyncio.AbstractEventLoop):
+        conn = self.engine.connect(read_only=True)
+        try:
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM change_events").fetchone()[0]
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            self._started.set()
+            while not self._stop.wait(self.interval):
+                current = conn.execute("PRAGMA data_version").fetchone()[0]
+                if current == version:
+                    continue
+                version = current
+                rows = conn.execute(
+                    "SELECT id, payload FROM change_events WHERE id > ? ORDER BY id", (last_id,)
+                ).fetchall()
+                for event_id, payload in rows:
+                    last_id = event_id
+                    self.delivered += 1
+                    loop.call_soon_threadsafe(self.on_change, json.loads(payload))
+        except Exception as e:
+            logger.error(f"SQLite change watcher stopped: {e}")
+        finally:
+            self._started.set()
+            conn.close()
@@ -1,17 +1,38 @@
 import asyncpg
 import json
 from typing import Optional, Dict, Any, List
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 from loguru import logger
 import asyncio
 
+from config import (
+    LOG_WRITE_BEHIND, LOG_BUFFER_MAX_ROWS, LOG_BUFFER_FLUSH_INTERVAL, LOG_BUFFER_MAX_PENDING,
+    SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_MAX_ENTRIES
+)
+from src.database.write_behind import WriteBehindBuffer
+from src.database.subscription_cache import SubscriptionCache
+from src.database.change_feed import (
+    CHANGE_CHANNEL, SUBSCRIPTION_CHANGED, RESYNC, ChangeCallback, encode_change, dispatch_change
+)
+
+# Колонки журнала генераций в порядке записей для COPY
+GENERATION_COLUMNS = [
+    'user_id', 'prompt', 'success', 'generation_type', 'processing_time_ms', 'status', 'image_url',
+    'queue_wait_ms', 'upstream_queue_ms', 'model_run_ms', 'download_ms', 'delivery_ms', 'created_at'
+]
+
 class ProductionDatabase:
     def __init__(self):
         self.pool = None
         self.db_url = os.getenv("DATABASE_URL")
         if not self.db_url:
             raise ValueError("DATABASE_URL environment variable is required")
+        self.log_buffer = WriteBehindBuffer(
+            self._write_log_rows, LOG_BUFFER_MAX_ROWS, LOG_BUFFER_FLUSH_INTERVAL, LOG_BUFFER_MAX_PENDING
+        ) if LOG_WRITE_BEHIND else None
+        self.subscriptions = SubscriptionCache(SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_MAX_ENTRIES)
+        self._listener: Optional[asyncio.Task] = None
     
     async def init_pool(self):
         """Инициализация пула соединений"""
@@ -59,6 +80,7 @@ class ProductionDatabase:
                         success BOOLEAN NOT NULL,
                         generation_type VARCHAR(50) DEFAULT 'text_to_image',
                         processing_time_ms INTEGER,
+                        status VARCHAR(20),
                         created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
                         FOREIGN KEY (user_id) REFERENCES users(telegram_id) ON DELETE CASCADE
                     )
@@ -96,6 +118,14 @@ class ProductionDatabase:
                     )
                 ''')
                 
+                # Миграции существующих таблиц
+                await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS output_profile VARCHAR(50)')
+                await conn.execute('ALTER TABLE image_generations ADD COLUMN IF NOT EXISTS status VARCHAR(20)')
+                await conn.execute('ALTER TABLE image_generations ADD COLUMN IF NOT EXISTS image_url TEXT')
+                # Время по этапам генерации (мс)
+                for column in ('queue_wait_ms', 'upstream_queue_ms', 'model_run_ms', 'download_ms', 'delivery_ms'):
+                    await conn.execute(f'ALTER TABLE image_generations ADD COLUMN IF NOT EXISTS {column} INTEGER')
+                
                 # Создаем индексы
                 await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)')
                 await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_subscription ON users(subscription_active, subscription_expires_at)')
@@ -134,11 +164,54 @@ class ProductionDatabase:
             raise
     
     async def close_pool(self):
-        """Закрытие пула соединений"""
+        """Закрытие пула соединений (после записи буфера журнала)"""
+        await self.stop_change_listener()
+        if self.log_buffer and self.pool:
+            await self.log_buffer.drain()
         if self.pool:
             await self.pool.close()
             logger.info("Database pool closed")
     
+    async def start_change_listener(self, callback: ChangeCallback = None):
+        """LISTEN изменений из других процессов: сброс кэша подписок и callback(change)"""
+        await self.stop_change_listener()
+        self._listener = asyncio.create_task(self._listen(callback))
+    
+    async def stop_change_listener(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+    
+    async def _listen(self, callback: Optional[ChangeCallback]):
+        """Отдельное соединение под LISTEN (соединения пула возвращаются в пул); при разрыве - переподключение"""
+        def on_notify(connection, pid, channel, payload):
+            dispatch_change(json.loads(payload), self.subscriptions, callback)
+        
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.db_url)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda connection: lost.set())
+                await conn.add_listener(CHANGE_CHANNEL, on_notify)
+                # Пока соединения не было, события могли потеряться
+                dispatch_change({"event": RESYNC}, self.subscriptions, callback)
+                logger.info(f"Listening for database changes on {CHANGE_CHANNEL}")
+                await lost.wait()
+                logger.warning("Change listener connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Change listener error: {e}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(1)
+    
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Получить пользователя по ID"""
         try:
@@ -172,45 +245,65 @@ class ProductionDatabase:
             logger.error(f"Error creating user: {e}")
             return False
     
-    async def update_subscription(self, user_id: int, plan_type: str, active: bool, 
-                                 duration_days: int = None) -> bool:
-        """Обновить подписку пользователя"""
+    async def update_subscription(self, user_id: int, plan_type: str, duration_days: int,
+                                  payment_id: str = None) -> bool:
+        """Активировать подписку на duration_days дней (сигнатура как у SimpleDatabase)"""
+        from datetime import timezone
+        expires_at = datetime.now(timezone.utc) + timedelta(days=duration_days)
+        return await self._set_subscription(user_id, plan_type, True, expires_at, payment_id)
+    
+    async def deactivate_subscription(self, user_id: int) -> bool:
+        """Деактивировать подписку пользователя"""
+        return await self._set_subscription(user_id, None, False, None, None)
+    
+    async def _set_subscription(self, user_id: int, plan_type: Optional[str], active: bool,
+                                expires_at: Optional[datetime], payment_id: Optional[str]) -> bool:
+        """Изменить подписку и опубликовать событие для других процессов"""
         try:
-            from datetime import timezone
-            expires_at = None
-            if active and duration_days:
-                expires_at = datetime.now(timezone.utc) + timedelta(days=duration_days)
-            
             async with self.pool.acquire() as conn:
-                await conn.execute('''
-                    UPDATE users 
-                    SET subscription_active = $1, subscription_plan = $2, 
-                        subscription_expires_at = $3, updated_at = NOW(), last_activity = NOW()
-                    WHERE telegram_id = $4
-                ''', active, plan_type, expires_at, user_id)
-                return True
+                # NOTIFY доставляется слушателям только при COMMIT - вместе с изменением
+                async with conn.transaction():
+                    await conn.execute('''
+                        UPDATE users 
+                        SET subscription_active = $1, subscription_plan = COALESCE($2, subscription_plan), 
+                            subscription_expires_at = $3, updated_at = NOW(), last_activity = NOW()
+                        WHERE telegram_id = $4
+                    ''', active, plan_type, expires_at, user_id)
+                    await conn.execute('SELECT pg_notify($1, $2)', CHANGE_CHANNEL, encode_change(
+                        SUBSCRIPTION_CHANGED, telegram_id=user_id, active=active, plan=plan_type,
+                        expires_at=expires_at.isoformat() if expires_at else None, payment_id=payment_id
+                    ))
+            self.subscriptions.invalidate(user_id)
+            return True
         except Exception as e:
             logger.error(f"Error updating subscription: {e}")
             return False
     
     async def check_subscription(self, user_id: int) -> bool:
-        """Проверить активность подписки"""
+        """Проверить активность подписки (срок окончания кэшируется до изменения подписки)"""
+        cached = self.subscriptions.get(user_id)
+        if cached:
+            return cached.is_active()
+        epoch = self.subscriptions.epoch
         try:
             user = await self.get_user(user_id)
             if not user:
                 logger.info(f"User {user_id} not found")
+                self.subscriptions.put(user_id, None, epoch)
                 return False
             
             subscription_active = user.get('subscription_active')
             logger.info(f"User {user_id} subscription_active: {subscription_active}")
             
             if not subscription_active:
+                self.subscriptions.put(user_id, None, epoch)
                 return False
             
             expires_at = user.get('subscription_expires_at')
             logger.info(f"User {user_id} expires_at: {expires_at}")
             
             if not expires_at:
+                self.subscriptions.put(user_id, None, epoch)
                 return False
             
             # Проверяем, не истекла ли подписка
@@ -226,31 +319,107 @@ class ProductionDatabase:
             
             if expires_at < now_utc:
                 logger.info(f"Subscription expired for user {user_id}")
-                # Автоматически деактивируем истекшую подписку
-                await self.update_subscription(user_id, user.get('subscription_plan', ''), False)
+                # Автоматически деактивируем истекшую подписку (сбросит кэш)
+                await self.deactivate_subscription(user_id)
                 return False
             
+            self.subscriptions.put(user_id, expires_at.timestamp(), epoch)
             logger.info(f"Subscription valid for user {user_id}")
             return True
         except Exception as e:
             logger.error(f"Error checking subscription: {e}")
             return False
     
-    async def log_image_generation(self, user_id: int, prompt: str, success: bool, 
-                                  generation_type: str = 'text_to_image', 
-                                  processing_time_ms: int = None) -> bool:
-        """Логировать генерацию изображения"""
+    async def get_active_plan(self, user_id: int) -> Optional[str]:
+        """Получить тариф активной подписки"""
+        try:
+            async with self.pool.acquire() as conn:
+                return await conn.fetchval(
+                    'SELECT subscription_plan FROM users WHERE telegram_id = $1 AND subscription_active = TRUE',
+                    user_id
+                )
+        except Exception as e:
+            logger.error(f"Error getting active plan: {e}")
+            return None
+
+    async def get_output_profile(self, user_id: int) -> Optional[str]:
+        """Получить выбранный пользователем профиль кодирования результата"""
         try:
+            async with self.pool.acquire() as conn:
+                return await conn.fetchval(
+                    'SELECT output_profile FROM users WHERE telegram_id = $1', user_id
+                )
+        except Exception as e:
+            logger.error(f"Error getting output profile: {e}")
+            return None
+
+    async def set_output_profile(self, user_id: int, profile: Optional[str]) -> bool:
+        """Сохранить профиль кодирования результата (None - по тарифу)"""
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(
+                    'UPDATE users SET output_profile = $2 WHERE telegram_id = $1', user_id, profile
+                )
+                return True
+        except Exception as e:
+            logger.error(f"Error setting output profile: {e}")
+            return False
+
+    async def log_image_generation(self, user_id: int, prompt: str, success: bool, image_url: str = None,
+                                  status: str = None, generation_type: str = 'text_to_image',
+                                  processing_time_ms: int = None, timings: Dict[str, Optional[int]] = None) -> bool:
+        """Логировать генерацию изображения (status: succeeded | failed | cancelled).
+        
+        timings - время этапов в мс: queue_wait_ms, upstream_queue_ms, model_run_ms, download_ms, delivery_ms.
+        """
+        try:
+            status = status or ('succeeded' if success else 'failed')
+            timings = timings or {}
+            row = (user_id, prompt, success, generation_type, processing_time_ms, status,
+                   image_url if success else None, timings.get('queue_wait_ms'), timings.get('upstream_queue_ms'),
+                   timings.get('model_run_ms'), timings.get('download_ms'), timings.get('delivery_ms'),
+                   datetime.now(timezone.utc))
+            if self.log_buffer:
+                self.log_buffer.add('image_generations', row)
+                return True
             async with self.pool.acquire() as conn:
                 await conn.execute('''
-                    INSERT INTO image_generations (user_id, prompt, success, generation_type, processing_time_ms, created_at)
-                    VALUES ($1, $2, $3, $4, $5, NOW())
-                ''', user_id, prompt, success, generation_type, processing_time_ms)
+                    INSERT INTO image_generations (user_id, prompt, success, generation_type, processing_time_ms,
+                                                   status, image_url, queue_wait_ms, upstream_queue_ms, model_run_ms,
+                                                   download_ms, delivery_ms, created_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+                ''', *row)
                 return True
         except Exception as e:
             logger.error(f"Error logging image generation: {e}")
             return False
     
+    async def _write_log_rows(self, table: str, rows: List[tuple]):
+        """Сброс буфера журнала одним COPY.
+        
+        Если пачку отвергли ограничения (например, нет пользователя для внешнего ключа), пишем
+        строки по одной и пропускаем только плохие - иначе одна строка блокировала бы всю очередь.
+        Ошибки соединения пробрасываются: буфер вернет строки и повторит позже.
+        """
+        async with self.pool.acquire() as conn:
+            try:
+                await conn.copy_records_to_table(table, records=rows, columns=GENERATION_COLUMNS)
+                return
+            except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+                logger.warning(f"COPY into {table} rejected ({e}), retrying row by row")
+            placeholders = ', '.join(f'${i}' for i in range(1, len(GENERATION_COLUMNS) + 1))
+            query = f"INSERT INTO {table} ({', '.join(GENERATION_COLUMNS)}) VALUES ({placeholders})"
+            for row in rows:
+                try:
+                    await conn.execute(query, *row)
+                except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+                    logger.error(f"Dropping {table} row for user {row[0]}: {e}")
+    
+    async def flush(self):
+        """Записать накопленные строки журнала сейчас (например, перед чтением отчета)"""
+        if self.log_buffer:
+            await self.log_buffer.flush()
+    
     async def log_payment(self, user_id: int, payment_id: str, plan_type: str, 
                          amount: int, currency: str, status: str, 
                          payment_method: str = None) -> bool:
@@ -303,6 +472,24 @@ class ProductionDatabase:
             logger.error(f"Error getting user stats: {e}")
             return {}
     
+    async def get_generation_timings(self, hours: int = 24, generation_type: str = None) -> List[Dict[str, Any]]:
+        """Тайминги успешных генераций за последние hours часов (для отчета по этапам)"""
+        await self.flush()  # отчет должен видеть и строки, еще ждущие в буфере
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch('''
+                    SELECT generation_type, processing_time_ms, queue_wait_ms, upstream_queue_ms,
+                           model_run_ms, download_ms, delivery_ms
+                    FROM image_generations
+                    WHERE status = 'succeeded' AND processing_time_ms IS NOT NULL
+                      AND created_at >= NOW() - make_interval(hours => $1)
+                      AND ($2::varchar IS NULL OR generation_type = $2)
+                ''', int(hours), generation_type)
+                return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"Error getting generation timings: {e}")
+            return []
+    
     async def get_admin_stats(self) -> Dict[str, Any]:
         """Получить административную статистику"""
         try:
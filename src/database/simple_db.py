@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 """
 Простая база данных SQLite, совместимая с существующей системой подписок
+
+Запросы выполняются через SQLiteEngine: чтения - в пуле соединений
+читателей, записи - в потоке-писателе, event loop не блокируется.
+Журнал генераций пишется пачками через буфер отложенной записи. Изменения
+подписок публикуются в change_events для процесса бота (см. change_feed.py).
 """
 
 import sqlite3
@@ -8,18 +13,53 @@ import json
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta
 import os
+import time
 from loguru import logger
 import asyncio
 
+from config import (
+    SQLITE_DB_PATH, SQLITE_READERS, SQLITE_BUSY_TIMEOUT_MS,
+    LOG_WRITE_BEHIND, LOG_BUFFER_MAX_ROWS, LOG_BUFFER_FLUSH_INTERVAL, LOG_BUFFER_MAX_PENDING,
+    SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_MAX_ENTRIES, CHANGE_FEED_POLL_INTERVAL, CHANGE_EVENTS_RETENTION
+)
+from src.database.sqlite_engine import SQLiteEngine
+from src.database.write_behind import WriteBehindBuffer
+from src.database.subscription_cache import SubscriptionCache
+from src.database.change_feed import (
+    SQLiteChangeWatcher, ChangeCallback, SUBSCRIPTION_CHANGED, encode_change, dispatch_change
+)
+
+# Журнальные вставки: таблица -> запрос для executemany
+LOG_INSERTS = {
+    'image_generations': '''
+        INSERT INTO image_generations (user_id, prompt, image_url, status, generation_type, processing_time_ms,
+                                       queue_wait_ms, upstream_queue_ms, model_run_ms, download_ms, delivery_ms,
+                                       created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+}
+
+def _timestamp() -> str:
+    """Время строки в формате CURRENT_TIMESTAMP (UTC) - строка пишется позже, чем создана"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
 class SimpleDatabase:
-    def __init__(self):
-        self.db_path = "bot_subscriptions.db"
+    def __init__(self, db_path: str = SQLITE_DB_PATH, readers: int = SQLITE_READERS,
+                 busy_timeout_ms: int = SQLITE_BUSY_TIMEOUT_MS):
+        self.db_path = db_path
+        self.engine = SQLiteEngine(db_path, readers=readers, busy_timeout_ms=busy_timeout_ms)
+        self.log_buffer = WriteBehindBuffer(
+            self._write_log_rows, LOG_BUFFER_MAX_ROWS, LOG_BUFFER_FLUSH_INTERVAL, LOG_BUFFER_MAX_PENDING
+        ) if LOG_WRITE_BEHIND else None
+        self.subscriptions = SubscriptionCache(SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_MAX_ENTRIES)
+        self.change_watcher: Optional[SQLiteChangeWatcher] = None
         self.init_database()
     
     def init_database(self):
-        """Инициализация базы данных"""
+        """Инициализация базы данных (синхронно, при старте процесса)"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.engine.connect()
+            conn.execute('BEGIN IMMEDIATE')
             cursor = conn.cursor()
             
             # Таблица пользователей (совместимая с production_db)
@@ -63,6 +103,7 @@ class SimpleDatabase:
                     user_id INTEGER,
                     prompt TEXT,
                     image_url TEXT,
+                    status TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (telegram_id)
                 )
@@ -83,6 +124,47 @@ class SimpleDatabase:
                 )
             ''')
             
+            # События изменений для других процессов (change_feed.py)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS change_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            
+            # Миграции существующих таблиц
+            cursor.execute('PRAGMA table_info(users)')
+            user_columns = [row[1] for row in cursor.fetchall()]
+            if 'output_profile' not in user_columns:
+                cursor.execute('ALTER TABLE users ADD COLUMN output_profile TEXT')
+            
+            cursor.execute('PRAGMA table_info(image_generations)')
+            generation_columns = [row[1] for row in cursor.fetchall()]
+            if 'status' not in generation_columns:
+                cursor.execute('ALTER TABLE image_generations ADD COLUMN status TEXT')
+            if 'generation_type' not in generation_columns:
+                cursor.execute("ALTER TABLE image_generations ADD COLUMN generation_type TEXT DEFAULT 'text_to_image'")
+            # Полное время задачи и время по этапам (мс)
+            for column in ('processing_time_ms', 'queue_wait_ms', 'upstream_queue_ms', 'model_run_ms',
+                           'download_ms', 'delivery_ms'):
+                if column not in generation_columns:
+                    cursor.execute(f'ALTER TABLE image_generations ADD COLUMN {column} INTEGER')
+            
+            # Индексы горячих запросов (после миграций - им нужны добавленные колонки).
+            # Планы запросов проверяет benchmark.py queryplan на заполненной базе.
+            # COUNT(*) генераций пользователя - только по индексу, без чтения строк
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_image_generations_user_id ON image_generations(user_id)')
+            # Тайминги успешных генераций за период (/admin_latency)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_image_generations_status_created '
+                           'ON image_generations(status, created_at)')
+            # Активный тариф пользователя (последняя активная подписка)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active ON subscriptions(user_id, is_active)')
+            # Платежи пользователя (как в production_db)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payments(user_id)')
+            # Удаление старых событий изменений
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_events_created ON change_events(created_at)')
+            
             conn.commit()
             conn.close()
             logger.success("Simple database initialized successfully")
@@ -94,16 +176,18 @@ class SimpleDatabase:
     async def add_user(self, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None, language_code: str = 'ru'):
         """Добавить пользователя"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (telegram_id, username, first_name, last_name, language_code)
+            # Обновляем только профиль Telegram, настройки пользователя сохраняются
+            await self.engine.execute('''
+                INSERT INTO users (telegram_id, username, first_name, last_name, language_code)
                 VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    language_code = excluded.language_code,
+                    updated_at = CURRENT_TIMESTAMP
             ''', (telegram_id, username, first_name, last_name, language_code))
             
-            conn.commit()
-            conn.close()
             logger.info(f"User {telegram_id} added/updated")
             
         except Exception as e:
@@ -112,13 +196,7 @@ class SimpleDatabase:
     async def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Получить информацию о пользователе"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-            result = cursor.fetchone()
-            
-            conn.close()
+            result = await self.engine.fetchone('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
             
             if result:
                 return {
@@ -142,28 +220,28 @@ class SimpleDatabase:
             return None
     
     async def check_subscription(self, telegram_id: int) -> bool:
-        """Проверить активную подписку"""
+        """Проверить активную подписку (срок окончания кэшируется до изменения подписки)"""
+        cached = self.subscriptions.get(telegram_id)
+        if cached:
+            return cached.is_active()
+        epoch = self.subscriptions.epoch
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            result = await self.engine.fetchone('''
                 SELECT subscription_active, subscription_expires_at 
                 FROM users 
                 WHERE telegram_id = ? AND subscription_active = TRUE
             ''', (telegram_id,))
             
-            result = cursor.fetchone()
-            conn.close()
-            
             if result:
                 is_active, expires_at = result
                 if is_active and expires_at:
                     expires_date = datetime.fromisoformat(expires_at)
                     if expires_date > datetime.now():
+                        self.subscriptions.put(telegram_id, expires_date.timestamp(), epoch)
                         logger.info(f"Active subscription found for user {telegram_id}")
                         return True
             
+            self.subscriptions.put(telegram_id, None, epoch)
             logger.info(f"No active subscription for user {telegram_id}")
             return False
                 
@@ -173,8 +251,7 @@ class SimpleDatabase:
     
     async def create_subscription(self, telegram_id: int, plan_name: str, price: int, duration_days: int, payment_id: str = None) -> bool:
         """Создать подписку"""
-        try:
-            conn = sqlite3.connect(self.db_path)
+        def _create(conn: sqlite3.Connection):
             cursor = conn.cursor()
             
             # Деактивируем старые подписки
@@ -194,8 +271,13 @@ class SimpleDatabase:
                 WHERE telegram_id = ?
             ''', (plan_name, expires_at, telegram_id))
             
-            conn.commit()
-            conn.close()
+            self._publish(cursor, SUBSCRIPTION_CHANGED, telegram_id=telegram_id, active=True, plan=plan_name,
+                          expires_at=expires_at.isoformat(), payment_id=payment_id)
+        
+        try:
+            # Все изменения и событие о них - одной транзакцией писателя
+            await self.engine.write(_create)
+            self.subscriptions.invalidate(telegram_id)
             logger.success(f"Subscription created for user {telegram_id}")
             return True
             
@@ -203,21 +285,35 @@ class SimpleDatabase:
             logger.error(f"Error creating subscription: {e}")
             return False
     
+    async def deactivate_subscription(self, telegram_id: int) -> bool:
+        """Деактивировать подписку пользователя"""
+        def _deactivate(conn: sqlite3.Connection):
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE users 
+                SET subscription_active = FALSE 
+                WHERE telegram_id = ?
+            ''', (telegram_id,))
+            self._publish(cursor, SUBSCRIPTION_CHANGED, telegram_id=telegram_id, active=False)
+        
+        try:
+            await self.engine.write(_deactivate)
+            self.subscriptions.invalidate(telegram_id)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error deactivating subscription: {e}")
+            return False
+    
     async def get_subscription_info(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Получить информацию о подписке"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            result = await self.engine.fetchone('''
                 SELECT subscription_plan, subscription_expires_at, subscription_active
                 FROM users 
                 WHERE telegram_id = ?
             ''', (telegram_id,))
             
-            result = cursor.fetchone()
-            conn.close()
-            
             if result:
                 plan, expires_at, is_active = result
                 return {
@@ -231,19 +327,55 @@ class SimpleDatabase:
             logger.error(f"Error getting subscription info: {e}")
             return None
     
+    async def get_active_plan(self, telegram_id: int) -> Optional[str]:
+        """Получить тариф активной подписки ('admin' для активированных админом)"""
+        try:
+            result = await self.engine.fetchone('''
+                SELECT plan_name, payment_id
+                FROM subscriptions
+                WHERE user_id = ? AND is_active = TRUE
+                ORDER BY id DESC LIMIT 1
+            ''', (telegram_id,))
+
+            if result:
+                plan_name, payment_id = result
+                if payment_id and payment_id.startswith("admin_activation"):
+                    return 'admin'
+                return plan_name
+            return None
+
+        except Exception as e:
+            logger.error(f"Error getting active plan: {e}")
+            return None
+
+    async def get_output_profile(self, telegram_id: int) -> Optional[str]:
+        """Получить выбранный пользователем профиль кодирования результата"""
+        try:
+            result = await self.engine.fetchone('SELECT output_profile FROM users WHERE telegram_id = ?', (telegram_id,))
+            return result[0] if result else None
+            
+        except Exception as e:
+            logger.error(f"Error getting output profile: {e}")
+            return None
+    
+    async def set_output_profile(self, telegram_id: int, profile: Optional[str]) -> bool:
+        """Сохранить профиль кодирования результата (None - по тарифу)"""
+        try:
+            await self.engine.execute('UPDATE users SET output_profile = ? WHERE telegram_id = ?', (profile, telegram_id))
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error setting output profile: {e}")
+            return False
+    
     async def add_image_generation(self, telegram_id: int, prompt: str, image_url: str = None):
         """Добавить запись о генерации изображения"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            await self.engine.execute('''
                 INSERT INTO image_generations (user_id, prompt, image_url)
                 VALUES (?, ?, ?)
             ''', (telegram_id, prompt, image_url))
             
-            conn.commit()
-            conn.close()
             logger.info(f"Image generation recorded for user {telegram_id}")
             
         except Exception as e:
@@ -252,16 +384,11 @@ class SimpleDatabase:
     async def add_payment(self, telegram_id: int, payment_id: str, amount: int, status: str, plan_type: str):
         """Добавить запись о платеже"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            await self.engine.execute('''
                 INSERT OR REPLACE INTO payments (user_id, payment_id, amount, status, plan_type)
                 VALUES (?, ?, ?, ?, ?)
             ''', (telegram_id, payment_id, amount, status, plan_type))
             
-            conn.commit()
-            conn.close()
             logger.info(f"Payment recorded for user {telegram_id}")
             
         except Exception as e:
@@ -270,18 +397,13 @@ class SimpleDatabase:
     async def get_user_stats(self, telegram_id: int) -> Dict[str, Any]:
         """Получить статистику пользователя"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Количество генераций
-            cursor.execute('SELECT COUNT(*) FROM image_generations WHERE user_id = ?', (telegram_id,))
-            generations_count = cursor.fetchone()[0]
+            row = await self.engine.fetchone('SELECT COUNT(*) FROM image_generations WHERE user_id = ?', (telegram_id,))
+            generations_count = row[0]
             
             # Активная подписка
             subscription = await self.get_subscription_info(telegram_id)
             
-            conn.close()
-            
             return {
                 'generations_count': generations_count,
                 'has_active_subscription': subscription and subscription.get('is_active', False),
@@ -314,23 +436,108 @@ class SimpleDatabase:
             logger.error(f"Error updating subscription: {e}")
             return False
     
-    async def log_image_generation(self, telegram_id: int, prompt: str, success: bool, image_url: str = None):
-        """Логировать генерацию изображения"""
+    async def log_image_generation(self, telegram_id: int, prompt: str, success: bool, image_url: str = None,
+                                   status: str = None, generation_type: str = 'text_to_image',
+                                   processing_time_ms: int = None, timings: Dict[str, Optional[int]] = None):
+        """Логировать генерацию изображения (status: succeeded | failed | cancelled).
+        
+        timings - время этапов в мс: queue_wait_ms, upstream_queue_ms, model_run_ms, download_ms, delivery_ms.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            status = status or ('succeeded' if success else 'failed')
+            timings = timings or {}
             
-            cursor.execute('''
-                INSERT INTO image_generations (user_id, prompt, image_url)
-                VALUES (?, ?, ?)
-            ''', (telegram_id, prompt, image_url if success else None))
+            await self._log_row('image_generations', (
+                telegram_id, prompt, image_url if success else None, status, generation_type, processing_time_ms,
+                timings.get('queue_wait_ms'), timings.get('upstream_queue_ms'), timings.get('model_run_ms'),
+                timings.get('download_ms'), timings.get('delivery_ms'), _timestamp()
+            ))
             
-            conn.commit()
-            conn.close()
-            logger.info(f"Image generation logged for user {telegram_id}, success: {success}")
+            logger.info(f"Image generation logged for user {telegram_id}, status: {status}")
             
         except Exception as e:
             logger.error(f"Error logging image generation: {e}")
+    
+    async def get_generation_timings(self, hours: int = 24, generation_type: str = None) -> List[Dict[str, Any]]:
+        """Тайминги успешных генераций за последние hours часов (для отчета по этапам)"""
+        await self.flush()  # отчет должен видеть и строки, еще ждущие в буфере
+        try:
+            query = '''
+                SELECT generation_type, processing_time_ms, queue_wait_ms, upstream_queue_ms,
+                       model_run_ms, download_ms, delivery_ms
+                FROM image_generations
+                WHERE status = 'succeeded' AND processing_time_ms IS NOT NULL
+                  AND created_at >= datetime('now', ?)
+            '''
+            params = [f'-{int(hours)} hours']
+            if generation_type:
+                query += ' AND generation_type = ?'
+                params.append(generation_type)
+            
+            rows = await self.engine.fetchall(query, params, row_factory=sqlite3.Row)
+            return [dict(row) for row in rows]
+            
+        except Exception as e:
+            logger.error(f"Error getting generation timings: {e}")
+            return []
+    
+    async def _log_row(self, table: str, row: tuple):
+        """Журнальная строка: в буфер отложенной записи или сразу в базу, если буфер выключен"""
+        if self.log_buffer:
+            self.log_buffer.add(table, row)
+        else:
+            await self.engine.execute(LOG_INSERTS[table], row)
+    
+    async def _write_log_rows(self, table: str, rows: List[tuple]):
+        """Сброс буфера: пачка строк одной транзакцией писателя.
+        
+        Если пачку отвергла сама строка (ограничение или неподходящий тип значения), пишем
+        строки по одной и пропускаем только плохие - иначе одна строка блокировала бы всю очередь.
+        Остальные ошибки (база занята, диск) пробрасываются: буфер вернет строки и повторит позже.
+        """
+        try:
+            await self.engine.executemany(LOG_INSERTS[table], rows)
+            return
+        except (sqlite3.IntegrityError, sqlite3.ProgrammingError) as e:
+            logger.warning(f"Batch insert into {table} rejected ({e}), retrying row by row")
+        for row in rows:
+            try:
+                await self.engine.execute(LOG_INSERTS[table], row)
+            except (sqlite3.IntegrityError, sqlite3.ProgrammingError) as e:
+                logger.error(f"Dropping {table} row for user {row[0]}: {e}")
+    
+    async def flush(self):
+        """Записать накопленные журнальные строки сейчас (например, перед чтением отчета)"""
+        if self.log_buffer:
+            await self.log_buffer.flush()
+    
+    def _publish(self, cursor: sqlite3.Cursor, event: str, **fields):
+        """Событие для других процессов - в транзакции самого изменения; заодно удаляем устаревшие"""
+        now = time.time()
+        cursor.execute('INSERT INTO change_events (payload, created_at) VALUES (?, ?)',
+                       (encode_change(event, **fields), now))
+        cursor.execute('DELETE FROM change_events WHERE created_at < ?', (now - CHANGE_EVENTS_RETENTION,))
+    
+    async def start_change_listener(self, callback: ChangeCallback = None):
+        """Получать изменения из других процессов: сброс кэша подписок и callback(change)"""
+        await self.stop_change_listener()
+        self.change_watcher = SQLiteChangeWatcher(
+            self.engine, lambda change: dispatch_change(change, self.subscriptions, callback),
+            CHANGE_FEED_POLL_INTERVAL
+        )
+        self.change_watcher.start()
+    
+    async def stop_change_listener(self):
+        if self.change_watcher:
+            await asyncio.to_thread(self.change_watcher.stop)
+            self.change_watcher = None
+    
+    async def close(self):
+        """Дописать буфер и очередь записей, закрыть соединения"""
+        await self.stop_change_listener()
+        if self.log_buffer:
+            await self.log_buffer.drain()
+        await asyncio.to_thread(self.engine.close)
 
 # Глобальный экземпляр базы данных
 db = SimpleDatabase()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Движок SQLite с постоянными соединениями вне event loop
+
+Все записи идут через одно соединение в отдельном потоке-писателе (очередь
+запросов, каждый запрос - своя транзакция BEGIN IMMEDIATE), чтения - через
+небольшой пул потоков, у каждого свое соединение только для чтения. База
+работает в режиме WAL: читатели не блокируют писателя и наоборот, а
+busy_timeout позволяет писать в тот же файл из другого процесса (бот и
+app.py) - конкурирующая запись ждет освобождения блокировки, а не падает.
+"""
+
+import asyncio
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Sequence
+
+from loguru import logger
+
+# Общие настройки соединений: WAL сохраняется в файле базы, остальное - на соединение
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728"
+)
+
+_STOP = object()
+
+class SQLiteEngine:
+    def __init__(self, db_path: str, readers: int = 4, busy_timeout_ms: int = 5000):
+        self.db_path = db_path
+        self.readers = readers
+        self.busy_timeout_ms = busy_timeout_ms
+        self.writes = 0
+        self.reads = 0
+        # Колбэк для каждого выполненного запроса (sqlite3 set_trace_callback), для проверки планов
+        self.trace: Optional[Callable[[str], None]] = None
+        self._local = threading.local()
+        self._reader_connections: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._read_pool: Optional[ThreadPoolExecutor] = None
+        self._write_queue: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Новое соединение с настройками движка (для писателя, читателей и миграций)"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False,
+                               isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only=ON")
+        if self.trace:
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    def _start(self):
+        with self._start_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+                self._writer.start()
+            if self._read_pool is None:
+                self._read_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+
+    def _write_loop(self):
+        conn = self.connect()
+        try:
+            while True:
+                item = self._write_queue.get()
+                if item is _STOP:
+                    break
+                fn, loop, future = item
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        result = fn(conn)
+                        conn.execute("COMMIT")
+                    except BaseException:
+                        conn.execute("ROLLBACK")
+                        raise
+                except BaseException as e:
+                    loop.call_soon_threadsafe(_set_exception, future, e)
+                else:
+                    self.writes += 1
+                    loop.call_soon_threadsafe(_set_result, future, result)
+        finally:
+            conn.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect(read_only=True)
+            self._local.conn = conn
+            with self._readers_lock:
+                self._reader_connections.append(conn)
+        return conn
+
+    def _read_sync(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        result = fn(self._reader())
+        self.reads += 1
+        return result
+
+    async def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполнить fn(conn) на соединении читателя в пуле потоков"""
+        self._start()
+        return await asyncio.get_running_loop().run_in_executor(self._read_pool, self._read_sync, fn)
+
+    async def write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Выполнить fn(conn) в потоке-писателе одной транзакцией"""
+        self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._write_queue.put((fn, loop, future))
+        return await future
+
+    async def fetchone(self, query: str, params: Sequence = (), row_factory=None) -> Optional[Any]:
+        def _run(conn: sqlite3.Connection):
+            cursor = conn.cursor()
+            cursor.row_factory = row_factory
+            return cursor.execute(query, params).fetchone()
+        return await self.read(_run)
+
+    async def fetchall(self, query: str, params: Sequence = (), row_factory=None) -> List[Any]:
+        def _run(conn: sqlite3.Connection):
+            cursor = conn.cursor()
+            cursor.row_factory = row_factory
+            return cursor.execute(query, params).fetchall()
+        return await self.read(_run)
+
+    async def execute(self, query: str, params: Sequence = ()) -> int:
+        """Выполнить запись, вернуть число измененных строк"""
+        return await self.write(lambda conn: conn.execute(query, params).rowcount)
+
+    async def executemany(self, query: str, rows: Iterable[Sequence]) -> int:
+        """Пакетная запись одной транзакцией"""
+        return await self.write(lambda conn: conn.executemany(query, rows).rowcount)
+
+    def close(self):
+        """Дождаться очереди записи и закрыть все соединения"""
+        if self._writer is not None and self._writer.is_alive():
+            self._write_queue.put(_STOP)
+            self._writer.join()
+        self._writer = None
+        if self._read_pool is not None:
+            self._read_pool.shutdown(wait=True)
+            self._read_pool = None
+        with self._readers_lock:
+            for conn in self._reader_connections:
+                conn.close()
+            self._reader_connections.clear()
+        self._local = threading.local()
+        logger.info(f"SQLite engine closed: {self.reads} reads, {self.writes} writes")
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+def _set_exception(future: asyncio.Future, error: BaseException):
+    if not future.done():
+        future.set_exception(error)
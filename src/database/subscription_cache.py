@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Кэш статуса подписки: telegram_id -> время окончания
+
+check_subscription вызывается на каждое нажатие «Генерация» и «Редактирование»,
+а статус меняется только при оплате, действиях админа и истечении срока. Кэш
+хранит время окончания подписки (или ее отсутствие), и проверка - это сравнение
+с текущим временем без запроса к базе. Запись сбрасывается при изменении
+подписки: в своем процессе - методами базы, в процессе бота после оплаты в
+app.py - по событию из базы (change_feed.py). TTL ограничивает устаревание,
+если событие потерялось.
+"""
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+@dataclass
+class SubscriptionStatus:
+    expires_at: Optional[float]  # POSIX-время окончания, None - активной подписки нет
+    cached_at: float
+
+    def is_active(self, now: float = None) -> bool:
+        return self.expires_at is not None and self.expires_at > (now or time.time())
+
+class SubscriptionCache:
+    def __init__(self, ttl: float = 600, max_entries: int = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, SubscriptionStatus]" = OrderedDict()
+        # Растет при каждом сбросе: чтение из базы, начатое до сброса, не попадет в кэш
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id: int) -> Optional[SubscriptionStatus]:
+        """Статус из кэша; None - идти в базу (нет записи, истек TTL или срок подписки)"""
+        entry = self._entries.get(telegram_id)
+        now = time.time()
+        if entry is None or now - entry.cached_at >= self.ttl or (
+                entry.expires_at is not None and entry.expires_at <= now):
+            # Истекшую подписку перечитываем: ее могли продлить, а ProductionDatabase деактивирует ее в базе
+            self._entries.pop(telegram_id, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(telegram_id)
+        self.hits += 1
+        return entry
+
+    def put(self, telegram_id: int, expires_at: Optional[float], epoch: int):
+        """Запомнить статус, прочитанный из базы; epoch - значение self.epoch до чтения"""
+        if epoch != self.epoch or self.ttl <= 0:
+            return
+        self._entries[telegram_id] = SubscriptionStatus(expires_at, time.time())
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id: int = None):
+        """Сбросить статус пользователя (None - всех)"""
+        self.epoch += 1
+        self.invalidations += 1
+        if telegram_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(telegram_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'invalidations': self.invalidations
+        }
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Буфер отложенной записи (write-behind) для журнальных строк
+
+Строки image_generations не пишутся по одной на горячем пути (платежи пишутся
+сразу - их нельзя терять): add() кладет строку в память и сразу возвращается,
+фоновая задача сбрасывает накопленное пачкой (executemany в SQLite, COPY в
+PostgreSQL), когда набралось max_rows строк или прошло flush_interval секунд.
+drain() при остановке процесса дописывает все, что осталось. Строку, которую
+отвергла база, запись пачки пропускает, дописав остальные по одной; если
+запись не удалась целиком (база недоступна), строки возвращаются в буфер,
+сверх max_pending самые старые отбрасываются.
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Any, List, Optional
+
+from loguru import logger
+
+# Запись пачки: (таблица, строки) -> None
+FlushCallback = Callable[[str, List[tuple]], Awaitable[None]]
+
+class WriteBehindBuffer:
+    def __init__(self, flush: FlushCallback, max_rows: int = 200, flush_interval: float = 1.0,
+                 max_pending: int = 10000):
+        self._flush = flush
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._rows: Dict[str, Deque[tuple]] = {}
+        self._pending = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._closing = False
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.last_flush_time = 0.0
+
+    def add(self, table: str, row: tuple):
+        """Поставить строку в очередь записи (без ожидания диска)"""
+        self._ensure_started()
+        rows = self._rows.setdefault(table, deque())
+        rows.append(row)
+        self._pending += 1
+        if self._pending > self.max_pending:
+            self._drop_oldest()
+        if self._pending >= self.max_rows:
+            self._wakeup.set()
+
+    def _drop_oldest(self):
+        table = max(self._rows, key=lambda name: len(self._rows[name]))
+        self._rows[table].popleft()
+        self._pending -= 1
+        self.dropped += 1
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._flush_lock = self._flush_lock or asyncio.Lock()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Записать все накопленные строки, по одной пачке на таблицу.
+
+        Сбросы идут по очереди: вызвавший flush() дождется и пачки, которую
+        уже пишет фоновая задача, - после возврата строки видны в базе.
+        """
+        if self._flush_lock is None:
+            return  # в буфер еще ничего не добавляли
+        async with self._flush_lock:
+            await self._flush_pending()
+
+    async def _flush_pending(self):
+        for table in list(self._rows):
+            rows = self._rows[table]
+            if not rows:
+                continue
+            batch = list(rows)
+            rows.clear()
+            self._pending -= len(batch)
+            start = time.perf_counter()
+            try:
+                await self._flush(table, batch)
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error(f"Error flushing {len(batch)} rows to {table}: {e}")
+                # Вернем строки в начало очереди, следующая попытка - по таймеру
+                rows.extendleft(reversed(batch))
+                self._pending += len(batch)
+                while self._pending > self.max_pending:
+                    self._drop_oldest()
+                continue
+            self.last_flush_time = time.perf_counter() - start
+            self.flushed_rows += len(batch)
+            self.flushes += 1
+
+    async def drain(self):
+        """Остановить фоновую запись и дописать остаток (при остановке процесса)"""
+        self._closing = True
+        if self._task is not None and not self._task.done():
+            self._wakeup.set()
+            await self._task
+        await self.flush()
+        if self._pending:
+            logger.error(f"Write-behind buffer lost {self._pending} rows on shutdown")
+        self._task = None
+        self._closing = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'pending': self._pending,
+            'flushed_rows': self.flushed_rows,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'dropped': self.dropped,
+            'last_flush_ms': round(self.last_flush_time * 1000, 1)
+        }
@@ -0,0 +1,585 @@
+"""
+Хранилище сгенерированных изображений (assets)
+
+Каждый результат скачивается с Replicate один раз и хранится локально под
+sha256 своего содержимого, поэтому одинаковые байты не дублируются. После
+первой отправки запоминается file_id Telegram - дальше изображение
+отправляется по file_id без повторной загрузки. Ссылка вида "asset:<id>"
+не протухает, в отличие от URL доставки Replicate, и годится для хранения
+в FSM (last_image_url).
+
+Здесь же хранится история правок пользователя: цепочка версий (asset +
+промпт), из которой "Редактировать еще" берет последний результат, а
+"Отменить правку" мгновенно возвращает предыдущую версию.
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+import aiohttp
+from loguru import logger
+from config import (
+    ASSET_STORE_DIR, ASSET_STORE_MAX_MB, ASSET_STORE_TTL_DAYS, PUBLIC_BASE_URL,
+    EDIT_HISTORY_MAX_VERSIONS, EDIT_HISTORY_MAX_MB, EDIT_HISTORY_TTL_HOURS
+)
+
+ASSET_REF_PREFIX = "asset:"
+
+MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp"
+}
+
+@dataclass
+class Asset:
+    asset_id: str
+    path: str
+    size: int
+    extension: str
+    source_url: Optional[str]
+    file_id: Optional[str]
+    document_file_id: Optional[str] = None
+
+    @property
+    def ref(self) -> str:
+        """Долговечная ссылка на asset для FSM и логов"""
+        return f"{ASSET_REF_PREFIX}{self.asset_id}"
+
+@dataclass
+class EditVersion:
+    version: int
+    asset: Asset
+    prompt: Optional[str]  # None - исходное загруженное изображение
+    created_at: float
+
+def parse_asset_ref(value: Optional[str]) -> Optional[str]:
+    """id asset из ссылки "asset:<id>" или None, если это обычный URL"""
+    if value and value.startswith(ASSET_REF_PREFIX):
+        return value[len(ASSET_REF_PREFIX):]
+    return None
+
+class AssetStore:
+    def __init__(self, asset_dir: str, max_bytes: int, ttl: float, public_base_url: str = None,
+                 history_versions: int = 10, history_max_bytes: int = 50 * 1024 * 1024,
+                 history_ttl: float = 86400):
+        self.asset_dir = asset_dir
+        self.public_base_url = public_base_url
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.history_versions = history_versions
+        self.history_max_bytes = history_max_bytes
+        self.history_ttl = history_ttl
+        self.index_path = os.path.join(asset_dir, "index.db")
+        self.downloads = 0
+        self.file_id_sends = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+        self._init_index()
+
+    def _init_index(self):
+        """Инициализация индекса хранилища"""
+        try:
+            os.makedirs(self.asset_dir, exist_ok=True)
+            conn = sqlite3.connect(self.index_path)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS assets (
+                    asset_id TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    extension TEXT NOT NULL,
+                    source_url TEXT,
+                    file_id TEXT,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_assets_last_access ON assets(last_access)')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(assets)').fetchall()]
+            if 'document_file_id' not in columns:
+                conn.execute('ALTER TABLE assets ADD COLUMN document_file_id TEXT')
+            # Перекодированные версии оригинала (профиль кодирования -> asset)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS variants (
+                    asset_id TEXT NOT NULL,
+                    profile TEXT NOT NULL,
+                    variant_id TEXT NOT NULL,
+                    PRIMARY KEY (asset_id, profile)
+                )
+            ''')
+            # История правок: версии изображения пользователя по порядку
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS edit_history (
+                    telegram_id INTEGER NOT NULL,
+                    version INTEGER NOT NULL,
+                    asset_id TEXT NOT NULL,
+                    prompt TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (telegram_id, version)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_edit_history_asset ON edit_history(asset_id)')
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error initializing asset store: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_path)
+
+    def _path_for(self, asset_id: str, extension: str) -> str:
+        # Раскладываем по подкаталогам, чтобы не держать тысячи файлов в одном
+        return os.path.join(self.asset_dir, asset_id[:2], f"{asset_id}.{extension}")
+
+    def _get_sync(self, asset_id: str) -> Optional[Asset]:
+        conn = self._connect()
+        try:
+            return self._load(conn, asset_id)
+        finally:
+            conn.close()
+
+    def _load(self, conn: sqlite3.Connection, asset_id: str) -> Optional[Asset]:
+        row = conn.execute(
+            'SELECT path, size, extension, source_url, file_id, document_file_id FROM assets WHERE asset_id = ?',
+            (asset_id,)
+        ).fetchone()
+        if not row:
+            return None
+        path, size, extension, source_url, file_id, document_file_id = row
+        if not os.path.exists(path):
+            conn.execute('DELETE FROM assets WHERE asset_id = ?', (asset_id,))
+            conn.commit()
+            return None
+        conn.execute('UPDATE assets SET last_access = ? WHERE asset_id = ?', (time.time(), asset_id))
+        conn.commit()
+        return Asset(asset_id, path, size, extension, source_url, file_id, document_file_id)
+
+    def _put_sync(self, data: bytes, source_url: Optional[str], extension: str) -> Asset:
+        asset_id = hashlib.sha256(data).hexdigest()
+        existing = self._get_sync(asset_id)
+        if existing:
+            return existing
+
+        path = self._path_for(asset_id, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._index_sync(asset_id, path, len(data), source_url, extension)
+        return Asset(asset_id, path, len(data), extension, source_url, None)
+
+    def _index_sync(self, asset_id: str, path: str, size: int, source_url: Optional[str], extension: str):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO assets (asset_id, path, size, extension, source_url, file_id, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?, NULL, ?, ?)
+            ''', (asset_id, path, size, extension, source_url, now, now))
+            conn.commit()
+            self._evict(conn)
+        finally:
+            conn.close()
+
+    def _remove(self, conn: sqlite3.Connection, asset_id: str, path: str):
+        conn.execute('DELETE FROM assets WHERE asset_id = ?', (asset_id,))
+        conn.execute('DELETE FROM variants WHERE asset_id = ? OR variant_id = ?', (asset_id, asset_id))
+        conn.execute('DELETE FROM edit_history WHERE asset_id = ?', (asset_id,))
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Удалить давно не использованные assets, самые старые сверх лимита и истекшие версии правок"""
+        expired = conn.execute('DELETE FROM edit_history WHERE created_at < ?',
+                               (time.time() - self.history_ttl,)).rowcount
+        evicted = 0
+        for asset_id, path in conn.execute('SELECT asset_id, path FROM assets WHERE last_access < ?',
+                                           (time.time() - self.ttl,)).fetchall():
+            self._remove(conn, asset_id, path)
+            evicted += 1
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM assets').fetchone()[0]
+        if total > self.max_bytes:
+            for asset_id, path, size in conn.execute(
+                'SELECT asset_id, path, size FROM assets ORDER BY last_access'
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._remove(conn, asset_id, path)
+                total -= size
+                evicted += 1
+
+        if evicted or expired:
+            conn.commit()
+            logger.info(f"Asset store evicted {evicted} assets, {expired} expired edit versions")
+
+    async def get(self, asset_id: str) -> Optional[Asset]:
+        """Найти asset по id"""
+        try:
+            return await asyncio.to_thread(self._get_sync, asset_id)
+        except Exception as e:
+            logger.error(f"Error reading asset store: {e}")
+            return None
+
+    async def find(self, prefix: str) -> Optional[Asset]:
+        """Найти asset по началу id (полный id не помещается в callback_data Telegram)"""
+        def _lookup():
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT asset_id FROM assets WHERE asset_id LIKE ? LIMIT 1',
+                                   (f"{prefix}%",)).fetchone()
+                return row[0] if row else None
+            finally:
+                conn.close()
+        if not prefix or not prefix.isalnum():
+            return None
+        try:
+            asset_id = await asyncio.to_thread(_lookup)
+        except Exception as e:
+            logger.error(f"Error reading asset store: {e}")
+            return None
+        return await self.get(asset_id) if asset_id else None
+
+    async def put(self, data: bytes, source_url: str = None, extension: str = "png") -> Optional[Asset]:
+        """Сохранить байты изображения (повторное сохранение тех же байт вернет существующий asset)"""
+        try:
+            async with self._lock:
+                return await asyncio.to_thread(self._put_sync, data, source_url, extension)
+        except Exception as e:
+            logger.error(f"Error writing asset store: {e}")
+            return None
+
+    def session(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия для скачивания результатов"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+        return self._session
+
+    def writer(self, source_url: str = None, extension: str = "png") -> "AssetWriter":
+        """Писатель для потоковой записи asset по частям"""
+        return AssetWriter(self, source_url, extension)
+
+    async def fetch(self, url: str, extension: str = "png") -> Optional[Asset]:
+        """Скачать изображение по URL один раз и сохранить в хранилище (по частям, без буфера в памяти)"""
+        writer = self.writer(url, extension)
+        try:
+            async with self.session().get(url) as response:
+                if response.status != 200:
+                    logger.error(f"Failed to download asset: {response.status}")
+                    return None
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    await writer.write(chunk)
+            self.downloads += 1
+            return await writer.commit()
+        except Exception as e:
+            logger.error(f"Error downloading asset: {e}")
+            return None
+        finally:
+            writer.abort()
+
+    def _adopt_sync(self, tmp_path: str, asset_id: str, size: int, source_url: Optional[str],
+                    extension: str) -> Asset:
+        existing = self._get_sync(asset_id)
+        if existing:
+            os.remove(tmp_path)
+            return existing
+
+        path = self._path_for(asset_id, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        self._index_sync(asset_id, path, size, source_url, extension)
+        return Asset(asset_id, path, size, extension, source_url, None)
+
+    async def adopt(self, tmp_path: str, asset_id: str, size: int, source_url: Optional[str] = None,
+                    extension: str = "png") -> Optional[Asset]:
+        """Принять в хранилище уже записанный временный файл"""
+        try:
+            async with self._lock:
+                return await asyncio.to_thread(self._adopt_sync, tmp_path, asset_id, size, source_url, extension)
+        except Exception as e:
+            logger.error(f"Error adopting asset: {e}")
+            return None
+
+    async def _execute(self, query: str, params: tuple):
+        def _run():
+            conn = self._connect()
+            try:
+                conn.execute(query, params)
+                conn.commit()
+            finally:
+                conn.close()
+        await asyncio.to_thread(_run)
+
+    async def set_file_id(self, asset_id: str, file_id: str):
+        """Запомнить file_id Telegram для повторной отправки без загрузки"""
+        try:
+            await self._execute('UPDATE assets SET file_id = ? WHERE asset_id = ?', (file_id, asset_id))
+        except Exception as e:
+            logger.error(f"Error saving file_id to asset store: {e}")
+
+    async def set_document_file_id(self, asset_id: str, file_id: str):
+        """Запомнить file_id отправки файлом (документом) - он отличается от file_id фото"""
+        try:
+            await self._execute('UPDATE assets SET document_file_id = ? WHERE asset_id = ?', (file_id, asset_id))
+        except Exception as e:
+            logger.error(f"Error saving document file_id to asset store: {e}")
+
+    async def get_variant(self, asset_id: str, profile: str) -> Optional[Asset]:
+        """Найти перекодированную версию asset для профиля"""
+        def _lookup():
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT variant_id FROM variants WHERE asset_id = ? AND profile = ?',
+                                   (asset_id, profile)).fetchone()
+                return row[0] if row else None
+            finally:
+                conn.close()
+        try:
+            variant_id = await asyncio.to_thread(_lookup)
+        except Exception as e:
+            logger.error(f"Error reading asset variants: {e}")
+            return None
+        return await self.get(variant_id) if variant_id else None
+
+    async def set_variant(self, asset_id: str, profile: str, variant_id: str):
+        """Связать asset с его перекодированной версией"""
+        try:
+            await self._execute('INSERT OR REPLACE INTO variants (asset_id, profile, variant_id) VALUES (?, ?, ?)',
+                                (asset_id, profile, variant_id))
+        except Exception as e:
+            logger.error(f"Error saving asset variant: {e}")
+
+    def _head_sync(self, conn: sqlite3.Connection, telegram_id: int, below: int = None) -> Optional[EditVersion]:
+        """
+        Последняя версия (ниже below) с живым файлом. Версии с удаленным asset
+        выбрасываются; истекшая версия (старше history_ttl) выбрасывается вместе
+        со всеми более старыми - их уже нет.
+        """
+        cutoff = time.time() - self.history_ttl
+        while True:
+            row = conn.execute(
+                'SELECT version, asset_id, prompt, created_at FROM edit_history '
+                'WHERE telegram_id = ? AND version < ? ORDER BY version DESC LIMIT 1',
+                (telegram_id, below if below is not None else 2 ** 62)
+            ).fetchone()
+            if not row:
+                return None
+            version, asset_id, prompt, created_at = row
+            if created_at < cutoff:
+                conn.execute('DELETE FROM edit_history WHERE telegram_id = ? AND version <= ?', (telegram_id, version))
+                conn.commit()
+                return None
+            asset = self._load(conn, asset_id)
+            if asset:
+                return EditVersion(version, asset, prompt, created_at)
+            conn.execute('DELETE FROM edit_history WHERE telegram_id = ? AND version = ?', (telegram_id, version))
+            conn.commit()
+
+    def _trim_history(self, conn: sqlite3.Connection, telegram_id: int):
+        """Выбросить старые версии сверх лимита по количеству, возрасту и объему (последняя остается)"""
+        rows = conn.execute('''
+            SELECT h.version, h.created_at, COALESCE(a.size, 0) FROM edit_history h
+            LEFT JOIN assets a ON a.asset_id = h.asset_id
+            WHERE h.telegram_id = ? ORDER BY h.version DESC
+        ''', (telegram_id,)).fetchall()
+        cutoff = time.time() - self.history_ttl
+        total = 0
+        for index, (version, created_at, size) in enumerate(rows):
+            total += size
+            if index and (index >= self.history_versions or created_at < cutoff or total > self.history_max_bytes):
+                conn.execute('DELETE FROM edit_history WHERE telegram_id = ? AND version <= ?',
+                             (telegram_id, version))
+                break
+        conn.commit()
+
+    def _start_history_sync(self, telegram_id: int, asset_id: str):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM edit_history WHERE telegram_id = ?', (telegram_id,))
+            conn.execute('INSERT INTO edit_history (telegram_id, version, asset_id, prompt, created_at) '
+                         'VALUES (?, 0, ?, NULL, ?)', (telegram_id, asset_id, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _push_edit_sync(self, telegram_id: int, parent_id: Optional[str], asset_id: str, prompt: str) -> int:
+        conn = self._connect()
+        try:
+            head = self._head_sync(conn, telegram_id)
+            if parent_id and (head is None or head.asset.asset_id != parent_id):
+                # Правили не последнюю версию (история истекла или началась заново) - новая цепочка
+                conn.execute('DELETE FROM edit_history WHERE telegram_id = ?', (telegram_id,))
+                conn.execute('INSERT INTO edit_history (telegram_id, version, asset_id, prompt, created_at) '
+                             'VALUES (?, 0, ?, NULL, ?)', (telegram_id, parent_id, time.time()))
+                version = 1
+            else:
+                version = head.version + 1 if head else 0
+            conn.execute('INSERT INTO edit_history (telegram_id, version, asset_id, prompt, created_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (telegram_id, version, asset_id, prompt, time.time()))
+            conn.commit()
+            self._trim_history(conn, telegram_id)
+            return version
+        finally:
+            conn.close()
+
+    def _head_of_sync(self, telegram_id: int) -> Optional[EditVersion]:
+        conn = self._connect()
+        try:
+            return self._head_sync(conn, telegram_id)
+        finally:
+            conn.close()
+
+    def _undo_sync(self, telegram_id: int) -> Optional[EditVersion]:
+        conn = self._connect()
+        try:
+            head = self._head_sync(conn, telegram_id)
+            previous = self._head_sync(conn, telegram_id, below=head.version) if head else None
+            if previous is None:
+                # Отменять нечего - последнюю оставшуюся версию не трогаем
+                return None
+            conn.execute('DELETE FROM edit_history WHERE telegram_id = ? AND version > ?',
+                         (telegram_id, previous.version))
+            conn.commit()
+            return previous
+        finally:
+            conn.close()
+
+    async def start_edit_history(self, telegram_id: int, asset_id: str):
+        """Начать новую историю правок с загруженного изображения"""
+        try:
+            await asyncio.to_thread(self._start_history_sync, telegram_id, asset_id)
+        except Exception as e:
+            logger.error(f"Error starting edit history: {e}")
+
+    async def push_edit(self, telegram_id: int, parent_id: Optional[str], asset_id: str, prompt: str) -> Optional[int]:
+        """Добавить результат правки parent_id в историю, вернуть номер версии"""
+        try:
+            return await asyncio.to_thread(self._push_edit_sync, telegram_id, parent_id, asset_id, prompt)
+        except Exception as e:
+            logger.error(f"Error saving edit history: {e}")
+            return None
+
+    async def edit_head(self, telegram_id: int) -> Optional[EditVersion]:
+        """Последняя версия в истории правок - с нее продолжается цепочка"""
+        try:
+            return await asyncio.to_thread(self._head_of_sync, telegram_id)
+        except Exception as e:
+            logger.error(f"Error reading edit history: {e}")
+            return None
+
+    async def undo_edit(self, telegram_id: int) -> Optional[EditVersion]:
+        """Отменить последнюю правку и вернуть предыдущую версию (None - отменять нечего)"""
+        try:
+            return await asyncio.to_thread(self._undo_sync, telegram_id)
+        except Exception as e:
+            logger.error(f"Error undoing edit: {e}")
+            return None
+
+    async def input_url(self, value: str) -> Optional[str]:
+        """
+        URL, который можно передать модели как входное изображение.
+
+        Обычный URL возвращается как есть. Ссылка "asset:<id>" превращается
+        в публичный URL /assets/<id> в app.py (id - sha256 содержимого, угадать
+        его нельзя), а без PUBLIC_BASE_URL - в data URI с содержимым файла.
+        """
+        asset_id = parse_asset_ref(value)
+        if not asset_id:
+            return value
+
+        asset = await self.get(asset_id)
+        if not asset:
+            logger.error(f"Asset {asset_id[:12]} not found")
+            return None
+        if self.public_base_url:
+            return f"{self.public_base_url}/assets/{asset.asset_id}.{asset.extension}"
+        try:
+            data = await asyncio.to_thread(_read_file, asset.path)
+        except Exception as e:
+            logger.error(f"Error reading asset {asset_id[:12]}: {e}")
+            return None
+        mime = MIME_TYPES.get(asset.extension, "application/octet-stream")
+        return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики хранилища для мониторинга"""
+        assets, bytes_stored, with_file_id, edit_versions = 0, 0, 0, 0
+        try:
+            conn = self._connect()
+            assets, bytes_stored, with_file_id = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(file_id) FROM assets'
+            ).fetchone()
+            edit_versions = conn.execute('SELECT COUNT(*) FROM edit_history').fetchone()[0]
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error reading asset store stats: {e}")
+        return {
+            'assets': assets,
+            'bytes_stored': bytes_stored,
+            'max_bytes': self.max_bytes,
+            'with_file_id': with_file_id,
+            'downloads': self.downloads,
+            'file_id_sends': self.file_id_sends,
+            'edit_versions': edit_versions
+        }
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+class AssetWriter:
+    """
+    Потоковая запись asset: части пишутся во временный файл и хэшируются
+    на лету, commit() переносит файл в хранилище под итоговым sha256.
+    """
+
+    def __init__(self, store: AssetStore, source_url: Optional[str], extension: str):
+        self.store = store
+        self.source_url = source_url
+        self.extension = extension
+        self.size = 0
+        self._hash = hashlib.sha256()
+        os.makedirs(os.path.join(store.asset_dir, "tmp"), exist_ok=True)
+        self._tmp_path = os.path.join(store.asset_dir, "tmp", f"{uuid.uuid4().hex}.{extension}.tmp")
+        self._file = open(self._tmp_path, "wb")
+
+    async def write(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        await asyncio.to_thread(self._file.write, chunk)
+
+    async def commit(self) -> Optional[Asset]:
+        self._file.close()
+        return await self.store.adopt(self._tmp_path, self._hash.hexdigest(), self.size,
+                                      self.source_url, self.extension)
+
+    def abort(self):
+        """Удалить временный файл, если commit() не был вызван или не удался"""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+# Глобальный экземпляр хранилища
+asset_store = AssetStore(
+    asset_dir=ASSET_STORE_DIR,
+    max_bytes=ASSET_STORE_MAX_MB * 1024 * 1024,
+    ttl=ASSET_STORE_TTL_DAYS * 86400,
+    public_base_url=PUBLIC_BASE_URL,
+    history_versions=EDIT_HISTORY_MAX_VERSIONS,
+    history_max_bytes=EDIT_HISTORY_MAX_MB * 1024 * 1024,
+    history_ttl=EDIT_HISTORY_TTL_HOURS * 3600
+)
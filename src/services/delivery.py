@@ -0,0 +1,264 @@
+"""
+Доставка результатов генерации в Telegram
+
+Порядок попыток:
+1. file_id уже отправленного изображения - без загрузки;
+2. сохраненный файл из хранилища - загрузка с диска;
+3. потоковая загрузка: ответ Replicate читается по частям и сразу уходит
+   в multipart-запрос к Telegram, параллельно записываясь в хранилище;
+4. отправка по URL - Telegram сам скачивает файл у Replicate.
+
+Если потоковая загрузка не удалась, автоматически пробуем отправку по URL
+(и наоборот, если начали с URL). По каждой доставке считаем переданные
+байты, время до первого байта и пиковый RSS процесса.
+
+Профиль кодирования (OUTPUT_PROFILES) решает, что уходит пользователю:
+оригинал модели перекодируется в компактный формат, а сам оригинал можно
+получить файлом (документом) по кнопке.
+"""
+
+import os
+import resource
+import time
+from collections import deque, Counter
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, AsyncGenerator, Deque, List
+
+from aiogram.types import Message, FSInputFile, InputFile, InputMediaPhoto
+from loguru import logger
+
+from src.services.asset_store import asset_store, Asset, AssetStore
+from src.services.generation_queue import percentile, StageTimings
+from src.services.image_preprocessing import image_preprocessor
+
+# Больше этого Telegram не принимает как фото - отправляем файлом
+TELEGRAM_PHOTO_LIMIT = 10 * 1024 * 1024
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss() -> int:
+    """Текущий RSS процесса в байтах (на не-Linux - пиковый за все время)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+@dataclass
+class DeliveryStats:
+    mode: str  # 'file_id' | 'upload' | 'stream' | 'url' | 'document' | 'media_group'
+    bytes: int = 0
+    ttfb: Optional[float] = None
+    duration: float = 0.0
+    peak_rss: int = 0
+
+class StreamingInputFile(InputFile):
+    """
+    InputFile, который читает результат с Replicate по частям и отдает их
+    в загрузку Telegram, одновременно записывая в хранилище (tee).
+    """
+
+    def __init__(self, url: str, store: AssetStore, extension: str, stats: DeliveryStats,
+                 chunk_size: int = 64 * 1024):
+        super().__init__(filename=f"image.{extension}", chunk_size=chunk_size)
+        self.url = url
+        self.store = store
+        self.extension = extension
+        self.stats = stats
+        self.asset: Optional[Asset] = None
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        writer = self.store.writer(self.url, self.extension)
+        start = time.perf_counter()
+        try:
+            async with self.store.session().get(self.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    if self.stats.ttfb is None:
+                        self.stats.ttfb = time.perf_counter() - start
+                    self.stats.bytes += len(chunk)
+                    self.stats.peak_rss = max(self.stats.peak_rss, current_rss())
+                    await writer.write(chunk)
+                    yield chunk
+            self.store.downloads += 1
+            self.asset = await writer.commit()
+        finally:
+            writer.abort()
+
+class DeliveryService:
+    def __init__(self, store: AssetStore, history: int = 500):
+        self.store = store
+        self._history: Deque[DeliveryStats] = deque(maxlen=history)
+        self.fallbacks = 0
+
+    async def send_photo(self, message: Message, image_url: Optional[str], asset: Optional[Asset],
+                         extension: str = "png", **kwargs) -> tuple[Message, Optional[Asset]]:
+        """
+        Отправить изображение пользователю.
+
+        Возвращает отправленное сообщение и asset (новый, если файл был
+        скачан при потоковой загрузке). Исключение - только если не сработал
+        ни один способ.
+        """
+        if asset and asset.size > TELEGRAM_PHOTO_LIMIT and not asset.file_id:
+            return await self.send_document(message, asset, **kwargs), asset
+
+        if asset:
+            mode = 'file_id' if asset.file_id else 'upload'
+            stats = DeliveryStats(mode, bytes=0 if asset.file_id else asset.size)
+            start = time.perf_counter()
+            if asset.file_id:
+                self.store.file_id_sends += 1
+            sent = await message.answer_photo(photo=asset.file_id or FSInputFile(asset.path), **kwargs)
+            stats.duration = time.perf_counter() - start
+            stats.peak_rss = current_rss()
+            self._record(stats)
+            await self._remember_file_id(asset, sent)
+            return sent, asset
+
+        last_error = None
+        for mode in ('stream', 'url'):
+            stats = DeliveryStats(mode)
+            start = time.perf_counter()
+            try:
+                if mode == 'stream':
+                    photo = StreamingInputFile(image_url, self.store, extension, stats)
+                    sent = await message.answer_photo(photo=photo, **kwargs)
+                    asset = photo.asset
+                else:
+                    sent = await message.answer_photo(photo=image_url, **kwargs)
+            except Exception as e:
+                last_error = e
+                self.fallbacks += 1
+                logger.warning(f"Delivery via {mode} failed, trying fallback: {e}")
+                continue
+
+            stats.duration = time.perf_counter() - start
+            stats.peak_rss = max(stats.peak_rss, current_rss())
+            self._record(stats)
+            await self._remember_file_id(asset, sent)
+            return sent, asset
+
+        raise last_error
+
+    async def prepare_result(self, image_url: Optional[str], original: Optional[Asset],
+                             profile: Dict[str, Any], timings: StageTimings = None) -> tuple[Optional[Asset], Optional[Asset]]:
+        """
+        Подготовить результат к отправке по профилю кодирования.
+
+        Возвращает (оригинал, что отправлять фото). Профиль без max_dim в
+        формате модели отдает оригинал как есть - если его еще нет в хранилище,
+        отправка пойдет потоком (фото None). Иначе оригинал скачивается в
+        хранилище и перекодируется в пуле процессов (время скачивания - в timings).
+        """
+        if profile.get('max_dim') is None and profile['format'] == profile['model_format']:
+            return original, original
+
+        if original is None:
+            start = time.perf_counter()
+            original = await self.store.fetch(image_url, profile['model_format'])
+            if timings is not None:
+                timings.download = time.perf_counter() - start
+        if original is None:
+            # Скачать не удалось - оригинал уйдет потоком или по URL
+            return None, None
+        return original, await self.variant_for(original, profile)
+
+    async def variant_for(self, original: Asset, profile: Dict[str, Any]) -> Asset:
+        """
+        Перекодированная по профилю версия оригинала (создается один раз).
+
+        Если перекодирование не уменьшило файл, версией считается сам оригинал.
+        """
+        key = f"{profile['format']}-q{profile['quality']}-{profile['max_dim']}"
+        variant = await self.store.get_variant(original.asset_id, key)
+        if variant:
+            return variant
+
+        data = await image_preprocessor.encode(original.path, profile['format'], profile['quality'], profile['max_dim'])
+        variant = None
+        if data and len(data) < original.size:
+            variant = await self.store.put(data, None, profile['format'])
+        variant = variant or original
+        await self.store.set_variant(original.asset_id, key, variant.asset_id)
+        return variant
+
+    async def send_media_group(self, message: Message, photos: List[tuple[Optional[Asset], Optional[str]]],
+                               caption: str = None, parse_mode: str = None) -> List[Message]:
+        """
+        Отправить несколько изображений одним альбомом (2-10 штук).
+
+        photos - пары (asset, URL): asset отправляется по file_id или с диска,
+        без asset - по URL. Подпись ставится на первое изображение.
+        """
+        media = []
+        uploaded = 0
+        for index, (asset, image_url) in enumerate(photos):
+            if asset and asset.file_id:
+                self.store.file_id_sends += 1
+                source = asset.file_id
+            elif asset:
+                uploaded += asset.size
+                source = FSInputFile(asset.path)
+            else:
+                source = image_url
+            media.append(InputMediaPhoto(
+                media=source,
+                caption=caption if index == 0 else None,
+                parse_mode=parse_mode if index == 0 else None
+            ))
+
+        stats = DeliveryStats('media_group', bytes=uploaded)
+        start = time.perf_counter()
+        sent = await message.answer_media_group(media=media)
+        stats.duration = time.perf_counter() - start
+        stats.peak_rss = current_rss()
+        self._record(stats)
+
+        for (asset, _), sent_message in zip(photos, sent):
+            await self._remember_file_id(asset, sent_message)
+        return sent
+
+    async def send_document(self, message: Message, asset: Asset, **kwargs) -> Message:
+        """Отправить asset файлом - без пережатия на стороне Telegram"""
+        stats = DeliveryStats('document', bytes=0 if asset.document_file_id else asset.size)
+        start = time.perf_counter()
+        sent = await message.answer_document(
+            document=asset.document_file_id or FSInputFile(asset.path, filename=f"original.{asset.extension}"),
+            **kwargs
+        )
+        stats.duration = time.perf_counter() - start
+        stats.peak_rss = current_rss()
+        self._record(stats)
+        if not asset.document_file_id and sent and sent.document:
+            asset.document_file_id = sent.document.file_id
+            await self.store.set_document_file_id(asset.asset_id, asset.document_file_id)
+        return sent
+
+    async def _remember_file_id(self, asset: Optional[Asset], sent: Message):
+        """Запомнить file_id отправленного фото, чтобы повторно не загружать файл"""
+        if asset and not asset.file_id and sent and sent.photo:
+            asset.file_id = sent.photo[-1].file_id
+            await self.store.set_file_id(asset.asset_id, asset.file_id)
+
+    def _record(self, stats: DeliveryStats):
+        self._history.append(stats)
+        logger.info(f"Delivered via {stats.mode}: {stats.bytes} bytes in {stats.duration:.2f}s, "
+                    f"ttfb {stats.ttfb or 0:.3f}s, peak rss {stats.peak_rss / 1024 / 1024:.1f} MB")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики доставки за последние отправки"""
+        history = list(self._history)
+        ttfbs = [stats.ttfb for stats in history if stats.ttfb is not None]
+        return {
+            'deliveries': len(history),
+            'by_mode': dict(Counter(stats.mode for stats in history)),
+            'bytes': sum(stats.bytes for stats in history),
+            'p50_ttfb': percentile(ttfbs, 50),
+            'p95_ttfb': percentile(ttfbs, 95),
+            'peak_rss': max((stats.peak_rss for stats in history), default=0),
+            'fallbacks': self.fallbacks
+        }
+
+# Глобальный экземпляр сервиса доставки
+delivery_service = DeliveryService(asset_store)
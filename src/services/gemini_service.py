@@ -1,77 +1,406 @@
 import replicate
+import httpx
 import asyncio
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Optional, Any, Callable, Dict
 from loguru import logger
-from config import REPLICATE_API_KEY
+from config import (
+    REPLICATE_API_KEY, REPLICATE_BASE_URL, REPLICATE_MAX_CONNECTIONS, REPLICATE_MAX_KEEPALIVE,
+    REPLICATE_WEBHOOK_URL, REPLICATE_WEBHOOK_FALLBACK_POLL, REPLICATE_DEADLINE, REPLICATE_FALLBACK_MODEL,
+    REPLICATE_HEDGE_MIN_DELAY, REPLICATE_HEDGE_MIN_SAMPLES, MODEL_CATALOG,
+    BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATIO, BREAKER_RESET_TIMEOUT
+)
+from src.services.prediction_waiters import prediction_waiters, TERMINAL_STATUSES
+from src.services.replicate_service import parse_progress
+from src.services.resilience import CircuitBreaker, CircuitOpenError, LatencyTracker
+from src.services.model_router import model_router, RouteDecision
+from src.services.generation_queue import StageTimings
+
+# Колбэк прогресса: (статус предсказания, доля выполнения 0..1 или None)
+ProgressCallback = Callable[[str, Optional[float]], None]
+
+class PredictionError(RuntimeError):
+    """Модель завершила предсказание ошибкой (провайдер при этом исправен)"""
+
+# Общий клиент Replicate на процесс (один пул HTTP-соединений с keep-alive).
+# Пул (транспорт httpx) создаем сами и передаем в SDK параметром transport: так его
+# можно закрыть, не трогая приватный _async_client SDK. Клиент только асинхронный.
+_client: Optional[replicate.Client] = None
+_transport: Optional[httpx.AsyncHTTPTransport] = None
+
+def get_replicate_client() -> replicate.Client:
+    """Получить общий клиент Replicate, создается один раз на процесс (и заново после закрытия)"""
+    global _client, _transport
+    if _client is None:
+        _transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=REPLICATE_MAX_CONNECTIONS,
+            max_keepalive_connections=REPLICATE_MAX_KEEPALIVE
+        ))
+        _client = replicate.Client(
+            api_token=REPLICATE_API_KEY,
+            base_url=REPLICATE_BASE_URL,
+            transport=_transport
+        )
+    return _client
+
+async def close_replicate_client():
+    """Закрыть пул соединений; следующий get_replicate_client() создаст новый клиент"""
+    global _client, _transport
+    if _transport is not None:
+        await _transport.aclose()
+    _client = None
+    _transport = None
+
+def extract_output_url(output: Any) -> Optional[str]:
+    """Получить URL изображения из output предсказания"""
+    if isinstance(output, list):
+        return str(output[0]) if output else None
+    return str(output) if output else None
 
 class ReplicateImageService:
     def __init__(self):
-        # Настройка Replicate с API ключом
-        replicate.Client(api_token=REPLICATE_API_KEY)
+        self.output_format = "png"
+        self.webhook_url = REPLICATE_WEBHOOK_URL
+        self.cancelled_upstream = 0
+        self._cancel_tasks: set[asyncio.Task] = set()
+        
+        # Каталог моделей (ключ -> "owner/name[:version]"); модель под запрос выбирает роутер
+        self.models = {key: entry['model'] for key, entry in MODEL_CATALOG.items()}
+        self.router = model_router
+        self.fallback_model = REPLICATE_FALLBACK_MODEL if REPLICATE_FALLBACK_MODEL in self.models else None
+        
+        # Дедлайн на предсказание; breaker и p95 задержки для hedged-запроса - на каждую модель
+        self.deadline = REPLICATE_DEADLINE
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latency: Dict[str, LatencyTracker] = {}
+        self.deadlines_exceeded = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # URL результатов запасной модели - их не кладем в кэш под ключом основной
+        self._fallback_results: OrderedDict = OrderedDict()
         logger.info("Replicate service initialized")
 
-    async def generate_image(self, prompt: str, user_id: int = None) -> Optional[str]:
-        """Сгенерировать изображение через Replicate API"""
+    @property
+    def client(self) -> replicate.Client:
+        """Общий клиент процесса (после close() создается заново)"""
+        return get_replicate_client()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        """Circuit breaker модели (создается при первом обращении)"""
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(
+                model, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                failure_ratio=BREAKER_FAILURE_RATIO, reset_timeout=BREAKER_RESET_TIMEOUT
+            )
+        return self.breakers[model]
+
+    def latency_for(self, model: str) -> LatencyTracker:
+        """Задержки успешных предсказаний модели (для задержки hedged-запроса)"""
+        if model not in self.latency:
+            self.latency[model] = LatencyTracker(
+                min_samples=REPLICATE_HEDGE_MIN_SAMPLES, min_delay=REPLICATE_HEDGE_MIN_DELAY
+            )
+        return self.latency[model]
+
+    def _unavailable(self) -> list[str]:
+        return [model for model, breaker in self.breakers.items() if breaker.is_open()]
+
+    def available(self, plan: Optional[str] = None, edit: bool = False) -> bool:
+        """Есть модель, подходящая тарифу, чей breaker не разомкнут"""
+        return bool(self.router.candidates(plan, edit, self._unavailable()))
+
+    def route(self, plan: Optional[str] = None, edit: bool = False) -> RouteDecision:
+        """Выбрать модель для запроса. CircuitOpenError - подходящие модели недоступны."""
+        decision = self.router.route(plan, edit, self._unavailable())
+        if decision is None:
+            raise CircuitOpenError(f"No model available for plan {plan}")
+        return decision
+
+    def _model_input(self, model: str, input_data: dict) -> dict:
+        """Вход модели: ее фиксированные параметры плюс понятные ей параметры запроса"""
+        entry = MODEL_CATALOG[model]
+        accepted = {key: value for key, value in input_data.items() if key == "prompt" or key in entry['params']}
+        return {**entry['input'], **accepted}
+
+    def served_by_fallback(self, image_url: Optional[str]) -> bool:
+        """Результат получен от запасной модели"""
+        return image_url in self._fallback_results
+
+    async def _attempt(self, model: str, input_data: dict, on_progress: ProgressCallback = None,
+                       timings: StageTimings = None) -> Optional[str]:
+        """
+        Одно предсказание модели (ключ каталога) с дедлайном.
+
+        Исход учитывают breaker модели (allow() уже вызван) и окно замеров роутера.
+        Успешное предсказание записывает в timings очередь Replicate и работу модели.
+        """
+        breaker = self.breaker(model)
+        metrics = {}
+        start = time.monotonic()
         try:
-            logger.info(f"Generating image with Replicate: {prompt}")
+            result = await asyncio.wait_for(
+                self._predict(self._model_input(model, input_data), on_progress, self.models[model], metrics),
+                timeout=self.deadline
+            )
+        except asyncio.TimeoutError:
+            # wait_for отменил ожидание - предсказание отменится и в Replicate
+            self.deadlines_exceeded += 1
+            breaker.record_failure()
+            self.router.record(model, time.monotonic() - start, False)
+            logger.error(f"Prediction on {model} exceeded deadline {self.deadline:.0f}s")
+            raise
+        except PredictionError:
+            # Отказ модели (например, цензура) - провайдер исправен
+            breaker.record_success()
+            raise
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            self.router.record(model, time.monotonic() - start, False)
+            raise
+        
+        duration = time.monotonic() - start
+        breaker.record_success()
+        self.latency_for(model).add(duration)
+        self.router.record(model, duration, True, metrics.get("predict_time"))
+        if timings is not None:
+            # Все, что не работа модели, - очередь Replicate и доставка статуса
+            timings.model_run = metrics.get("predict_time", duration)
+            timings.upstream_queue = max(0.0, duration - timings.model_run)
+        return result
+
+    async def _run(self, input_data: dict, route: RouteDecision, on_progress: ProgressCallback = None,
+                   hedge: bool = False, timings: StageTimings = None) -> Optional[str]:
+        """
+        Предсказание выбранной роутером моделью с защитой от деградации провайдера.
+
+        Если breaker модели успел разомкнуться, запрос сразу уходит в запасную
+        (если hedge) или завершается CircuitOpenError. Если модель не ответила
+        за p95 своей задержки, параллельно запускается запасная - побеждает
+        первый успешный ответ, второй запрос отменяется. Запасная модель
+        используется, только если проходит по качеству тарифа.
+        """
+        model = route.model
+        fallback = self.fallback_model if hedge else None
+        if fallback and (fallback == model or fallback not in self.router.enabled
+                         or MODEL_CATALOG[fallback].get('quality', 1) < route.floor):
+            fallback = None
+        if not self.breaker(model).allow():
+            if fallback and self.breaker(fallback).allow():
+                logger.warning(f"Circuit {model} open, using fallback {fallback}")
+                return self._mark_fallback(await self._attempt(fallback, input_data, on_progress, timings))
+            raise CircuitOpenError(f"{model} is unavailable")
+        
+        primary = asyncio.create_task(self._attempt(model, input_data, on_progress, timings))
+        delay = self.latency_for(model).hedge_delay() if fallback else None
+        if delay is None:
+            return await primary
+        
+        secondary = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self.breaker(fallback).allow():
+                return await primary
             
+            self.hedges += 1
+            logger.info(f"Primary prediction slower than p95 ({delay:.1f}s), hedging with {fallback}")
+            secondary = asyncio.create_task(self._attempt(fallback, input_data, timings=timings))
+            pending = {primary, secondary}
+            last_error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception():
+                        last_error = task.exception()
+                    elif task.result():
+                        if task is secondary:
+                            self.hedge_wins += 1
+                            self._mark_fallback(task.result())
+                        return task.result()
+            if last_error:
+                raise last_error
+            return None
+        finally:
+            for task in (primary, secondary):
+                if task and not task.done():
+                    task.cancel()
+                elif task and not task.cancelled():
+                    task.exception()  # проигравший мог упасть - ошибку уже учел breaker
+
+    def _mark_fallback(self, image_url: Optional[str]) -> Optional[str]:
+        if image_url:
+            self._fallback_results[image_url] = True
+            while len(self._fallback_results) > 1000:
+                self._fallback_results.popitem(last=False)
+        return image_url
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики устойчивости: breaker'ы, задержки, дедлайны, hedging, роутер"""
+        return {
+            'breakers': {model: breaker.get_stats() for model, breaker in self.breakers.items()},
+            'latency': {
+                model: {'p95': tracker.p95(), 'hedge_delay': tracker.hedge_delay()}
+                for model, tracker in self.latency.items()
+            },
+            'deadlines_exceeded': self.deadlines_exceeded,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'hedge_win_rate': self.hedge_wins / self.hedges if self.hedges else 0.0,
+            'cancelled_upstream': self.cancelled_upstream,
+            'router': self.router.get_stats()
+        }
+
+    async def _predict(self, input_data: dict, on_progress: ProgressCallback = None,
+                       model: str = None, metrics: dict = None) -> Optional[str]:
+        """
+        Создать предсказание и дождаться результата, не блокируя event loop.
+
+        model - "owner/name" или "owner/name:version"; metrics заполняется
+        метриками завершенного предсказания (predict_time).
+        """
+        start_time = time.time()
+        model = model or self.models['nano-banana']
+        params = {}
+        if self.webhook_url:
+            # start - чтобы показать пользователю, что модель взялась за работу
+            events = ["start", "completed"] if on_progress else ["completed"]
+            params = {"webhook": self.webhook_url, "webhook_events_filter": events}
+        if ":" in model:
+            # Модели сообщества вызываются по версии
+            params["version"] = model.split(":", 1)[1]
+        else:
+            params["model"] = model
+        prediction = await self.client.predictions.async_create(input=input_data, **params)
+        logger.info(f"Prediction created: {prediction.id}")
+
+        def report(status: Optional[str], logs: Optional[str]):
+            if on_progress and status and status not in TERMINAL_STATUSES:
+                on_progress(status, parse_progress(logs))
+
+        report(prediction.status, prediction.logs)
+
+        try:
+            if self.webhook_url:
+                # Ждем webhook, опрос статуса - только запасной вариант
+                async def poll():
+                    await prediction.async_reload()
+                    return prediction.dict() if prediction.status in TERMINAL_STATUSES else None
+
+                payload = await prediction_waiters.wait(
+                    prediction.id, poll, poll_interval=REPLICATE_WEBHOOK_FALLBACK_POLL,
+                    on_update=lambda update: report(update.get("status"), update.get("logs"))
+                )
+                if payload is None:
+                    raise RuntimeError(f"Prediction {prediction.id} timed out")
+                prediction.status = payload.get("status")
+                prediction.output = payload.get("output")
+                prediction.error = payload.get("error")
+                prediction.metrics = payload.get("metrics")
+            else:
+                # Тот же опрос, что в prediction.async_wait(), но с отчетом о прогрессе
+                while prediction.status not in TERMINAL_STATUSES:
+                    await asyncio.sleep(self.client.poll_interval)
+                    await prediction.async_reload()
+                    report(prediction.status, prediction.logs)
+        except asyncio.CancelledError:
+            # Ожидание отменили (пользователь или новый запрос) - останавливаем и
+            # предсказание, чтобы не платить за ненужный результат. Отмена в Replicate
+            # идет фоном: слот воркера освобождается сразу.
+            self._cancel_upstream(prediction.id)
+            raise
+
+        if prediction.status != "succeeded":
+            # Сообщение ошибки модели пробрасываем наверх (например, "flagged as sensitive")
+            raise PredictionError(prediction.error or f"Prediction {prediction.id} {prediction.status}")
+
+        if metrics is not None and prediction.metrics:
+            metrics.update(prediction.metrics)
+        logger.info(f"Prediction {prediction.id} finished in {time.time() - start_time:.2f}s")
+        return extract_output_url(prediction.output)
+
+    def _cancel_upstream(self, prediction_id: str):
+        """Отменить предсказание в Replicate в фоновой задаче"""
+        async def cancel():
+            try:
+                await self.client.predictions.async_cancel(prediction_id)
+                self.cancelled_upstream += 1
+                logger.info(f"Prediction {prediction_id} cancelled upstream")
+            except Exception as e:
+                logger.error(f"Error cancelling prediction {prediction_id}: {e}")
+
+        task = asyncio.create_task(cancel())
+        self._cancel_tasks.add(task)
+        task.add_done_callback(self._cancel_tasks.discard)
+
+    async def generate_image(self, prompt: str, user_id: int = None, output_format: str = None,
+                             params: dict = None, on_progress: ProgressCallback = None,
+                             route: RouteDecision = None, timings: StageTimings = None) -> Optional[str]:
+        """
+        Сгенерировать изображение через Replicate API.
+
+        params - доп. параметры модели (например, стиля); route - решение роутера,
+        без него модель выбирается без учета тарифа; timings - куда записать время этапов.
+        """
+        try:
+            logger.info(f"Generating image with Replicate: {prompt}")
+
             # Валидация промпта
             if len(prompt) < 5:
                 logger.error("Prompt too short")
                 return None
-            
-            # Создаем предсказание через официальную библиотеку
-            output = replicate.run(
-                "google/nano-banana",
-                input={
-                    "prompt": prompt,
-                    "output_format": "png"
-                }
-            )
-            
-            if output:
-                # Получаем URL изображения
-                image_url = str(output)
+
+            # Создаем предсказание через асинхронный API (с hedged-запросом к запасной модели)
+            image_url = await self._run({
+                **(params or {}),
+                "prompt": prompt,
+                "output_format": output_format or self.output_format
+            }, route or self.route(), on_progress, hedge=True, timings=timings)
+
+            if image_url:
                 logger.success(f"Image generated successfully: {image_url}")
                 return image_url
             else:
                 logger.error("Failed to generate image")
                 return None
-                
+
+        except CircuitOpenError:
+            # Обработчик ответит "сервис перегружен"
+            raise
         except Exception as e:
             logger.error(f"Error generating image: {e}")
             return None
 
-    async def edit_image(self, prompt: str, image_url: str, user_id: int = None) -> Optional[str]:
+    async def edit_image(self, prompt: str, image_url: str, user_id: int = None,
+                         output_format: str = None, on_progress: ProgressCallback = None,
+                         route: RouteDecision = None, timings: StageTimings = None) -> Optional[str]:
         """Редактировать изображение через Replicate API"""
         try:
             logger.info(f"Editing image with Replicate: {prompt}")
-            
+
             # Убеждаемся, что image_url это строка URL
             if isinstance(image_url, bytes):
                 logger.error("Image URL is bytes, expected string URL")
                 return None
-            
+
             # Создаем предсказание для редактирования
-            output = replicate.run(
-                "google/nano-banana",
-                input={
-                    "prompt": prompt,
-                    "image_input": [str(image_url)],
-                    "output_format": "png"
-                }
-            )
-            
-            if output:
-                # Получаем URL отредактированного изображения
-                edited_url = str(output)
+            edited_url = await self._run({
+                "prompt": prompt,
+                "image_input": [str(image_url)],
+                "output_format": output_format or self.output_format
+            }, route or self.route(edit=True), on_progress, timings=timings)
+
+            if edited_url:
                 logger.success(f"Image edited successfully: {edited_url}")
                 return edited_url
             else:
                 logger.error("Failed to edit image")
                 return None
-                
+
+        except CircuitOpenError:
+            raise
         except Exception as e:
             error_msg = str(e)
             if "sensitive" in error_msg.lower() or "flagged" in error_msg.lower():
@@ -80,5 +409,11 @@ class ReplicateImageService:
                 logger.error(f"Error editing image: {e}")
             return None
 
+    async def close(self):
+        """Дождаться фоновых отмен и закрыть пул HTTP-соединений"""
+        if self._cancel_tasks:
+            await asyncio.gather(*self._cancel_tasks, return_exceptions=True)
+        await close_replicate_client()
+
 # Глобальный экземпляр сервиса
-replicate_service = ReplicateImageService()
\ No newline at end of file
+replicate_service = ReplicateImageService()
@@ -0,0 +1,418 @@
+"""
+Очередь задач генерации с пулом воркеров, приоритетными полосами по тарифам
+и справедливым планированием по пользователям
+"""
+
+import asyncio
+import time
+import uuid
+from collections import deque, defaultdict
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, Callable, Awaitable, Deque, List
+from loguru import logger
+from config import (
+    GENERATION_QUEUE_MAX, GENERATION_MAX_PENDING_PER_USER, GENERATION_MAX_IN_FLIGHT_PER_USER,
+    GENERATION_LANE_MAX_WAIT, SUBSCRIPTION_PLANS, ADMIN_PRIORITY_WEIGHT
+)
+
+DEFAULT_LANE = "admin"
+
+# Тип генерации в истории (image_generations.generation_type) по виду задачи
+GENERATION_TYPES = {'generate': 'text_to_image', 'edit': 'image_edit', 'variations': 'variation'}
+
+# Этапы задачи, время которых пишется в историю (колонки <этап>_ms)
+STAGES = ('queue_wait', 'upstream_queue', 'model_run', 'download', 'delivery')
+
+class QueueFullError(Exception):
+    """Очередь переполнена или у пользователя слишком много задач"""
+
+@dataclass
+class StageTimings:
+    """
+    Время этапов одной генерации (сек; None - этапа не было).
+
+    queue_wait - ожидание в очереди бота; upstream_queue - от создания
+    предсказания до старта модели (очередь Replicate и доставка результата);
+    model_run - работа модели (metrics.predict_time); download - скачивание
+    результата в хранилище; delivery - отправка в Telegram (при потоковой
+    отправке включает и скачивание).
+    """
+    queue_wait: Optional[float] = None
+    upstream_queue: Optional[float] = None
+    model_run: Optional[float] = None
+    download: Optional[float] = None
+    delivery: Optional[float] = None
+
+    def as_ms(self) -> Dict[str, Optional[int]]:
+        """Тайминги в миллисекундах для записи в историю"""
+        values = {stage: getattr(self, stage) for stage in STAGES}
+        return {f"{stage}_ms": int(value * 1000) if value is not None else None for stage, value in values.items()}
+
+@dataclass
+class GenerationJob:
+    telegram_id: int
+    kind: str  # 'generate' | 'edit' | 'variations'
+    prompt: str
+    execute: Callable[["GenerationJob"], Awaitable[Any]]
+    image_url: Optional[str] = None
+    input_hash: Optional[str] = None  # хэш входного изображения (для ключа кэша)
+    regenerate: bool = False  # игнорировать кэш результатов
+    lane: str = DEFAULT_LANE
+    output_profile: Optional[str] = None  # профиль кодирования результата (OUTPUT_PROFILES)
+    style: Optional[str] = None  # стилевой пресет (STYLE_PRESETS)
+    cost: int = 1
+    context: Dict[str, Any] = field(default_factory=dict)
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    enqueued_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cancelled: bool = False
+    delivered: bool = False  # результат отправлен пользователю - отменять поздно
+    task: Optional[asyncio.Task] = field(default=None, repr=False)  # выполнение в воркере
+    timings: StageTimings = field(default_factory=StageTimings)
+
+    @property
+    def wait_time(self) -> float:
+        return (self.started_at or time.time()) - self.enqueued_at
+
+    @property
+    def generation_type(self) -> str:
+        return GENERATION_TYPES.get(self.kind, self.kind)
+
+    def processing_time_ms(self) -> int:
+        """Полное время задачи от постановки в очередь до текущего момента"""
+        return int((time.time() - self.enqueued_at) * 1000)
+
+def percentile(values: list, p: float) -> float:
+    """Перцентиль p (0..100) по списку значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def stage_report(rows: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """
+    p50/p95/p99 каждого этапа (мс) по записям истории генераций.
+
+    rows - словари с колонками <этап>_ms и processing_time_ms (итог - 'total').
+    """
+    report = {}
+    for stage, column in [(stage, f"{stage}_ms") for stage in STAGES] + [('total', 'processing_time_ms')]:
+        values = [row[column] for row in rows if row.get(column) is not None]
+        report[stage] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99)
+        }
+    return report
+
+class _Lane:
+    """Полоса приоритета: deficit round robin по пользователям внутри тарифа"""
+
+    def __init__(self, name: str, weight: int):
+        self.name = name
+        self.weight = weight
+        self.current = 0  # для smooth weighted round robin между полосами
+        self.pending: Dict[int, Deque[GenerationJob]] = defaultdict(deque)
+        self.active_users: Deque[int] = deque()
+        self.deficit: Dict[int, int] = defaultdict(int)
+        self.size = 0
+        self.wait_times: Deque[float] = deque(maxlen=1000)
+
+    def push(self, job: GenerationJob):
+        if not self.pending[job.telegram_id] and job.telegram_id not in self.active_users:
+            self.active_users.append(job.telegram_id)
+        self.pending[job.telegram_id].append(job)
+        self.size += 1
+
+    def oldest_wait(self) -> float:
+        heads = [q[0].enqueued_at for q in self.pending.values() if q]
+        return time.time() - min(heads) if heads else 0.0
+
+    def _drop_user(self, user_id: int):
+        self.active_users.remove(user_id)
+        self.deficit.pop(user_id, None)
+        self.pending.pop(user_id, None)
+
+    def pick(self, in_flight: Dict[int, int], max_in_flight: int, quantum: int) -> Optional[GenerationJob]:
+        """Выбрать следующую задачу полосы (deficit round robin по telegram_id)"""
+        head_costs = [q[0].cost for q in self.pending.values() if q]
+        rounds = max(head_costs, default=1) // quantum + 1
+
+        for _ in range(len(self.active_users) * rounds):
+            user_id = self.active_users[0]
+            user_queue = self.pending.get(user_id)
+
+            if not user_queue:
+                self._drop_user(user_id)
+                continue
+
+            if in_flight.get(user_id, 0) >= max_in_flight:
+                self.active_users.rotate(-1)
+                continue
+
+            job = user_queue[0]
+            if self.deficit[user_id] < job.cost:
+                self.deficit[user_id] += quantum
+                if self.deficit[user_id] < job.cost:
+                    # Пользователь копит квант и уходит в конец круга
+                    self.active_users.rotate(-1)
+                    continue
+
+            user_queue.popleft()
+            self.deficit[user_id] -= job.cost
+            self.size -= 1
+            if user_queue:
+                self.active_users.rotate(-1)
+            else:
+                self._drop_user(user_id)
+            return job
+        return None
+
+class GenerationQueue:
+    """
+    Ограниченная очередь генераций.
+
+    Обработчики кладут задачи через enqueue() и сразу возвращаются, пул воркеров
+    разбирает очередь. Задачи раскладываются по полосам тарифов, между полосами
+    выбор идет взвешенным round robin (старшие тарифы обслуживаются чаще), а
+    полоса, чья самая старая задача ждет дольше max_lane_wait, обслуживается
+    вне очереди - так младшие тарифы не голодают. Внутри полосы - deficit round
+    robin по telegram_id, поэтому один активный пользователь не может вытеснить
+    остальных.
+    """
+
+    def __init__(self, lanes: Dict[str, int] = None, max_size: int = 500, max_pending_per_user: int = 5,
+                 max_in_flight_per_user: int = 2, quantum: int = 1, max_lane_wait: float = 60.0):
+        self.max_size = max_size
+        self.max_pending_per_user = max_pending_per_user
+        self.max_in_flight_per_user = max_in_flight_per_user
+        self.quantum = quantum
+        self.max_lane_wait = max_lane_wait
+
+        lanes = lanes or {DEFAULT_LANE: 1}
+        self._lanes: Dict[str, _Lane] = {name: _Lane(name, weight) for name, weight in lanes.items()}
+        if DEFAULT_LANE not in self._lanes:
+            self._lanes[DEFAULT_LANE] = _Lane(DEFAULT_LANE, 1)
+
+        self._in_flight: Dict[int, int] = defaultdict(int)
+        # Задачи в очереди и в работе по job_id - для отмены
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._size = 0
+        self._cond = asyncio.Condition()
+        self._workers: list[asyncio.Task] = []
+        self._busy = 0
+        self._completed = 0
+        self._failed = 0
+        self._cancelled = 0
+
+    async def start(self, workers: int = 4):
+        """Запустить пул воркеров"""
+        if self._workers:
+            return
+        for index in range(workers):
+            self._workers.append(asyncio.create_task(self._worker(index)))
+        logger.info(f"Generation queue started with {workers} workers")
+
+    async def stop(self):
+        """Остановить воркеры (незавершенные задачи отменяются)"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Generation queue stopped")
+
+    def lane_for_plan(self, plan: Optional[str]) -> str:
+        """Имя полосы для тарифа пользователя"""
+        return plan if plan in self._lanes else DEFAULT_LANE
+
+    def position(self, job: GenerationJob) -> Optional[int]:
+        """
+        Примерное место задачи в очереди (1 - следующая) или None, если она уже
+        не ждет. Считаются задачи, поставленные раньше, во всех полосах: порядок
+        выдачи зависит от весов и round robin, поэтому это оценка сверху.
+        """
+        if job.started_at is not None:
+            return None
+        ahead = 0
+        found = False
+        for lane in self._lanes.values():
+            for user_queue in lane.pending.values():
+                for pending in user_queue:
+                    if pending is job:
+                        found = True
+                    elif pending.enqueued_at < job.enqueued_at:
+                        ahead += 1
+        return ahead + 1 if found else None
+
+    def get_job(self, job_id: str) -> Optional[GenerationJob]:
+        """Задача в очереди или в работе"""
+        return self._jobs.get(job_id)
+
+    def user_jobs(self, user_id: int) -> list[GenerationJob]:
+        """Незавершенные задачи пользователя"""
+        return [job for job in self._jobs.values() if job.telegram_id == user_id]
+
+    async def cancel(self, job_id: str) -> Optional[GenerationJob]:
+        """
+        Отменить задачу. Ожидающая убирается из очереди, выполняющаяся
+        отменяется (CancelledError в обработчике) - слот воркера освобождается
+        сразу. Возвращает отмененную задачу или None, если она уже завершилась
+        или ее результат уже отправлен пользователю.
+        """
+        async with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.cancelled or job.delivered or (job.task and job.task.done()):
+                return None
+            job.cancelled = True
+
+            if job.started_at is None:
+                user_queue = self._lanes[job.lane].pending.get(job.telegram_id)
+                if user_queue and job in user_queue:
+                    user_queue.remove(job)
+                    self._lanes[job.lane].size -= 1
+                    self._size -= 1
+                self._jobs.pop(job_id, None)
+                self._cancelled += 1
+            elif job.task:
+                job.task.cancel()
+
+        logger.info(f"Job {job.job_id} ({job.kind}) of user {job.telegram_id} cancelled")
+        return job
+
+    async def enqueue(self, job: GenerationJob) -> int:
+        """Поставить задачу в очередь. Возвращает текущую глубину очереди."""
+        async with self._cond:
+            if self._size >= self.max_size:
+                raise QueueFullError("Generation queue is full")
+            pending = sum(len(lane.pending.get(job.telegram_id, ())) for lane in self._lanes.values())
+            if pending >= self.max_pending_per_user:
+                raise QueueFullError(f"Too many pending jobs for user {job.telegram_id}")
+
+            job.lane = self.lane_for_plan(job.lane)
+            self._lanes[job.lane].push(job)
+            self._jobs[job.job_id] = job
+            self._size += 1
+            self._cond.notify()
+            logger.info(f"Job {job.job_id} ({job.kind}) queued for user {job.telegram_id} "
+                        f"in lane {job.lane}, depth {self._size}")
+            return self._size
+
+    def _pick(self) -> Optional[GenerationJob]:
+        """Выбрать следующую задачу. Вызывается под self._cond."""
+        candidates = [lane for lane in self._lanes.values() if lane.size]
+        if not candidates:
+            return None
+
+        # Защита от голодания: полоса с задачей, ждущей дольше лимита, идет первой
+        starving = [lane for lane in candidates if lane.oldest_wait() >= self.max_lane_wait]
+        if starving:
+            ordered = sorted(starving, key=lambda lane: -lane.oldest_wait())
+            ordered += [lane for lane in candidates if lane not in starving]
+        else:
+            # Smooth weighted round robin между непустыми полосами
+            total = sum(lane.weight for lane in candidates)
+            for lane in candidates:
+                lane.current += lane.weight
+            best = max(candidates, key=lambda lane: lane.current)
+            best.current -= total
+            ordered = [best] + sorted((lane for lane in candidates if lane is not best),
+                                      key=lambda lane: -lane.weight)
+
+        for lane in ordered:
+            job = lane.pick(self._in_flight, self.max_in_flight_per_user, self.quantum)
+            if job:
+                self._size -= 1
+                return job
+        return None
+
+    async def _next_job(self) -> GenerationJob:
+        async with self._cond:
+            while True:
+                job = self._pick()
+                if job:
+                    self._in_flight[job.telegram_id] += 1
+                    return job
+                await self._cond.wait()
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._next_job()
+            job.started_at = time.time()
+            job.timings.queue_wait = job.wait_time
+            self._lanes[job.lane].wait_times.append(job.wait_time)
+            self._busy += 1
+            job.task = asyncio.create_task(job.execute(job))
+            try:
+                await job.task
+                self._completed += 1
+            except asyncio.CancelledError:
+                if not job.cancelled:
+                    # Останавливают сам воркер - задачу тоже отменяем
+                    job.task.cancel()
+                    raise
+                self._cancelled += 1
+            except Exception as e:
+                self._failed += 1
+                logger.error(f"Job {job.job_id} failed in worker {index}: {e}")
+            finally:
+                job.finished_at = time.time()
+                self._busy -= 1
+                self._jobs.pop(job.job_id, None)
+                async with self._cond:
+                    self._in_flight[job.telegram_id] -= 1
+                    if self._in_flight[job.telegram_id] <= 0:
+                        self._in_flight.pop(job.telegram_id, None)
+                    # Пользователь мог упираться в лимит in-flight
+                    self._cond.notify_all()
+
+    async def join(self):
+        """Дождаться, пока очередь опустеет и воркеры освободятся"""
+        while self._size or self._busy:
+            await asyncio.sleep(0.05)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики очереди для мониторинга"""
+        waits = [wait for lane in self._lanes.values() for wait in lane.wait_times]
+        pending_per_user: Dict[int, int] = defaultdict(int)
+        for lane in self._lanes.values():
+            for user_id, user_queue in lane.pending.items():
+                if user_queue:
+                    pending_per_user[user_id] += len(user_queue)
+
+        return {
+            'queue_depth': self._size,
+            'workers': len(self._workers),
+            'busy_workers': self._busy,
+            'pending_per_user': dict(pending_per_user),
+            'in_flight_per_user': dict(self._in_flight),
+            'avg_wait_time': sum(waits) / len(waits) if waits else 0.0,
+            'max_wait_time': max(waits) if waits else 0.0,
+            'lanes': {
+                name: {
+                    'weight': lane.weight,
+                    'depth': lane.size,
+                    'p50_wait': percentile(list(lane.wait_times), 50),
+                    'p95_wait': percentile(list(lane.wait_times), 95),
+                    'samples': len(lane.wait_times)
+                }
+                for name, lane in self._lanes.items()
+            },
+            'completed': self._completed,
+            'failed': self._failed,
+            'cancelled': self._cancelled
+        }
+
+# Глобальный экземпляр очереди: полосы по тарифам из SUBSCRIPTION_PLANS
+generation_queue = GenerationQueue(
+    lanes={
+        **{plan: info.get('priority_weight', 1) for plan, info in SUBSCRIPTION_PLANS.items()},
+        DEFAULT_LANE: ADMIN_PRIORITY_WEIGHT
+    },
+    max_size=GENERATION_QUEUE_MAX,
+    max_pending_per_user=GENERATION_MAX_PENDING_PER_USER,
+    max_in_flight_per_user=GENERATION_MAX_IN_FLIGHT_PER_USER,
+    max_lane_wait=GENERATION_LANE_MAX_WAIT
+)
@@ -0,0 +1,184 @@
+"""
+Обработка изображений в пуле процессов
+
+Входы: фото из Telegram скачивается один раз, проверяется по заголовку
+(формат и размеры без декодирования пикселей), поворачивается по EXIF,
+уменьшается до разрешения, полезного модели, и пережимается в компактный JPEG.
+
+Выходы: результат модели перекодируется по профилю (формат, качество,
+максимальная сторона) перед отправкой пользователю.
+
+Вся работа с пикселями идет в пуле процессов, event loop не блокируется.
+"""
+
+import asyncio
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+from loguru import logger
+from PIL import Image, ImageOps
+from config import IMAGE_MAX_DIM, IMAGE_JPEG_QUALITY, IMAGE_PREPROCESS_WORKERS, IMAGE_MAX_UPLOAD_MB
+
+ALLOWED_FORMATS = ("JPEG", "PNG", "WEBP")
+
+# Расширение файла -> формат Pillow
+PIL_FORMATS = {"jpg": "JPEG", "webp": "WEBP", "png": "PNG"}
+
+# Защита от "декомпрессионных бомб": больше этого не декодируем
+MAX_PIXELS = 50_000_000
+
+class InvalidImageError(Exception):
+    """Файл не является поддерживаемым изображением"""
+
+@dataclass
+class PreprocessedImage:
+    data: bytes
+    extension: str
+    original_size: int
+    original_dims: tuple[int, int]
+    dims: tuple[int, int]
+    duration: float
+
+def preprocess_image(data: bytes, max_dim: int, quality: int) -> tuple[bytes, tuple[int, int], tuple[int, int]]:
+    """
+    Проверить, повернуть, уменьшить и пережать изображение.
+
+    Выполняется в дочернем процессе. Возвращает (JPEG, исходные размеры, итоговые размеры).
+    """
+    # Image.open читает только заголовок - пиксели еще не декодированы
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Exception as e:
+        raise InvalidImageError(f"cannot identify image: {e}")
+    if image.format not in ALLOWED_FORMATS:
+        raise InvalidImageError(f"unsupported format {image.format}")
+    width, height = image.size
+    if width * height > MAX_PIXELS:
+        raise InvalidImageError(f"image too large: {width}x{height}")
+
+    # draft() позволяет JPEG-декодеру сразу читать уменьшенную версию
+    image.draft("RGB", (max_dim, max_dim))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_dim, max_dim), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue(), (width, height), image.size
+
+def encode_image(path: str, extension: str, quality: int, max_dim: int) -> tuple[bytes, tuple[int, int]]:
+    """
+    Перекодировать изображение с диска по профилю.
+
+    Выполняется в дочернем процессе (путь вместо байт - чтобы не гонять
+    большой файл через pickle). Возвращает (байты, итоговые размеры).
+    """
+    with Image.open(path) as image:
+        image.draft("RGB", (max_dim, max_dim))
+        if extension == "jpg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.thumbnail((max_dim, max_dim), Image.LANCZOS)
+
+        output = io.BytesIO()
+        if extension == "jpg":
+            image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+        elif extension == "webp":
+            image.save(output, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(output, format=PIL_FORMATS[extension], optimize=True)
+        return output.getvalue(), image.size
+
+class ImagePreprocessor:
+    def __init__(self, max_dim: int, quality: int, workers: int, max_upload_bytes: int):
+        self.max_dim = max_dim
+        self.quality = quality
+        self.workers = workers
+        self.max_upload_bytes = max_upload_bytes
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.rejected = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total_time = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def process(self, data: bytes) -> Optional[PreprocessedImage]:
+        """Предобработать изображение. Возвращает None, если файл не подходит."""
+        if len(data) > self.max_upload_bytes:
+            logger.warning(f"Image rejected: {len(data)} bytes exceeds upload limit")
+            self.rejected += 1
+            return None
+
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            processed, original_dims, dims = await loop.run_in_executor(
+                self._get_executor(), preprocess_image, data, self.max_dim, self.quality
+            )
+        except InvalidImageError as e:
+            logger.warning(f"Image rejected: {e}")
+            self.rejected += 1
+            return None
+        except Exception as e:
+            logger.error(f"Error preprocessing image: {e}")
+            self.rejected += 1
+            return None
+
+        duration = time.perf_counter() - start
+        self.processed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(processed)
+        self.total_time += duration
+        logger.info(f"Image preprocessed: {original_dims} -> {dims}, "
+                    f"{len(data)} -> {len(processed)} bytes in {duration:.2f}s")
+        return PreprocessedImage(processed, "jpg", len(data), original_dims, dims, duration)
+
+    async def encode(self, path: str, extension: str, quality: int, max_dim: int) -> Optional[bytes]:
+        """Перекодировать результат для отправки. Возвращает None при ошибке."""
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            data, dims = await loop.run_in_executor(
+                self._get_executor(), encode_image, path, extension, quality, max_dim
+            )
+        except Exception as e:
+            logger.error(f"Error encoding image: {e}")
+            return None
+        logger.info(f"Image encoded to {extension} q{quality} {dims}: {len(data)} bytes "
+                    f"in {time.perf_counter() - start:.2f}s")
+        return data
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики предобработки для мониторинга"""
+        return {
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+            'avg_time': self.total_time / self.processed if self.processed else 0.0
+        }
+
+    def close(self):
+        """Остановить пул процессов"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# Глобальный экземпляр
+image_preprocessor = ImagePreprocessor(
+    max_dim=IMAGE_MAX_DIM,
+    quality=IMAGE_JPEG_QUALITY,
+    workers=IMAGE_PREPROCESS_WORKERS,
+    max_upload_bytes=IMAGE_MAX_UPLOAD_MB * 1024 * 1024
+)
@@ -0,0 +1,234 @@
+"""
+Роутер моделей генерации
+
+Для каждого запроса выбирает модель из каталога (MODEL_CATALOG) по
+скользящему окну собственных замеров: задержка успешных предсказаний,
+доля ошибок и цена предсказания. Пока замеров мало, используются оценки
+из каталога. Модели ниже минимального качества тарифа не рассматриваются.
+Небольшая доля запросов (ROUTER_EXPLORE) уходит в наименее изученную
+подходящую модель - иначе окно замеров невыбранных моделей не обновляется.
+
+Политика задается оператором (ROUTER_POLICY или /admin_router):
+- fastest - минимум ожидаемого времени с учетом повторов после ошибок;
+- cheapest - минимум ожидаемой цены успешного результата;
+- best - максимум качества, при равенстве - надежность и задержка.
+
+Каждое решение вместе с входными данными пишется в лог ("Router decision")
+и хранится в памяти для аудита.
+"""
+
+import json
+import random
+import time
+from collections import deque, Counter
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Deque, Iterable
+
+from loguru import logger
+from config import (
+    MODEL_CATALOG, ROUTER_POLICY, ROUTER_MODELS, ROUTER_WINDOW, ROUTER_MIN_SAMPLES, ROUTER_EXPLORE,
+    SUBSCRIPTION_PLANS, ADMIN_MODEL_QUALITY
+)
+from src.services.generation_queue import percentile
+
+POLICIES = ("fastest", "cheapest", "best")
+
+# Нижняя граница вероятности успеха в оценках: модель с одними ошибками
+# получает большой, но конечный штраф
+MIN_SUCCESS_RATE = 0.1
+
+@dataclass
+class RouteDecision:
+    model: str  # ключ каталога
+    ref: str  # "owner/name" или "owner/name:version"
+    policy: str
+    floor: int
+    candidates: List[Dict[str, Any]] = field(default_factory=list)
+    explore: bool = False
+
+class ModelStats:
+    """Скользящее окно исходов предсказаний одной модели"""
+
+    def __init__(self, window: int):
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._durations: Deque[float] = deque(maxlen=window)
+        self._costs: Deque[float] = deque(maxlen=window)
+
+    def record(self, duration: float, ok: bool, cost: Optional[float] = None):
+        self._outcomes.append(ok)
+        if ok:
+            self._durations.append(duration)
+            if cost is not None:
+                self._costs.append(cost)
+
+    @property
+    def samples(self) -> int:
+        return len(self._outcomes)
+
+    def failure_rate(self) -> float:
+        return self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0
+
+    def p50(self) -> float:
+        return percentile(list(self._durations), 50)
+
+    def p95(self) -> float:
+        return percentile(list(self._durations), 95)
+
+    def avg_cost(self) -> Optional[float]:
+        return sum(self._costs) / len(self._costs) if self._costs else None
+
+class ModelRouter:
+    def __init__(self, catalog: Dict[str, Dict[str, Any]], policy: str = "best", enabled: Iterable[str] = None,
+                 window: int = 50, min_samples: int = 5, explore: float = 0.0, history: int = 100):
+        self.catalog = catalog
+        self.enabled = [key for key in (enabled or catalog) if key in catalog]
+        self.policy = policy if policy in POLICIES else "best"
+        self.window = window
+        self.min_samples = min_samples
+        self.explore = explore
+        self._stats: Dict[str, ModelStats] = {}
+        self._decisions: Deque[Dict[str, Any]] = deque(maxlen=history)
+        self.chosen: Counter = Counter()
+        self.unroutable = 0
+        self.explored = 0
+
+    def set_policy(self, policy: str) -> bool:
+        """Сменить политику выбора (оператор). False - неизвестная политика."""
+        if policy not in POLICIES:
+            return False
+        logger.info(f"Router policy changed: {self.policy} -> {policy}")
+        self.policy = policy
+        return True
+
+    def stats(self, key: str) -> ModelStats:
+        if key not in self._stats:
+            self._stats[key] = ModelStats(self.window)
+        return self._stats[key]
+
+    def quality_floor(self, plan: Optional[str]) -> int:
+        """Минимальное качество модели для тарифа (без тарифа - без ограничений)"""
+        if plan == 'admin':
+            return ADMIN_MODEL_QUALITY
+        return SUBSCRIPTION_PLANS.get(plan, {}).get('model_quality', 0)
+
+    def prediction_cost(self, key: str, predict_time: Optional[float]) -> Optional[float]:
+        """Цена одного предсказания: за изображение или по времени GPU"""
+        entry = self.catalog[key]
+        if entry.get('cost') is not None:
+            return entry['cost']
+        if entry.get('cost_per_second') is not None and predict_time is not None:
+            return entry['cost_per_second'] * predict_time
+        return None
+
+    def record(self, key: str, duration: float, ok: bool, predict_time: Optional[float] = None):
+        """Учесть исход предсказания модели"""
+        if key in self.catalog:
+            self.stats(key).record(duration, ok, self.prediction_cost(key, predict_time) if ok else None)
+
+    def estimate(self, key: str) -> Dict[str, Any]:
+        """Оценки модели: свои замеры, если их достаточно, иначе данные каталога"""
+        entry = self.catalog[key]
+        stats = self.stats(key)
+        observed = stats.samples >= self.min_samples
+        latency = stats.p50() if observed and stats.p50() else entry.get('latency', 10)
+        cost = stats.avg_cost() if observed else None
+        if cost is None:
+            cost = self.prediction_cost(key, entry.get('latency', 10)) or 0.0
+        return {
+            'model': key,
+            'quality': entry.get('quality', 1),
+            'latency': latency,
+            'failure_rate': stats.failure_rate() if observed else 0.0,
+            'cost': cost,
+            'samples': stats.samples
+        }
+
+    def _score(self, estimate: Dict[str, Any]) -> tuple:
+        """Ключ сортировки по политике (меньше - лучше)"""
+        success = max(MIN_SUCCESS_RATE, 1 - estimate['failure_rate'])
+        if self.policy == "fastest":
+            return (estimate['latency'] / success, -estimate['quality'])
+        if self.policy == "cheapest":
+            return (estimate['cost'] / success, estimate['latency'])
+        return (-estimate['quality'], estimate['failure_rate'], estimate['latency'])
+
+    def candidates(self, plan: Optional[str], edit: bool = False, unavailable: Iterable[str] = ()) -> List[str]:
+        """Модели, подходящие запросу, в порядке предпочтения текущей политики"""
+        floor = self.quality_floor(plan)
+        unavailable = set(unavailable)
+        keys = [
+            key for key in self.enabled
+            if self.catalog[key].get('quality', 1) >= floor
+            and key not in unavailable
+            and (not edit or self.catalog[key].get('edit'))
+        ]
+        return sorted(keys, key=lambda key: self._score(self.estimate(key)))
+
+    def route(self, plan: Optional[str], edit: bool = False, unavailable: Iterable[str] = ()) -> Optional[RouteDecision]:
+        """
+        Выбрать модель для запроса.
+
+        unavailable - модели, которые сейчас нельзя вызывать (разомкнут breaker).
+        None - подходящей модели нет.
+        """
+        unavailable = set(unavailable)
+        floor = self.quality_floor(plan)
+        ranked = self.candidates(plan, edit, unavailable)
+        estimates = [self.estimate(key) for key in ranked]
+        explore = len(ranked) > 1 and random.random() < self.explore
+        if explore:
+            chosen = min(ranked[1:], key=lambda key: self.stats(key).samples)
+        else:
+            chosen = ranked[0] if ranked else None
+        record = {
+            'time': time.time(),
+            'plan': plan,
+            'edit': edit,
+            'policy': self.policy,
+            'floor': floor,
+            'unavailable': sorted(unavailable),
+            'candidates': estimates,
+            'chosen': chosen,
+            'explore': explore
+        }
+        self._decisions.append(record)
+        logger.info(f"Router decision: {json.dumps(record, ensure_ascii=False, default=str)}")
+
+        if chosen is None:
+            self.unroutable += 1
+            return None
+        self.chosen[chosen] += 1
+        self.explored += explore
+        return RouteDecision(chosen, self.catalog[chosen]['model'], self.policy, floor, estimates, explore)
+
+    def recent_decisions(self, limit: int = 10) -> List[Dict[str, Any]]:
+        return list(self._decisions)[-limit:]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики роутера: политика, выбор моделей и окно замеров по каждой"""
+        return {
+            'policy': self.policy,
+            'chosen': dict(self.chosen),
+            'unroutable': self.unroutable,
+            'explored': self.explored,
+            'models': {
+                key: {
+                    'samples': self.stats(key).samples,
+                    'failure_rate': self.stats(key).failure_rate(),
+                    'p50_latency': self.stats(key).p50(),
+                    'p95_latency': self.stats(key).p95(),
+                    'avg_cost': self.stats(key).avg_cost()
+                }
+                for key in self.enabled
+            }
+        }
+
+# Глобальный экземпляр роутера
+model_router = ModelRouter(
+    MODEL_CATALOG,
+    policy=ROUTER_POLICY,
+    enabled=ROUTER_MODELS,
+    window=ROUTER_WINDOW,
+    min_samples=ROUTER_MIN_SAMPLES,
+    explore=ROUTER_EXPLORE
+)
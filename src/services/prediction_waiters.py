@@ -0,0 +1,132 @@
+"""
+Таблица ожидающих предсказаний Replicate, которые завершаются через webhook
+
+Сервис генерации регистрирует id предсказания и ждет future. Webhook
+(/replicate-webhook в app.py или внутренний сервер бота) вызывает resolve()
+с телом запроса от Replicate. Если webhook потерялся, ожидание
+подстраховывается редким опросом статуса. Промежуточные webhook'и (start)
+передаются в on_update ожидающего - для показа прогресса.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable
+from loguru import logger
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+# Допустимое расхождение webhook-timestamp с текущим временем (сек) - защита от повтора старых запросов
+WEBHOOK_TOLERANCE = 300
+
+def verify_webhook_signature(headers: Dict[str, str], body: bytes, secret: str,
+                             tolerance: float = WEBHOOK_TOLERANCE) -> bool:
+    """Проверить подпись webhook Replicate (заголовки webhook-id/-timestamp/-signature)"""
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature", "")
+    if not webhook_id or not timestamp or not signatures:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+    except ValueError:
+        return False
+
+    key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    signed = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    return any(
+        hmac.compare_digest(expected, signature.split(",", 1)[-1])
+        for signature in signatures.split()
+    )
+
+class PredictionWaiters:
+    def __init__(self, early_ttl: float = 300.0):
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._listeners: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+        # Webhook может прийти раньше, чем мы успели зарегистрировать id
+        self._early: Dict[str, tuple[float, Dict[str, Any]]] = {}
+        self.early_ttl = early_ttl
+        self.resolved_by_webhook = 0
+        self.resolved_by_poll = 0
+
+    def resolve(self, payload: Dict[str, Any]) -> bool:
+        """Передать результат webhook ожидающему. Возвращает True, если ожидающий найден."""
+        prediction_id = payload.get("id")
+        if not prediction_id:
+            return False
+        if payload.get("status") not in TERMINAL_STATUSES:
+            listener = self._listeners.get(prediction_id)
+            if listener:
+                listener(payload)
+            return listener is not None
+
+        future = self._waiters.get(prediction_id)
+        if future is None:
+            self._remember_early(prediction_id, payload)
+            return False
+
+        if not future.done():
+            future.set_result(payload)
+            self.resolved_by_webhook += 1
+        return True
+
+    def _remember_early(self, prediction_id: str, payload: Dict[str, Any]):
+        now = time.time()
+        for stale_id in [key for key, (ts, _) in self._early.items() if now - ts > self.early_ttl]:
+            del self._early[stale_id]
+        self._early[prediction_id] = (now, payload)
+
+    async def wait(self, prediction_id: str, poll: Callable[[], Awaitable[Optional[Dict[str, Any]]]],
+                   timeout: float = 300.0, poll_interval: float = 15.0,
+                   on_update: Callable[[Dict[str, Any]], None] = None) -> Optional[Dict[str, Any]]:
+        """
+        Дождаться завершения предсказания.
+
+        poll() - запасной опрос статуса: возвращает тело предсказания, если оно
+        завершено, иначе None. on_update получает промежуточные webhook'и.
+        Возвращает тело предсказания или None по таймауту.
+        """
+        early = self._early.pop(prediction_id, None)
+        if early:
+            self.resolved_by_webhook += 1
+            return early[1]
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[prediction_id] = future
+        if on_update:
+            self._listeners[prediction_id] = on_update
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"Prediction {prediction_id} timeout after {timeout} seconds")
+                    return None
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout=min(poll_interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+
+                # Webhook не пришел вовремя - проверяем статус сами
+                payload = await poll()
+                if payload and payload.get("status") in TERMINAL_STATUSES:
+                    logger.warning(f"Prediction {prediction_id} resolved by fallback polling")
+                    self.resolved_by_poll += 1
+                    return payload
+        finally:
+            self._waiters.pop(prediction_id, None)
+            self._listeners.pop(prediction_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'waiting': len(self._waiters),
+            'resolved_by_webhook': self.resolved_by_webhook,
+            'resolved_by_poll': self.resolved_by_poll
+        }
+
+# Глобальный экземпляр (на процесс)
+prediction_waiters = PredictionWaiters()
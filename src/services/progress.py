@@ -0,0 +1,161 @@
+"""
+Живой прогресс генерации в сообщении "⏳ Пожалуйста, подождите..."
+
+Источники обновлений - место в очереди и статус предсказания Replicate
+(starting -> processing, процент из логов модели). Обновления приходят чаще,
+чем Telegram разрешает править сообщение (порядка раза в секунду на чат),
+поэтому ProgressReporter хранит только последний текст и правит сообщение
+не чаще min_interval: промежуточные состояния схлопываются, одинаковый текст
+не отправляется повторно.
+"""
+
+import asyncio
+from collections import Counter
+from contextlib import suppress
+from typing import Optional, Dict, Any, Coroutine
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message, InlineKeyboardMarkup
+from loguru import logger
+from config import PROGRESS_UPDATES, PROGRESS_EDIT_INTERVAL
+
+STAGE_LABELS = {
+    'queued': "📋 В очереди",
+    'starting': "🚀 Запуск модели",
+    'processing': "🎨 Рисую"
+}
+
+def render_progress(title: str, stage: str, progress: Optional[float] = None,
+                    position: Optional[int] = None, waited: Optional[float] = None) -> str:
+    """Текст сообщения о прогрессе: заголовок, стадия, место в очереди или процент"""
+    line = STAGE_LABELS.get(stage, f"⏳ {stage}")
+    if position:
+        line += f": {position}-й"
+    if waited:
+        # Растущее время ожидания показывает, что бот не завис, даже если очередь стоит
+        line += f" (ждем {int(waited)} с)"
+    if progress is not None:
+        filled = int(progress * 10)
+        line += f": {int(progress * 100)}% {'▓' * filled}{'░' * (10 - filled)}"
+    return f"{title}\n\n{line}"
+
+class ProgressReporter:
+    """Троттлинг правок одного сообщения о прогрессе"""
+
+    def __init__(self, service: "ProgressService", message: Message, title: str, min_interval: float,
+                 reply_markup: Optional[InlineKeyboardMarkup] = None):
+        self.service = service
+        self.message = message
+        self.title = title
+        # Правка текста без reply_markup убирает кнопки - передаем их каждый раз
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval
+        self.closed = False
+        self._text: Optional[str] = None
+        self._sent: Optional[str] = None
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def update(self, stage: str, progress: Optional[float] = None, position: Optional[int] = None,
+               waited: Optional[float] = None):
+        """Новое состояние; сообщение обновится при ближайшей возможности"""
+        if self.closed or not self.service.enabled:
+            return
+        text = render_progress(self.title, stage, progress, position, waited)
+        if text == self._text:
+            return
+        if self._changed.is_set():
+            # Предыдущее состояние так и не попало в Telegram - заменяем его
+            self.service.coalesced += 1
+        self._text = text
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def spawn(self, coro: Coroutine):
+        """Фоновая задача, которая живет, пока открыт reporter (например, слежение за очередью)"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self._text
+            if text != self._sent:
+                try:
+                    await self.message.edit_text(text, reply_markup=self.reply_markup, parse_mode="HTML")
+                    self._sent = text
+                    self.service.edits += 1
+                except TelegramRetryAfter as e:
+                    # Превысили лимит правок - ждем и отправляем последнее состояние
+                    self.service.throttled += 1
+                    self._changed.set()
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except Exception as e:
+                    logger.debug(f"Progress edit failed: {e}")
+            await asyncio.sleep(self.min_interval)
+
+    async def close(self):
+        """Остановить обновления до отправки результата (повторный вызов безопасен)"""
+        if self.closed:
+            return
+        self.closed = True
+        tasks = list(self._tasks) + ([self._task] if self._task else [])
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+
+class ProgressService:
+    def __init__(self, enabled: bool, min_interval: float):
+        self.enabled = enabled
+        self.min_interval = min_interval
+        self.edits = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.submissions = 0
+        self.duplicates = 0
+        # (пользователь, промпт) -> число задач в очереди или в работе
+        self._active: Counter = Counter()
+
+    def start(self, message: Message, title: str,
+              reply_markup: Optional[InlineKeyboardMarkup] = None) -> ProgressReporter:
+        """Reporter для сообщения о прогрессе задачи"""
+        return ProgressReporter(self, message, title, self.min_interval, reply_markup)
+
+    def submitted(self, user_id: int, prompt: str) -> bool:
+        """Учесть отправку промпта. True - такой же промпт пользователя еще в работе (повтор)."""
+        key = (user_id, prompt.strip().lower())
+        duplicate = self._active[key] > 0
+        self.submissions += 1
+        if duplicate:
+            self.duplicates += 1
+            logger.info(f"Duplicate submission from user {user_id} while previous job is in flight")
+        self._active[key] += 1
+        return duplicate
+
+    def finished(self, user_id: int, prompt: str):
+        key = (user_id, prompt.strip().lower())
+        self._active[key] -= 1
+        if self._active[key] <= 0:
+            del self._active[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики прогресса и повторных отправок"""
+        return {
+            'enabled': self.enabled,
+            'edits': self.edits,
+            'coalesced': self.coalesced,
+            'throttled': self.throttled,
+            'submissions': self.submissions,
+            'duplicates': self.duplicates,
+            'duplicate_rate': self.duplicates / self.submissions if self.submissions else 0.0
+        }
+
+# Глобальный экземпляр сервиса прогресса
+progress_service = ProgressService(enabled=PROGRESS_UPDATES, min_interval=PROGRESS_EDIT_INTERVAL)
@@ -4,28 +4,65 @@
 """
 
 import os
-import requests
+import re
+import aiohttp
 import time
 import asyncio
 from typing import Optional
 from loguru import logger
-from config import REPLICATE_API_KEY
+from config import (
+    REPLICATE_API_KEY, REPLICATE_BASE_URL, REPLICATE_WEBHOOK_URL, REPLICATE_WEBHOOK_FALLBACK_POLL,
+    REPLICATE_MAX_CONNECTIONS, REPLICATE_POLL_MIN, REPLICATE_POLL_MAX, MODEL_CATALOG
+)
+from src.services.prediction_waiters import prediction_waiters
+
+# Прогресс из логов модели, например "45%|████▌     | 9/20"
+PROGRESS_PATTERN = re.compile(r"(\d+)%\|")
+
+def parse_progress(logs: Optional[str]) -> Optional[float]:
+    """Последний процент выполнения из логов предсказания (0..1)"""
+    matches = PROGRESS_PATTERN.findall(logs or "")
+    return int(matches[-1]) / 100 if matches else None
+
+def retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    """Значение заголовка Retry-After в секундах"""
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
 
 class ReplicateImageService:
     def __init__(self):
         self.api_key = REPLICATE_API_KEY
-        self.base_url = "https://api.replicate.com/v1"
+        self.base_url = f"{REPLICATE_BASE_URL or 'https://api.replicate.com'}/v1"
+        self.webhook_url = REPLICATE_WEBHOOK_URL
+        # Границы адаптивного интервала опроса статуса (сек)
+        self.poll_min = REPLICATE_POLL_MIN
+        self.poll_max = REPLICATE_POLL_MAX
+        self._session: Optional[aiohttp.ClientSession] = None
         self.headers = {
             'Authorization': f'Token {self.api_key}',
             'Content-Type': 'application/json'
         }
         
-        # Популярные модели для генерации изображений
-        self.models = {
-            'stable-diffusion': 'stability-ai/stable-diffusion:27b93a2413e7f36cd83da926f3656280b2931564ff050bf9575f1fdf9bcd7478',
-            'sdxl': 'stability-ai/sdxl:39ed52f2a78e934b3ba6e2a89f5b1c712de7dfea535525255b1aa35c5565e08b',
-            'flux': 'black-forest-labs/flux:36d42d23d8ec4e2745e8e79ebde4bae3f9c46e6a'
-        }
+        # Модели каталога, которые вызываются по версии (POST /predictions)
+        self.models = {key: entry['model'] for key, entry in MODEL_CATALOG.items() if ':' in entry['model']}
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия с keep-alive, создается один раз"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=30),
+                connector=aiohttp.TCPConnector(limit=REPLICATE_MAX_CONNECTIONS, keepalive_timeout=60)
+            )
+        return self._session
+    
+    async def close(self):
+        """Закрыть HTTP-сессию"""
+        if self._session and not self._session.closed:
+            await self._session.close()
     
     async def generate_image(self, prompt: str, model: str = 'stable-diffusion') -> Optional[str]:
         """Сгенерировать изображение через Replicate API"""
@@ -38,10 +75,11 @@ class ReplicateImageService:
                 return None
             
             # Выбираем модель
-            model_version = self.models.get(model, self.models['stable-diffusion'])
+            if model not in self.models:
+                model = 'stable-diffusion'
             
             # Создаем предсказание
-            prediction = await self._create_prediction(prompt, model_version)
+            prediction = await self._create_prediction(prompt, model)
             if not prediction:
                 logger.error("Failed to create prediction")
                 return None
@@ -50,7 +88,7 @@ class ReplicateImageService:
             logger.info(f"Prediction created: {prediction_id}")
             
             # Ждем завершения и получаем результат
-            result = await self._wait_for_completion(prediction_id)
+            result = await self._wait_for_completion(prediction_id, model)
             if result:
                 logger.success(f"Image generated successfully: {result}")
                 return result
@@ -62,116 +100,130 @@ class ReplicateImageService:
             logger.error(f"Error generating image: {e}")
             return None
     
-    async def _create_prediction(self, prompt: str, model_version: str) -> Optional[dict]:
-        """Создать предсказание в Replicate"""
+    async def _create_prediction(self, prompt: str, model: str) -> Optional[dict]:
+        """Создать предсказание в Replicate (model - ключ MODEL_CATALOG)"""
         try:
-            # Параметры для разных моделей
-            if 'stable-diffusion' in model_version:
-                input_data = {
-                    "prompt": prompt,
-                    "width": 512,
-                    "height": 512,
-                    "num_inference_steps": 20,
-                    "guidance_scale": 7.5
-                }
-            elif 'sdxl' in model_version:
-                input_data = {
-                    "prompt": prompt,
-                    "width": 1024,
-                    "height": 1024,
-                    "num_inference_steps": 25,
-                    "guidance_scale": 7.5
-                }
-            elif 'flux' in model_version:
-                input_data = {
-                    "prompt": prompt,
-                    "width": 1024,
-                    "height": 1024,
-                    "num_inference_steps": 20
-                }
-            else:
-                input_data = {"prompt": prompt}
-            
+            # Фиксированные параметры модели берем из каталога
             payload = {
-                "version": model_version,
-                "input": input_data
+                "version": self.models[model],
+                "input": {**MODEL_CATALOG[model]['input'], "prompt": prompt}
             }
+            if self.webhook_url:
+                payload["webhook"] = self.webhook_url
+                payload["webhook_events_filter"] = ["completed"]
             
-            response = requests.post(
-                f"{self.base_url}/predictions",
-                headers=self.headers,
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 201:
-                result = response.json()
-                logger.info(f"Prediction created successfully: {result['id']}")
-                return result
-            else:
-                logger.error(f"Failed to create prediction: {response.status_code} - {response.text}")
-                return None
+            async with self._get_session().post(f"{self.base_url}/predictions", json=payload) as response:
+                if response.status == 201:
+                    result = await response.json()
+                    logger.info(f"Prediction created successfully: {result['id']}")
+                    return result
+                else:
+                    logger.error(f"Failed to create prediction: {response.status} - {await response.text()}")
+                    return None
                 
         except Exception as e:
             logger.error(f"Error creating prediction: {e}")
             return None
     
-    async def _wait_for_completion(self, prediction_id: str, max_wait_time: int = 300) -> Optional[str]:
+    def _extract_output(self, prediction: dict) -> Optional[str]:
+        """Получить URL изображения из завершенного предсказания"""
+        status = prediction.get('status')
+        
+        if status == 'succeeded':
+            # Получаем URL изображения
+            output = prediction.get('output')
+            if output:
+                if isinstance(output, list) and len(output) > 0:
+                    image_url = output[0]
+                elif isinstance(output, str):
+                    image_url = output
+                else:
+                    logger.error(f"Unexpected output format: {output}")
+                    return None
+                
+                logger.success(f"Image ready: {image_url}")
+                return image_url
+            else:
+                logger.error("No output in successful prediction")
+                return None
+        
+        error = prediction.get('error', 'Unknown error')
+        logger.error(f"Prediction {status}: {error}")
+        return None
+    
+    async def _get_prediction(self, prediction_id: str) -> tuple[Optional[dict], Optional[float]]:
+        """Получить текущее состояние предсказания и Retry-After, если сервер его прислал"""
+        async with self._get_session().get(f"{self.base_url}/predictions/{prediction_id}") as response:
+            if response.status == 200:
+                return await response.json(), None
+            
+            logger.error(f"Failed to check prediction status: {response.status}")
+            return None, retry_after(response)
+    
+    def _clamp_poll_interval(self, interval: float) -> float:
+        return min(self.poll_max, max(self.poll_min, interval))
+    
+    def _next_poll_interval(self, prediction: Optional[dict], interval: float, elapsed: float,
+                            expected: float) -> float:
+        """
+        Адаптивный интервал опроса.
+        
+        Первый опрос - чуть раньше типичной задержки модели (expected). Если
+        модель пишет прогресс в логи, ждем чуть меньше оставшегося по оценке
+        времени, пока типичная задержка не истекла - ждем до нее. Иначе
+        интервал растет экспоненциально до poll_max. Смена статуса
+        (starting -> processing) интервал не сбрасывает: о времени до
+        завершения она ничего не говорит.
+        """
+        progress = parse_progress(prediction.get('logs')) if prediction else None
+        if progress:
+            remaining = elapsed * (1 - progress) / progress
+            return self._clamp_poll_interval(remaining * 0.9)
+        
+        if elapsed < expected:
+            return self._clamp_poll_interval(expected - elapsed)
+        
+        return min(self.poll_max, interval * 1.5)
+    
+    async def _wait_for_completion(self, prediction_id: str, model: str, max_wait_time: int = 300) -> Optional[str]:
         """Ждать завершения предсказания и получить результат"""
         try:
+            if self.webhook_url:
+                # Результат приходит webhook'ом, опрос - только запасной вариант
+                async def poll():
+                    prediction, _ = await self._get_prediction(prediction_id)
+                    return prediction
+                
+                prediction = await prediction_waiters.wait(
+                    prediction_id,
+                    poll,
+                    timeout=max_wait_time,
+                    poll_interval=REPLICATE_WEBHOOK_FALLBACK_POLL
+                )
+                return self._extract_output(prediction) if prediction else None
+            
             start_time = time.time()
+            # Типичная задержка модели из каталога
+            expected = MODEL_CATALOG[model]['latency']
+            interval = self._clamp_poll_interval(expected * 0.9)
             
             while time.time() - start_time < max_wait_time:
-                logger.info(f"Checking prediction {prediction_id} status...")
+                await asyncio.sleep(interval)
                 
-                response = requests.get(
-                    f"{self.base_url}/predictions/{prediction_id}",
-                    headers=self.headers,
-                    timeout=30
-                )
+                prediction, server_delay = await self._get_prediction(prediction_id)
+                status = prediction.get('status') if prediction else None
+                logger.debug(f"Prediction {prediction_id} status: {status}")
                 
-                if response.status_code == 200:
-                    prediction = response.json()
-                    status = prediction.get('status')
-                    
-                    logger.info(f"Prediction status: {status}")
-                    
-                    if status == 'succeeded':
-                        # Получаем URL изображения
-                        output = prediction.get('output')
-                        if output:
-                            if isinstance(output, list) and len(output) > 0:
-                                image_url = output[0]
-                            elif isinstance(output, str):
-                                image_url = output
-                            else:
-                                logger.error(f"Unexpected output format: {output}")
-                                return None
-                            
-                            logger.success(f"Image ready: {image_url}")
-                            return image_url
-                        else:
-                            logger.error("No output in successful prediction")
-                            return None
-                    
-                    elif status == 'failed':
-                        error = prediction.get('error', 'Unknown error')
-                        logger.error(f"Prediction failed: {error}")
-                        return None
-                    
-                    elif status in ['starting', 'processing']:
-                        # Предсказание еще выполняется
-                        await asyncio.sleep(5)  # Ждем 5 секунд
-                        continue
-                    
-                    else:
-                        logger.warning(f"Unknown status: {status}")
-                        await asyncio.sleep(5)
-                        continue
-                else:
-                    logger.error(f"Failed to check prediction status: {response.status_code}")
-                    await asyncio.sleep(5)
-                    continue
+                if status in ['succeeded', 'failed', 'canceled']:
+                    return self._extract_output(prediction)
+                
+                if status not in [None, 'starting', 'processing']:
+                    logger.warning(f"Unknown status: {status}")
+                
+                interval = self._next_poll_interval(prediction, interval, time.time() - start_time, expected)
+                if server_delay:
+                    # Сервер просит подождать (429/503) - уважаем Retry-After
+                    interval = max(interval, server_delay)
             
             # Превышено время ожидания
             logger.error(f"Prediction timeout after {max_wait_time} seconds")
@@ -0,0 +1,118 @@
+"""
+Устойчивость вызовов внешнего провайдера (Replicate)
+
+CircuitBreaker считает исходы последних вызовов: когда доля ошибок высока,
+он "размыкается" и сразу отказывает, не дожидаясь таймаутов. Через
+reset_timeout пропускает один пробный вызов (half-open): успех замыкает
+цепь, ошибка снова размыкает.
+
+LatencyTracker хранит длительности успешных вызовов и дает задержку для
+hedged-запроса: если ответа нет дольше p95, запасной запрос почти наверняка
+не лишний.
+"""
+
+import time
+from collections import deque
+from typing import Optional, Dict, Any, Deque
+
+from loguru import logger
+
+from src.services.generation_queue import percentile
+
+class CircuitOpenError(Exception):
+    """Провайдер недоступен: circuit breaker разомкнут"""
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_ratio: float = 0.5,
+                 reset_timeout: float = 30.0, half_open_probes: int = 1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def is_open(self) -> bool:
+        """Разомкнут и еще не готов к пробному вызову"""
+        return self.state == self.OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        """Можно ли сейчас вызывать провайдера. В half-open занимает слот пробного вызова."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probes = 0
+            logger.info(f"Circuit {self.name} half-open, probing")
+
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                self.rejected += 1
+                return False
+            self._probes += 1
+        return True
+
+    def record_success(self):
+        if self.state == self.HALF_OPEN:
+            self.state = self.CLOSED
+            self._outcomes.clear()
+            logger.success(f"Circuit {self.name} closed")
+        self._outcomes.append(True)
+
+    def record_failure(self):
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+        self._outcomes.append(False)
+        failures = self._outcomes.count(False)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_ratio:
+            self._open()
+
+    def release(self):
+        """Вызов отменен без результата - вернуть слот пробного вызова"""
+        if self.state == self.HALF_OPEN and self._probes:
+            self._probes -= 1
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.opened += 1
+        logger.warning(f"Circuit {self.name} opened for {self.reset_timeout:.0f}s")
+
+    def get_stats(self) -> Dict[str, Any]:
+        failures = self._outcomes.count(False)
+        return {
+            'state': self.state,
+            'failure_rate': failures / len(self._outcomes) if self._outcomes else 0.0,
+            'opened': self.opened,
+            'rejected': self.rejected
+        }
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, min_samples: int = 20, min_delay: float = 10.0):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+    def add(self, duration: float):
+        self._samples.append(duration)
+
+    def p95(self) -> float:
+        return percentile(list(self._samples), 95)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Через сколько секунд отправлять hedged-запрос (None - мало данных)"""
+        if len(self._samples) < self.min_samples:
+            return None
+        return max(self.min_delay, self.p95())
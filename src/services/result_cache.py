@@ -0,0 +1,199 @@
+"""
+Кэш результатов генерации: prompt -> изображение
+
+Ключ - хэш нормализованного кортежа (модель, промпт, формат, хэш входного
+изображения, стилевой пресет). Сами изображения лежат в хранилище assets
+(asset_store.py), кэш хранит только ссылку ключ -> asset в SQLite, поэтому
+переживает перезапуск бота. Вытеснение - LRU по суммарному размеру плюс TTL.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+from loguru import logger
+from config import RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB, RESULT_CACHE_TTL_HOURS
+from src.services.asset_store import asset_store, Asset, AssetStore
+
+@dataclass
+class CachedResult:
+    key: str
+    asset: Asset
+
+    @property
+    def source_url(self) -> Optional[str]:
+        return self.asset.source_url
+
+def normalize_prompt(prompt: str) -> str:
+    """Нормализовать промпт: регистр, пробелы, финальная пунктуация"""
+    return re.sub(r"\s+", " ", prompt or "").strip().lower().rstrip(".!")
+
+class ResultCache:
+    def __init__(self, cache_dir: str, max_bytes: int, ttl: float, assets: AssetStore):
+        self.cache_dir = cache_dir
+        self.assets = assets
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_path = os.path.join(cache_dir, "index.db")
+        self.hits = 0
+        self.misses = 0
+        self._lock = asyncio.Lock()
+        self._init_index()
+
+    def _init_index(self):
+        """Инициализация индекса кэша"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            conn = sqlite3.connect(self.index_path)
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    asset_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_results_last_access ON results(last_access)')
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error initializing result cache: {e}")
+
+    @staticmethod
+    def make_key(model: str, prompt: str, output_format: str, input_hash: str = None, style: str = None) -> str:
+        """Ключ кэша по нормализованному кортежу параметров генерации (стиль - только если выбран)"""
+        parts = [model, normalize_prompt(prompt), output_format, input_hash or ""]
+        if style:
+            parts.append(style)
+        payload = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_path)
+
+    def _get_sync(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT asset_id, created_at FROM results WHERE key = ?', (key,)).fetchone()
+            if not row:
+                return None
+            asset_id, created_at = row
+            if time.time() - created_at > self.ttl:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                conn.commit()
+                return None
+            conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+            return asset_id
+        finally:
+            conn.close()
+
+    def _delete_sync(self, key: str):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _put_sync(self, key: str, asset: Asset):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('''
+                INSERT OR REPLACE INTO results (key, asset_id, size, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (key, asset.asset_id, asset.size, now, now))
+            conn.commit()
+            self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn: sqlite3.Connection):
+        """Удалить просроченные записи и самые давно использованные сверх лимита"""
+        cursor = conn.execute('DELETE FROM results WHERE created_at < ?', (time.time() - self.ttl,))
+        evicted = cursor.rowcount
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total > self.max_bytes:
+            for key, size in conn.execute('SELECT key, size FROM results ORDER BY last_access').fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                total -= size
+                evicted += 1
+
+        if evicted:
+            conn.commit()
+            logger.info(f"Result cache evicted {evicted} entries")
+
+    async def get(self, key: str) -> Optional[CachedResult]:
+        """Найти результат в кэше"""
+        return await self.get_first([key])
+
+    async def get_first(self, keys: List[str]) -> Optional[CachedResult]:
+        """Первый найденный результат из нескольких ключей (одно обращение в статистике)"""
+        result = None
+        try:
+            for key in keys:
+                asset_id = await asyncio.to_thread(self._get_sync, key)
+                if not asset_id:
+                    continue
+                asset = await self.assets.get(asset_id)
+                if asset:
+                    result = CachedResult(key, asset)
+                    break
+                # Файл вытеснен из хранилища - запись кэша больше не нужна
+                await asyncio.to_thread(self._delete_sync, key)
+        except Exception as e:
+            logger.error(f"Error reading result cache: {e}")
+        if result:
+            self.hits += 1
+            logger.info(f"Result cache hit: {result.key[:12]}")
+        else:
+            self.misses += 1
+        return result
+
+    async def put(self, key: str, asset: Asset) -> Optional[CachedResult]:
+        """Связать ключ кэша с сохраненным asset"""
+        try:
+            async with self._lock:
+                await asyncio.to_thread(self._put_sync, key, asset)
+            return CachedResult(key, asset)
+        except Exception as e:
+            logger.error(f"Error writing result cache: {e}")
+            return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Метрики кэша для мониторинга"""
+        entries, bytes_stored = 0, 0
+        try:
+            conn = self._connect()
+            entries, bytes_stored = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error reading result cache stats: {e}")
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'entries': entries,
+            'bytes_stored': bytes_stored,
+            'max_bytes': self.max_bytes
+        }
+
+# Глобальный экземпляр кэша
+result_cache = ResultCache(
+    cache_dir=RESULT_CACHE_DIR,
+    max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+    ttl=RESULT_CACHE_TTL_HOURS * 3600,
+    assets=asset_store
+)
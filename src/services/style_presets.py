@@ -0,0 +1,58 @@
+"""
+Стилевые пресеты генерации
+
+Шаблоны из STYLE_PRESETS разбираются один раз при импорте: шаблон делится
+по {prompt} на префикс и суффикс, параметры модели замораживаются. Применение
+пресета к промпту - конкатенация трех строк, без format() и разбора шаблона
+на каждый запрос.
+"""
+
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Mapping
+
+from loguru import logger
+from config import STYLE_PRESETS
+
+PROMPT_PLACEHOLDER = "{prompt}"
+
+@dataclass(frozen=True)
+class StylePreset:
+    key: str
+    name: str
+    prefix: str
+    suffix: str
+    params: Mapping[str, Any] = field(default_factory=dict)
+
+    def apply(self, prompt: str) -> str:
+        """Подставить описание пользователя в шаблон стиля"""
+        return self.prefix + prompt + self.suffix
+
+def compile_preset(key: str, spec: Dict[str, Any]) -> StylePreset:
+    """Разобрать шаблон стиля; без {prompt} стиль дописывается после описания"""
+    template = spec.get("template") or PROMPT_PLACEHOLDER
+    if PROMPT_PLACEHOLDER not in template:
+        template = f"{PROMPT_PLACEHOLDER}. {template}"
+    prefix, suffix = template.split(PROMPT_PLACEHOLDER, 1)
+    return StylePreset(
+        key=key,
+        name=spec.get("name", key),
+        prefix=prefix,
+        suffix=suffix,
+        params=MappingProxyType(dict(spec.get("params") or {}))
+    )
+
+class StylePresets:
+    def __init__(self, specs: Dict[str, Dict[str, Any]]):
+        self._presets = {key: compile_preset(key, spec) for key, spec in specs.items()}
+        logger.info(f"Loaded {len(self._presets)} style presets")
+
+    def get(self, key: Optional[str]) -> Optional[StylePreset]:
+        """Пресет по ключу (None - без стиля или стиль неизвестен)"""
+        return self._presets.get(key) if key else None
+
+    def all(self) -> list[StylePreset]:
+        return list(self._presets.values())
+
+# Глобальный экземпляр пресетов (загружается один раз при старте)
+style_presets = StylePresets(STYLE_PRESETS)